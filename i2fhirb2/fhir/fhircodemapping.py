@@ -1,11 +1,12 @@
 import copy
-from typing import List, Dict, Callable, Optional
+from typing import List, Dict, Callable, Optional, Tuple
 
 from fhirtordf.rdfsupport import fhirgraphutils
 from fhirtordf.rdfsupport.namespaces import FHIR
 from rdflib import URIRef, Graph, RDF
 from rdflib.term import Node, Literal
 
+from i2fhirb2.fhir.fhirconceptcache import LRUCache, CODING_CACHE_SIZE
 from i2fhirb2.fhir.fhirnamespaces import fhir_namespace_for
 from i2b2model.data.i2b2observationfact import ObservationFactKey, ObservationFact, valuetype_text, \
     valuetype_number, valuetype_novalue
@@ -82,8 +83,6 @@ def value_codeable_concept(g: Graph, subject: Node, obs_fact: ObservationFact) -
     :param obs_fact: target fact(s)
     :return: Additional obs_facts beyond obs_fact itself
     """
-    from i2fhirb2.fhir.fhirobservationfact import FHIRObservationFact
-
     rval = []
     if obs_fact.modifier_cd != '@':
         print(f"{obs_fact.concept_cd}, {obs_fact.modifier_cd}: Modifier on modifier!")
@@ -93,8 +92,7 @@ def value_codeable_concept(g: Graph, subject: Node, obs_fact: ObservationFact) -
         for coding in codings:
             obs_fact_copy = copy.copy(obs_fact)
             if obs_fact.modifier_cd == '@':
-                concept_uri = concept_uri_for(g, coding)
-                concept_ns_name = FHIRObservationFact.ns_name_for(concept_uri) if concept_uri else None
+                concept_ns_name = coding_concept(g, coding)[1]
                 if concept_ns_name:
                     obs_fact.modifier_cd = concept_ns_name
             display = fhirgraphutils.value(g, coding, FHIR.Coding.display)
@@ -175,14 +173,49 @@ def concept_uri_for(g: Graph, coding: Node) -> Optional[URIRef]:
     """
     uri = g.value(coding, RDF.type)
     if uri is None:
-        # TODO: Combine this with the rules in fhirtordf - they should do exactly the same thing
         system = fhirgraphutils.value(g, coding, FHIR.Coding.system)
         code = fhirgraphutils.value(g, coding, FHIR.Coding.code)
         if system and code:
-            uri = URIRef(system + ('' if system.endswith(('#', '/')) else '/') + code)
+            uri = _coding_uri(system, code)
     return uri
 
 
+def _coding_uri(system: str, code: str) -> URIRef:
+    # TODO: Combine this with the rules in fhirtordf - they should do exactly the same thing
+    return URIRef(system + ('' if system.endswith(('#', '/')) else '/') + code)
+
+
+# Concept URI and NS:code for the codings seen so far, keyed by type arc or (system, code).  The same handful of
+# LOINC / SNOMED / RxNorm codings recur across every resource in a population.
+coding_cache = LRUCache("Coding", CODING_CACHE_SIZE)
+
+
+def coding_concept(g: Graph, coding: Node) -> Tuple[Optional[URIRef], Optional[str]]:
+    """ Return the concept URI (see ``concept_uri_for``) and its NS:code form for coding.  Codings whose namespace is
+    known are cached in ``coding_cache``.
+
+    :param g: Graph containing the coding node
+    :param coding: node that contains the FHIR.Coding entry
+    :return: URI or None if nothing is available, NS:code or None if the namespace isn't known
+    """
+    from i2fhirb2.fhir.fhirobservationfact import FHIRObservationFact   # Imported here to prevent recursive imports
+
+    key = g.value(coding, RDF.type)
+    if key is None:
+        system = fhirgraphutils.value(g, coding, FHIR.Coding.system)
+        code = fhirgraphutils.value(g, coding, FHIR.Coding.code)
+        if not (system and code):
+            return None, None
+        key = (system, code)
+    rval = coding_cache.get(key)
+    if rval is None:
+        uri = key if isinstance(key, URIRef) else _coding_uri(*key)
+        rval = uri, FHIRObservationFact.ns_name_for(uri)
+        if rval[1] is not None:
+            coding_cache.put(key, rval)
+    return rval
+
+
 def add_concept_values(g: Graph, obs_fact: ObservationFact, subject: URIRef, graph_node: Node) -> List[ObservationFact]:
     """  Add any value[x] entries to obs_fact
 
@@ -234,9 +267,10 @@ def process_concept_code(g: Graph, root_concept: URIRef, subject: Node, predicat
     for target in g.objects(subject, predicate):                        # Indirectly looking for FHIR:CodedEntry
         for target_p, target_o in g.predicate_objects(target):
             if target_p == FHIR.CodeableConcept.coding:                 # And interior FHIR:Coding
-                target_concept_code = concept_uri_for(g, target_o)      # Look for type arc or synthesize it
+                # Look for type arc or synthesize it
+                target_concept_code, target_ns_name = coding_concept(g, target_o)
                 # Code must exist and we have to have a known namespace to proceed
-                if target_concept_code and FHIRObservationFact.ns_name_for(target_concept_code):
+                if target_ns_name:
                     if predicate in bare_codes:
                         # Predicate can serve as a concept_cd for the resource itself
                         # Add the root element and its values
@@ -268,7 +302,7 @@ def process_concept_code(g: Graph, root_concept: URIRef, subject: Node, predicat
                                 for entry in base_entries:
                                     fact_entry = copy.copy(entry)
                                     fact_entry.concept_cd = id_code
-                                    fact_entry.modifier_cd = FHIRObservationFact.ns_name_for(target_concept_code)
+                                    fact_entry.modifier_cd = target_ns_name
                                     fact_entry.instance_num = 0
                                     rval.append(fact_entry)
                                 if not base_entries:
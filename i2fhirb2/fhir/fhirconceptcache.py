@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Dict, Tuple
+
+CODING_CACHE_SIZE = 50000           # Maximum number of (system, code) / type arc to concept entries
+NS_NAME_CACHE_SIZE = 100000         # Maximum number of concept URI to NS:code entries
+
+
+class LRUCache:
+    """
+    Bounded least recently used cache that counts its hits and misses.  Caches are registered by name when they
+    are created so their statistics can be reported at the end of a load (see ``cache_stats``)
+    """
+    def __init__(self, name: str, maxsize: int) -> None:
+        """
+        Create a cache
+        :param name: name the cache is reported under
+        :param maxsize: maximum number of entries.  The least recently used entry is discarded past this
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()       # type: OrderedDict[Hashable, Any]
+        _caches[name] = self
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Return the entry for key, marking it as the most recently used
+        :param key: entry key
+        :return: entry value or None if key isn't in the cache
+        """
+        rval = self._entries.get(key)
+        if rval is None:
+            self.misses += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return rval
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Add an entry, discarding the least recently used entry if the cache is full
+        :param key: entry key
+        :param value: entry value.  Must not be None
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """ Remove all entries and reset the statistics """
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = f"{self.hits * 100.0 / lookups:.1f}%" if lookups else "n/a"
+        return f"{self.name}: {self.hits} hits / {self.misses} misses ({hit_rate} hit rate, max {self.maxsize} entries)"
+
+
+_caches = OrderedDict()             # type: OrderedDict[str, LRUCache]
+
+
+def cache_counts() -> Dict[str, Tuple[int, int]]:
+    """ Return the hit and miss counts of the registered caches """
+    return {name: (cache.hits, cache.misses) for name, cache in _caches.items()}
+
+
+def add_cache_counts(counts: Dict[str, Tuple[int, int]]) -> None:
+    """
+    Add hit and miss counts that were accumulated elsewhere (e.g. in a worker process) to the registered caches
+    :param counts: counts to add (see ``cache_counts``)
+    """
+    for name, (hits, misses) in counts.items():
+        if name in _caches:
+            _caches[name].hits += hits
+            _caches[name].misses += misses
+
+
+def clear_caches() -> None:
+    """ Empty every registered cache.  The Coding cache holds NS:code values, so it can't outlive the NS:code cache """
+    for cache in _caches.values():
+        cache.clear()
+
+
+def cache_stats() -> str:
+    """ Return a printable summary of the registered cache statistics """
+    return "=== CACHES ===\n" + ''.join(f"    {cache.stats()}\n" for cache in _caches.values())
+
@@ -1,53 +1,24 @@
-from typing import Dict, Tuple, Optional
+from typing import Dict, Tuple, Optional, List, Iterable
 
 from fhirtordf.rdfsupport.uriutils import parse_fhir_resource_uri
 from rdflib import URIRef
 from rdflib.namespace import split_uri
-from sqlalchemy import func, or_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, select, or_
 
 from i2fhirb2.common_cli_parameters import DEFAULT_PROJECT_ID, DEFAULT_ENCOUNTER_NUMBER_START, IDE_SOURCE_HIVE
+from i2fhirb2.fhir.fhirnumbergenerator import NumberGenerator
 from i2b2model.data.i2b2encountermapping import EncounterMapping, EncounterIDEStatus
+from i2b2model.shared.listchunker import ListChunker
 from i2b2model.sqlsupport.dbconnection import I2B2Tables
 
 
-class EncounterNumberGenerator:
+class EncounterNumberGenerator(NumberGenerator):
     """
     i2b2 encounter number generator.
     """
-    def __init__(self, next_number: int) -> None:
-        """
-        Create the number generator
-        :param next_number: First encounter number to assign
-        """
-        self._next_number = next_number
-
-    def new_number(self) -> int:
-        """
-        Return a new encounter number
-        :return:
-        """
-        rval = self._next_number
-        self._next_number += 1
-        return rval
-
-    def refresh(self, tables: I2B2Tables, ignore_upload_id: Optional[int]) -> int:
-        """
-        Determine the greatest encounter number that is currently in use and set the next number to one greater
-        :param tables: i2b2 SQL tables
-        :param ignore_upload_id: If present, encounters with this upload id are ignored.  This is used in cases when
-        an upload is being replaced.
-        :return: next number
-        """
-        session = sessionmaker(bind=tables.crc_engine)()
-        q = func.max(tables.visit_dimension.c.encounter_num)
-        if ignore_upload_id is not None:
-            q = q.filter(or_(tables.visit_dimension.c.upload_id.is_(None),
-                         tables.visit_dimension.c.upload_id != ignore_upload_id))
-        qr = session.query(q).all()
-        self._next_number = qr[0][0] + 1
-        session.close()
-        return self._next_number
+    @staticmethod
+    def _number_column(tables: I2B2Tables) -> Column:
+        return tables.visit_dimension.c.encounter_num
 
 
 class FHIREncounterMapping:
@@ -55,6 +26,7 @@ class FHIREncounterMapping:
     identity_source_id = IDE_SOURCE_HIVE    # source_id for identity mapping
     number_generator = EncounterNumberGenerator(DEFAULT_ENCOUNTER_NUMBER_START)
     number_map = dict()                     # type: Dict[Tuple[str, str, str, str, str], int]
+    preload_chunk_size = 1000               # Number of identifiers per IN (...) clause in ``preload``
 
     @classmethod
     def _clear(cls) -> None:
@@ -76,6 +48,81 @@ class FHIREncounterMapping:
         """
         return cls.number_generator.refresh(tables, ignore_upload_id)
 
+    @classmethod
+    def mapping_key(cls, encounterURI: URIRef, patient_id: str, patient_ide_source: str) \
+            -> Tuple[str, str, str, str, str]:
+        """
+        Return the number map key for an encounter
+        :param encounterURI: URI of the encounter
+        :param patient_id: Associated patient identifier
+        :param patient_ide_source: Associated patient identifier source
+        :return: encounter_ide, encounter_ide_source, project_id, patient_ide, patient_ide_source
+        """
+        parsed_resource = parse_fhir_resource_uri(encounterURI)
+        resource_ide = split_uri(parsed_resource.resource_type)[1] + '/' + parsed_resource.resource
+        return resource_ide, str(parsed_resource.namespace), cls.project_id, patient_id, patient_ide_source
+
+    @classmethod
+    def preload(cls, tables: I2B2Tables, keys: Iterable[Tuple[str, str, str, str, str]],
+                ignore_upload_id: Optional[int] = None) -> int:
+        """
+        Seed the number map with the encounter numbers that are already assigned to keys in the encounter_mapping
+        table, using ``encounter_ide IN (...)`` queries of ``preload_chunk_size`` identifiers
+        :param tables: i2b2 data tables link
+        :param keys: encounter keys (see ``mapping_key``) referenced by the input
+        :param ignore_upload_id: If present, ignore mappings with this upload id, as they will be deleted
+        :return: number of keys resolved
+        """
+        wanted = {key for key in keys if key not in cls.number_map}
+        emc = tables.encounter_mapping.c
+        nresolved = 0
+        for chunk in ListChunker(sorted({key[0] for key in wanted}), cls.preload_chunk_size, print_progress=False):
+            q = select([emc.encounter_ide, emc.encounter_ide_source, emc.project_id, emc.patient_ide,
+                        emc.patient_ide_source, emc.encounter_num]).where(emc.encounter_ide.in_(chunk))
+            if ignore_upload_id is not None:
+                q = q.where(or_(emc.upload_id.is_(None), emc.upload_id != ignore_upload_id))
+            for row in tables.crc_connection.execute(q):
+                key = (row.encounter_ide, row.encounter_ide_source, row.project_id, row.patient_ide,
+                       row.patient_ide_source)
+                if key in wanted and key not in cls.number_map:
+                    cls.number_map[key] = row.encounter_num
+                    cls.number_map.setdefault((str(row.encounter_num), cls.identity_source_id, row.project_id),
+                                              row.encounter_num)
+                    nresolved += 1
+        return nresolved
+
+    @classmethod
+    def renumber(cls, entries: List[EncounterMapping], renumber_map: Optional[Dict[int, int]] = None) \
+            -> Tuple[Dict[int, int], List[EncounterMapping]]:
+        """
+        Merge a set of encounter mapping entries that were generated with a private number generator and map (e.g.
+        by a worker process) into this context, assigning numbers in the order that the entries were generated
+        :param entries: encounter mapping entries in the order they were generated
+        :param renumber_map: map returned for an earlier set of entries from the same private generator, if any.  It
+            is extended with the numbers of entries.
+        :return: map from the private encounter numbers to the numbers in this context, entries that are new to it
+        """
+        renumber_map = dict() if renumber_map is None else renumber_map
+        new_entries = []                # type: List[EncounterMapping]
+        for entry in entries:
+            if entry.encounter_ide_source == cls.identity_source_id and entry.encounter_ide == str(entry.encounter_num):
+                entry.encounter_num = renumber_map[entry.encounter_num]
+                entry.encounter_ide = str(entry.encounter_num)
+                if (entry.encounter_ide, entry.encounter_ide_source, entry.project_id) not in cls.number_map:
+                    new_entries.append(entry)
+            else:
+                key = (entry.encounter_ide, entry.encounter_ide_source, entry.project_id, entry.patient_ide,
+                       entry.patient_ide_source)
+                if key in cls.number_map:
+                    renumber_map[entry.encounter_num] = cls.number_map[key]
+                else:
+                    encounter_num = cls.number_generator.new_number()
+                    renumber_map[entry.encounter_num] = encounter_num
+                    entry.encounter_num = encounter_num
+                    cls.number_map[key] = encounter_num
+                    new_entries.append(entry)
+        return renumber_map, new_entries
+
     def __init__(self, encounterURI: URIRef, patient_id: str, patient_ide_source: str) -> None:
         """
         Create a new encounter mapping entry
@@ -84,10 +131,8 @@ class FHIREncounterMapping:
         :param patient_ide_source: Associated patient identifier source
         """
         self.encounter_mapping_entries = []
-        parsed_resource = parse_fhir_resource_uri(encounterURI)
-        resource_namespace = str(parsed_resource.namespace)
-        resource_ide = split_uri(parsed_resource.resource_type)[1] + '/' + parsed_resource.resource
-        key = (resource_ide, resource_namespace, self.project_id, patient_id, patient_ide_source)
+        key = self.mapping_key(encounterURI, patient_id, patient_ide_source)
+        resource_ide, resource_namespace = key[:2]
         if key in self.number_map:
             self.encounter_num = self.number_map[key]
         else:
@@ -0,0 +1,94 @@
+import hashlib
+import os
+from typing import Optional, Tuple, List, Dict
+
+from fhirtordf.fhir.picklejar import picklejar
+from fhirtordf.fhir.signature import is_url, signature
+from rdflib import Graph, URIRef
+
+from i2fhirb2 import __version__
+from i2fhirb2.fhir.fhirmetadatavocabulary import FMVGraphNode
+from i2fhirb2.fhir.fhirontologytable import FHIROntologyTable
+
+HASH_BLOCK_SIZE = 1 << 20           # Block size used when computing file digests
+
+
+def content_signature(name: str) -> Optional[Tuple]:
+    """
+    Return a signature that changes whenever the content of name changes -- the SHA-1 digest of a file, or the
+    last modified / length / ETag signature of a URL
+    :param name: file name or URL
+    :return: signature or None if name can't be found
+    """
+    if is_url(name):
+        return signature(name)
+    digest = hashlib.sha1()
+    try:
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return 'sha1', digest.hexdigest()
+
+
+def _sources(metadatavoc: str, include_w5: bool) -> List[str]:
+    """
+    Return the absolute names of the FMV source files
+    :param metadatavoc: directory or URL containing fhir.ttl and w5.ttl
+    :param include_w5: True means include w5.ttl
+    :return: fhir.ttl and, if requested, w5.ttl
+    """
+    sources = [os.path.join(metadatavoc, 'fhir.ttl')] + ([os.path.join(metadatavoc, 'w5.ttl')] if include_w5 else [])
+    return [source if is_url(source) else os.path.abspath(source) for source in sources]
+
+
+def fhir_metavoc(metadatavoc: str, include_w5: bool = False, rebuild_cache: bool = False) -> Graph:
+    """
+    Return the FHIR Metadata Vocabulary (fhir.ttl) graph, optionally merged with w5.ttl.  The parsed graph is
+    pickled in the fhirtordf picklejar (~/.cache) keyed on the content of the source files, so it is only parsed
+    when one of them changes.
+    :param metadatavoc: directory or URL containing fhir.ttl and w5.ttl
+    :param include_w5: True means include w5.ttl
+    :param rebuild_cache: True means parse the source files even if there is a cached image
+    :return: FMV graph
+    """
+    sources = _sources(metadatavoc, include_w5)
+    cache_name = 'i2fhirb2:' + ' '.join(sources)
+    sig = tuple(content_signature(source) for source in sources)
+    cacheable = None not in sig
+
+    g = picklejar().get(cache_name, sig) if cacheable and not rebuild_cache else None
+    if g is not None:
+        print("Loading {} (cached)".format(', '.join(os.path.basename(source) for source in sources)))
+        return g
+    g = Graph()
+    for source in sources:
+        print("Loading {} (from disc)".format(os.path.basename(source)))
+        g.load(source, format="turtle")
+    if cacheable:
+        picklejar().add(cache_name, sig, g)
+    return g
+
+
+def fmv_type_graph(metadatavoc: str, g: Graph, rebuild_cache: bool = False) -> Dict[URIRef, FMVGraphNode]:
+    """
+    Return the compiled FMV type graph (``FHIROntologyTable.compile_type_graph``) for the resources in g.  The
+    compiled graph is cached alongside the vocabulary and is keyed on the content of fhir.ttl and w5.ttl and on the
+    i2FHIRb2 version.
+    :param metadatavoc: directory or URL containing the fhir.ttl and w5.ttl that g was loaded from
+    :param g: FMV + w5 graph (see ``fhir_metavoc``)
+    :param rebuild_cache: True means recompile even if there is a cached image
+    :return: map from resource URI to FMV graph node
+    """
+    sources = _sources(metadatavoc, True)
+    cache_name = 'i2fhirb2 type graph:' + ' '.join(sources)
+    sig = (__version__, ) + tuple(content_signature(source) for source in sources)
+    cacheable = None not in sig
+
+    type_graph = picklejar().get(cache_name, sig) if cacheable and not rebuild_cache else None
+    if type_graph is None:
+        type_graph = FHIROntologyTable(g).compile_type_graph()
+        if cacheable:
+            picklejar().add(cache_name, sig, type_graph)
+    return type_graph
@@ -1,4 +1,4 @@
-from typing import Union, ChainMap, Optional
+from typing import Union, ChainMap, Optional, Dict
 
 from fhirtordf.rdfsupport.namespaces import AnonNS, namespaces as fhirtordf_namespaces, FHIR, SCT
 from fhirtordf.rdfsupport.numericnamespace import NumericNamespace
@@ -18,6 +18,29 @@ namespaces = ChainMap(fhirtordf_namespaces,
                        })
 
 
+# Reverse (URI to prefix) index of namespaces.  Entries can be added to the underlying maps by other packages (e.g.
+# fhirtordf.rdfsupport.namespaces.namespace_for), so the index is rebuilt whenever their combined size changes.
+_namespace_prefixes = dict()            # type: Dict[str, str]
+_indexed_size = 0
+
+
+def _namespace_index() -> Dict[str, str]:
+    """
+    Return the URI to prefix index, rebuilding it if namespaces have been added since it was last built.  Where a
+    URI has more than one prefix, the first one found in ``namespaces`` wins.
+
+    :return: namespace URI to prefix map
+    """
+    global _indexed_size
+    size = sum(len(m) for m in namespaces.maps)
+    if size != _indexed_size:
+        _namespace_prefixes.clear()
+        for k, v in namespaces.items():
+            _namespace_prefixes.setdefault(v, k)
+        _indexed_size = size
+    return _namespace_prefixes
+
+
 def fhir_namespace_for(uri: Union[URIRef, Namespace, str]) -> Optional[str]:
     """
     Reverse namespace lookup.  Note that returned namespace may not be unique
@@ -28,13 +51,11 @@ def fhir_namespace_for(uri: Union[URIRef, Namespace, str]) -> Optional[str]:
     uri = str(uri)
     if not uri.endswith(('#', '/')):
         uri += '/'
-    if uri not in namespaces.values():
+    prefix = _namespace_index().get(uri)
+    if prefix is None:
         if uri.startswith(str(FHIR)):
-            ns = uri[len(str(FHIR)):-1]
-            namespaces[ns] = uri
+            prefix = uri[len(str(FHIR)):-1]
+            namespaces[prefix] = uri
         elif uri == str(SNOMED):
             return fhir_namespace_for(SCT)
-        else:
-            return None
-    return [k for k, v in namespaces.items() if uri == v][0]
-
+    return prefix
@@ -0,0 +1,83 @@
+from abc import ABCMeta, abstractmethod
+from typing import Optional, List
+
+from sqlalchemy import Column, func, or_, select
+
+from i2b2model.sqlsupport.dbconnection import I2B2Tables
+
+
+class NumberGenerator(metaclass=ABCMeta):
+    """
+    Base class for the i2b2 patient and encounter number generators.  Numbers are handed out from blocks of
+    ``block_size`` consecutive values.  When a block is reserved, the numbers in it that are already in use are
+    removed with a single range query, so there are no database calls between reservations.
+    """
+    block_size = 1000           # Number of consecutive values reserved at a time
+
+    def __init__(self, next_number: Optional[int] = None) -> None:
+        """
+        Create a number generator
+        :param next_number: First number to assign.  Can be updated with the refresh method
+        """
+        self._next_number = next_number         # First number past the reserved block
+        self._block = []                        # type: List[int]
+        self._block_pos = 0
+
+    @staticmethod
+    @abstractmethod
+    def _number_column(tables: I2B2Tables) -> Column:
+        """
+        Return the column that holds the numbers in use
+        :param tables: database tables link
+        """
+
+    def _reserve_block(self, tables: Optional[I2B2Tables], check_db: bool) -> None:
+        """
+        Reserve the next block of numbers, omitting those that are already in the database if check_db is true
+        :param tables: database tables link.  If None, no check is made
+        :param check_db: True means remove numbers that are already in use
+        """
+        while True:
+            first, self._next_number = self._next_number, self._next_number + self.block_size
+            if tables and check_db:
+                col = self._number_column(tables)
+                used = {r[0] for r in tables.crc_connection.execute(
+                    select([col]).where(col.between(first, self._next_number - 1)))}
+                self._block = [n for n in range(first, self._next_number) if n not in used]
+            else:
+                self._block = list(range(first, self._next_number))
+            self._block_pos = 0
+            if self._block:
+                break
+
+    def new_number(self, tables: Optional[I2B2Tables] = None, check_db: bool = True) -> int:
+        """ Get a new number.  If check_db is false, caller takes responsibility that the number generator is
+        returning unused numbers -- which typically occurs in a single user situation where ``refresh()`` has been
+        called
+
+        :param tables: database tables link.  If None, we are generating TSV files.
+        :param check_db: True means skip numbers that are already in the database
+        :return: Available number
+        """
+        if self._block_pos >= len(self._block):
+            self._reserve_block(tables, check_db)
+        rval = self._block[self._block_pos]
+        self._block_pos += 1
+        return rval
+
+    def refresh(self, tables: I2B2Tables, ignore_upload_id: Optional[int]) -> int:
+        """ Update the next number to the last used number plus one, discarding any reserved numbers
+
+        :param tables: database tables link
+        :param ignore_upload_id: If present, ignore numbers with this upload id, as they will be deleted
+        :return: next available number
+        """
+        col = self._number_column(tables)
+        q = func.max(col)
+        if ignore_upload_id is not None:
+            q = q.filter(or_(col.table.c.upload_id.is_(None), col.table.c.upload_id != ignore_upload_id))
+        max_number = tables.crc_connection.execute(select([q])).scalar()
+        self._next_number = max_number + 1 if max_number is not None else 1
+        self._block = []
+        self._block_pos = 0
+        return self._next_number
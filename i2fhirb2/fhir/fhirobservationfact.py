@@ -1,10 +1,11 @@
-from typing import List, Optional, Union, Tuple
+from typing import List, Optional, Union, Tuple, Set
 
 from fhirtordf.rdfsupport.namespaces import FHIR
 from rdflib import URIRef, Graph, BNode, RDF
 from rdflib.term import Node
 
 from i2fhirb2.fhir.fhircodemapping import process_concept_code
+from i2fhirb2.fhir.fhirconceptcache import LRUCache, NS_NAME_CACHE_SIZE, clear_caches
 from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
 from i2fhirb2.fhir.fhirnamespaces import fhir_namespace_for
 from i2fhirb2.fhir.fhirpatientdimension import FHIRPatientDimension
@@ -22,6 +23,7 @@ from i2b2model.data.i2b2observationfact import ObservationFact, ObservationFactK
 class FHIRObservationFact(ObservationFact):
 
     _unknown_namespaces: List[str] = []         # URI's that have been reported as being unknown
+    _ns_names = LRUCache("NS:code", NS_NAME_CACHE_SIZE)   # concept URI to NS:code (known namespaces only)
 
     def __init__(self, g: Graph, ofk: ObservationFactKey, concept: Union[URIRef, str],
                  modifier: Optional[Union[URIRef, str]], obj: Optional[Node],
@@ -56,6 +58,15 @@ class FHIRObservationFact(ObservationFact):
         :return: NS:code representation if NS is known, else None
         """
         concept_uri = str(concept_uri)
+        ns_name = cls._ns_names.get(concept_uri)
+        if ns_name is None:
+            ns_name = cls._ns_name_for(concept_uri)
+            if ns_name is not None:
+                cls._ns_names.put(concept_uri, ns_name)
+        return ns_name
+
+    @classmethod
+    def _ns_name_for(cls, concept_uri: str) -> Optional[str]:
         if '#' in concept_uri:
             nsuri, cd = concept_uri.rsplit('#', 1)
             nsuri += '#'
@@ -76,6 +87,7 @@ class FHIRObservationFact(ObservationFact):
     @classmethod
     def _clear(cls, complete=True):
         cls._unknown_namespaces = []
+        clear_caches()
 
 
 class FHIRObservationFactFactory:
@@ -141,14 +153,14 @@ class FHIRObservationFactFactory:
         example, visionprescription-example-1.ttl.html has two products that are dispensed, both of which are contacts.
 
         :param facts: List of facts to be pruned
-        :return: List with duplicates removed
+        :return: List with duplicates removed.  The first occurrence of each fact is retained, in the original order
         """
-        fact_keys: List[Tuple[int, str, str]] = []
+        fact_keys: Set[Tuple[int, str, str]] = set()
         rval: List[FHIRObservationFact] = []
         for fact in facts:
             k = (fact.instance_num, fact.concept_cd, fact.modifier_cd)
             if k not in fact_keys:
-                fact_keys.append(k)
+                fact_keys.add(k)
                 rval.append(fact)
         return rval
 
@@ -1,5 +1,7 @@
 
-from typing import Optional, List, cast, Dict, NamedTuple, Set
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Optional, List, cast, Dict, NamedTuple, Set, Tuple
 
 from fhirtordf.rdfsupport.namespaces import FHIR, W5
 from rdflib import URIRef, Graph, RDFS
@@ -11,7 +13,9 @@ from i2fhirb2.fhir.fhirontology import ModifierOntologyEntry, ConceptOntologyEnt
 from i2fhirb2.fhir.fhirspecific import concept_path, concept_path_sans_root, concept_code, rightmost_element, \
     skip_fhir_predicates, skip_fhir_types, composite_uri, DEFAULT_BASE_PATH, w5_infrastructure_categories, concept_name
 from i2fhirb2.fhir.fhirw5ontology import FHIRW5Ontology
+from i2b2model.metadata.commondimension import CommonDimension
 from i2b2model.metadata.i2b2ontology import OntologyEntry
+from i2b2model.shared.i2b2core import I2B2Core
 
 
 class DimensionSet(NamedTuple):
@@ -21,16 +25,32 @@ class DimensionSet(NamedTuple):
     modifier_dimension: List[FHIRModifierDimension]
 
 
+class ResourceDimensions(NamedTuple):
+    """ The defining elements for a single resource, with the dimension entries keyed by path """
+    ontology_dimension: List[OntologyEntry]
+    concept_dimension: Dict[str, FHIRConceptDimension]
+    modifier_dimension: Dict[str, FHIRModifierDimension]
+
+
 class FHIROntologyTable:
     """  The set of i2b2 ontology table entries for the supplied subject or all root concepts
     """
-    def __init__(self, g: Graph, name_base: str=DEFAULT_BASE_PATH, modifier_base: str = None) -> None:
+    def __init__(self, g: Graph, name_base: str=DEFAULT_BASE_PATH, modifier_base: str = None,
+                 type_graph: Optional[Dict[URIRef, FMVGraphNode]] = None) -> None:
+        """
+        :param g: FHIR Metadata Vocabulary + w5
+        :param name_base: concept path base
+        :param modifier_base: modifier path base.  Default is name_base with a 'Mod' suffix
+        :param type_graph: precompiled map from resource URI to its FMV graph node (see ``compile_type_graph``).
+        Resources that aren't in the map are compiled from g as needed
+        """
 
         self._name_base = name_base if name_base.endswith('\\') else name_base + '\\'
         self._modifier_base = modifier_base if modifier_base else self._name_base[:-1] + 'Mod'
         if not self._modifier_base.endswith('\\'):
             self._modifier_base += '\\'
         self.graph = g
+        self.type_graph = type_graph if type_graph is not None else {}
         self.w5_ontology = FHIRW5Ontology(g)
         OntologyEntry.graph = g
 
@@ -98,18 +118,65 @@ class FHIROntologyTable:
 
         return ontology_modifiers
 
-    def dimension_list(self, resource: Optional[URIRef]=None) -> DimensionSet:
+    def resource_dimensions(self, resource: URIRef, w5_path: str) -> ResourceDimensions:
+        """
+        Return the ontology, concept and modifier dimension entries for resource.  This is the unit of work for
+        ``dimension_list`` -- it doesn't depend on any other resource, so resources can be expanded in parallel.
+        :param resource: FHIR resource URI
+        :param w5_path: navigational path of the W5 node the resource appears under
+        :return: dimension entries.  Concept and modifier entries are keyed by path
+        """
+        ontology_entries: List[OntologyEntry] = []
+        concept_dimension_entries: Dict[str, FHIRConceptDimension] = {}
+        modifier_dimension_entries: Dict[str, FHIRModifierDimension] = {}
+        for conc_uri, conc_node_ent in self.fhir_concepts(resource).items():
+            conc_node = conc_node_ent.graph_node
+            if '.' in concept_code(conc_uri):
+                navigational_path = w5_path + concept_path_sans_root(conc_uri)
+                ontological_path = self._name_base + concept_path(conc_uri)
+                ontology_entries.append(
+                    ConceptOntologyEntry(conc_uri,
+                                         navigational_path,
+                                         ontological_path,
+                                         is_leaf=conc_node.is_primitive,
+                                         is_draggable=True,
+                                         primitive_type=conc_node.node if conc_node.is_primitive else None))
+
+                concept_dimension_entries[ontological_path] = \
+                    FHIRConceptDimension(conc_uri, concept_name(self.graph, conc_uri), self._name_base)
+                ontology_entries += self._modifier_ontology_list(navigational_path,
+                                                                 conc_uri,
+                                                                 concept_path(conc_uri),
+                                                                 conc_node,
+                                                                 modifier_dimension_entries,
+                                                                 conc_node_ent.is_multiple)
+        return ResourceDimensions(ontology_entries, concept_dimension_entries, modifier_dimension_entries)
+
+    def dimension_list(self, resource: Optional[URIRef]=None, workers: int = 1) -> DimensionSet:
         """
         Return the set of ontology entries for all w5 concepts and resources (or resource if it is supplied)
         :param resource: Optional resource URI -- for debugging purposes only.  None means all resources
+        :param workers: Number of processes used to expand the resources.  The result is the same regardless
         :return: List of i2b2 ontology entries
         """
         ontology_entries: List[OntologyEntry] = [cast(OntologyEntry, OntologyRoot(self._name_base))]    # FHIR root node
         concept_dimension_entries: Dict[str, FHIRConceptDimension] = {}
         modifier_dimension_entries: Dict[str, FHIRModifierDimension] = {}
 
-        # Create an entry for all of the W5 paths
-        for w5_node in self.w5_ontology.w5_paths():
+        w5_nodes = self.w5_ontology.w5_paths()
+        work_units = [(w5_node.fhir_resource_uri, w5_node.path) for w5_node in w5_nodes
+                      if w5_node.fhir_resource_uri and (resource is None or w5_node.fhir_resource_uri == resource)]
+        if workers > 1 and len(work_units) > 1:
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(self, I2B2Core.update_date, I2B2Core.sourcesystem_cd)) as executor:
+                resource_dims = iter(list(executor.map(_resource_dimensions, work_units)))
+        else:
+            resource_dims = (self.resource_dimensions(*work_unit) for work_unit in work_units)
+
+        # Create an entry for all of the W5 paths, followed by the entries for the corresponding resource.  Merging in
+        # W5 order gives the same result as expanding the resources one after another: the last concept dimension
+        # and the first modifier dimension for a given path are retained.
+        for w5_node in w5_nodes:
             ontological_path = self._name_base + concept_path(w5_node.node)
             ontology_entries.append(
                 ConceptOntologyEntry(w5_node.node,                  # subject URI
@@ -119,27 +186,11 @@ class FHIROntologyTable:
                                      is_draggable=True))
 
             if w5_node.fhir_resource_uri and (resource is None or w5_node.fhir_resource_uri == resource):
-                for conc_uri, conc_node_ent in self.fhir_concepts(w5_node.fhir_resource_uri).items():
-                    conc_node = conc_node_ent.graph_node
-                    if '.' in concept_code(conc_uri):
-                        navigational_path = w5_node.path + concept_path_sans_root(conc_uri)
-                        ontological_path = self._name_base + concept_path(conc_uri)
-                        ontology_entries.append(
-                            ConceptOntologyEntry(conc_uri,
-                                                 navigational_path,
-                                                 ontological_path,
-                                                 is_leaf=conc_node.is_primitive,
-                                                 is_draggable=True,
-                                                 primitive_type=conc_node.node if conc_node.is_primitive else None))
-
-                        concept_dimension_entries[ontological_path] = \
-                            FHIRConceptDimension(conc_uri, concept_name(self.graph, conc_uri), self._name_base)
-                        ontology_entries += self._modifier_ontology_list(navigational_path,
-                                                                         conc_uri,
-                                                                         concept_path(conc_uri),
-                                                                         conc_node,
-                                                                         modifier_dimension_entries,
-                                                                         conc_node_ent.is_multiple)
+                dims = next(resource_dims)
+                ontology_entries += dims.ontology_dimension
+                concept_dimension_entries.update(dims.concept_dimension)
+                for path, modifier_entry in dims.modifier_dimension.items():
+                    modifier_dimension_entries.setdefault(path, modifier_entry)
 
         return DimensionSet(ontology_entries,
                             list(concept_dimension_entries.values()),
@@ -170,9 +221,18 @@ class FHIROntologyTable:
         resources = [resource] if resource else self.fhir_resource_concepts()
         rval = {}           # type: Dict[URIRef, FMVGraphNodeWithMultiplicity]
         for r in resources:
-            self._fhir_concept_expansion(r, FMVGraphNode(self.graph, r), rval)
+            node = self.type_graph.get(r)
+            self._fhir_concept_expansion(r, node if node is not None else FMVGraphNode(self.graph, r), rval)
         return rval
 
+    def compile_type_graph(self) -> Dict[URIRef, FMVGraphNode]:
+        """
+        Build the FMV graph node for every FHIR resource.  The nodes share their descendants, so the result can be
+        pickled as a unit and passed back to the constructor as ``type_graph``.
+        :return: map from resource URI to the corresponding graph node
+        """
+        return {r: FMVGraphNode(self.graph, r) for r in sorted(self.fhir_resource_concepts())}
+
     def fhir_resource_concepts(self) -> Set[URIRef]:
         """
         Return the uris for the set of all qualifying FHIR resources
@@ -189,3 +249,30 @@ class FHIROntologyTable:
         """
         return subj in w5_infrastructure_categories or \
             bool(set(self.graph.transitive_objects(subj, RDFS.subClassOf)).intersection(w5_infrastructure_categories))
+
+
+# Per process state for dimension_list workers
+_worker_table = None                # type: Optional[FHIROntologyTable]
+
+
+def _init_worker(table: FHIROntologyTable, update_date: datetime, sourcesystem_cd: str) -> None:
+    """
+    Initialize a dimension_list worker process
+    :param table: ontology table being generated
+    :param update_date: update_date to use in generated entries
+    :param sourcesystem_cd: sourcesystem_cd to use in generated entries
+    """
+    global _worker_table
+    _worker_table = table
+    CommonDimension.graph = OntologyEntry.graph = table.graph
+    I2B2Core.update_date = update_date
+    I2B2Core.sourcesystem_cd = sourcesystem_cd
+
+
+def _resource_dimensions(work_unit: Tuple[URIRef, str]) -> ResourceDimensions:
+    """
+    Expand a resource in a worker process
+    :param work_unit: resource URI and W5 navigational path
+    :return: dimension entries for the resource
+    """
+    return _worker_table.resource_dimensions(*work_unit)
@@ -1,67 +1,21 @@
-from operator import or_
-from typing import Dict, Optional, NamedTuple
+from typing import Dict, Optional, NamedTuple, List, Tuple, Iterable, Set
 
-from sqlalchemy import func, select
-from sqlalchemy.orm import sessionmaker
+from i2b2model.shared.listchunker import ListChunker
+from sqlalchemy import select, Column, and_, or_
 
 from i2fhirb2.common_cli_parameters import DEFAULT_PROJECT_ID, DEFAULT_PATIENT_NUMBER_START, IDE_SOURCE_HIVE
+from i2fhirb2.fhir.fhirnumbergenerator import NumberGenerator
 from i2b2model.data.i2b2patientmapping import PatientMapping, PatientIDEStatus
 from i2b2model.sqlsupport.dbconnection import I2B2Tables
 
 
-class PatientNumberGenerator:
+class PatientNumberGenerator(NumberGenerator):
     """
     i2b2 patient number generator.
     """
-    def __init__(self, next_number: Optional[int]=None) -> None:
-        """ Create a number generator with a starting patient number
-
-        :param next_number: Patient number to start with.  Can be updated with the refresh method
-        """
-        self._next_number = next_number
-
-    def new_number(self, tables: Optional[I2B2Tables]=None, check_db: bool=True) -> int:
-        """ Get a new patient number.  If check_db is false, caller takes responsibility
-        that the number generator is returning unused numbers -- which typically occurs
-        in a single user situation where ``refresh()`` has been called
-
-        :param tables: database tables link.  If None, we are generating TSV files.
-        :param check_db: True means validate the number before return.
-        :return: Available patient number
-        """
-        if tables and check_db:
-            session = sessionmaker(bind=tables.crc_engine)()
-            rval = None
-            while rval is None:
-                qr = session.query(tables.patient_dimension)\
-                    .filter(tables.patient_dimension.c.patient_num == self._next_number)
-                if not qr.all():
-                    rval = self._next_number
-                    break
-                else:
-                    self._next_number += 1
-        else:
-            rval = self._next_number
-
-        self._next_number += 1
-        return rval
-
-    def refresh(self, tables: I2B2Tables, ignore_upload_id: Optional[int]) -> int:
-        """ Update the next number to the last used number plus one
-
-        :param tables: database tables link
-        :param ignore_upload_id: If present, ignore this id as it will be deleted
-        :return: next available number
-        """
-        session = sessionmaker(bind=tables.crc_engine)()
-        q = func.max(tables.patient_dimension.c.patient_num)
-        if ignore_upload_id is not None:
-            q = q.filter(or_(tables.patient_dimension.c.upload_id.is_(None),
-                         tables.patient_dimension.c.upload_id != ignore_upload_id))
-        qr = session.query(q).all()
-        self._next_number = qr[0][0] + 1 if qr else 1
-        session.close()
-        return self._next_number
+    @staticmethod
+    def _number_column(tables: I2B2Tables) -> Column:
+        return tables.patient_dimension.c.patient_num
 
 
 class PatientMappingKey(NamedTuple):
@@ -78,6 +32,8 @@ class FHIRPatientMapping:
     identity_source_id = IDE_SOURCE_HIVE    # source_id for identity mapping
     number_generator = PatientNumberGenerator(DEFAULT_PATIENT_NUMBER_START)
     number_map: Dict[PatientMappingKey, patient_number] = dict()
+    new_keys: Set[PatientMappingKey] = set()    # Keys that ``preload`` found no mapping for
+    preload_chunk_size = 1000               # Number of identifiers per IN (...) clause in ``preload``
 
     @classmethod
     def _clear(cls) -> None:
@@ -88,6 +44,7 @@ class FHIRPatientMapping:
         cls.identity_source_id = IDE_SOURCE_HIVE
         cls.number_generator = PatientNumberGenerator(DEFAULT_PATIENT_NUMBER_START)
         cls.number_map.clear()
+        cls.new_keys.clear()
 
     @classmethod
     def refresh_patient_number_generator(cls, tables: I2B2Tables, ignore_upload_id: Optional[int]) -> int:
@@ -101,6 +58,77 @@ class FHIRPatientMapping:
         """
         return cls.number_generator.refresh(tables, ignore_upload_id)
 
+    @classmethod
+    def preload(cls, tables: I2B2Tables, keys: Iterable[PatientMappingKey],
+                ignore_upload_id: Optional[int] = None) -> int:
+        """ Seed the number map with the patient numbers that are already assigned to keys in the patient_mapping
+        table, so existing patients keep their numbers and their mapping entries aren't generated again.  The keys
+        are resolved with ``patient_ide IN (...)`` queries of ``preload_chunk_size`` identifiers rather than with one
+        query per patient.  Keys that aren't found are recorded in ``new_keys`` and aren't looked up again.
+
+        :param tables: i2b2 data tables link
+        :param keys: patient mapping keys referenced by the input
+        :param ignore_upload_id: If present, ignore mappings with this upload id, as they will be deleted
+        :return: number of keys resolved
+        """
+        wanted = {key for key in keys if key not in cls.number_map and key not in cls.new_keys}
+        pmc = tables.patient_mapping.c
+        nresolved = 0
+        for chunk in ListChunker(sorted({key.patient_id for key in wanted}), cls.preload_chunk_size,
+                                 print_progress=False):
+            q = select([pmc.patient_ide, pmc.patient_ide_source, pmc.project_id, pmc.patient_num])\
+                .where(pmc.patient_ide.in_(chunk))
+            if ignore_upload_id is not None:
+                q = q.where(or_(pmc.upload_id.is_(None), pmc.upload_id != ignore_upload_id))
+            for row in tables.crc_connection.execute(q):
+                key = PatientMappingKey(row.patient_ide, row.patient_ide_source, row.project_id)
+                if key in wanted and key not in cls.number_map:
+                    cls.number_map[key] = row.patient_num
+                    # The identity mapping was written along with the source mapping
+                    ikey = PatientMappingKey(str(row.patient_num), cls.identity_source_id, row.project_id)
+                    cls.number_map.setdefault(ikey, row.patient_num)
+                    nresolved += 1
+        cls.new_keys.update(key for key in wanted if key not in cls.number_map)
+        return nresolved
+
+    @classmethod
+    def renumber(cls, tables: Optional[I2B2Tables], entries: List[PatientMapping],
+                 renumber_map: Optional[Dict[patient_number, patient_number]] = None) \
+            -> Tuple[Dict[patient_number, patient_number], List[PatientMapping]]:
+        """ Merge a set of patient mapping entries that were generated with a private number generator and map
+        (e.g. by a worker process) into this context.  Entries are visited in order, so the numbers assigned are the
+        same as they would have been had the entries been generated here.
+
+        :param tables: i2b2 data tables link.  None means that we are generating tsv files
+        :param entries: patient mapping entries in the order they were generated
+        :param renumber_map: map returned for an earlier set of entries from the same private generator, if any.  It
+            is extended with the numbers of entries.
+        :return: map from the private patient numbers to the numbers in this context, entries that are new to it
+        """
+        renumber_map = dict() if renumber_map is None else renumber_map
+        new_entries = []                # type: List[PatientMapping]
+        for entry in entries:
+            if entry.patient_ide_source == cls.identity_source_id and entry.patient_ide == str(entry.patient_num):
+                entry.patient_num = renumber_map[entry.patient_num]
+                entry.patient_ide = str(entry.patient_num)
+                ikey = PatientMappingKey(entry.patient_ide, entry.patient_ide_source, entry.project_id)
+                if ikey not in cls.number_map:
+                    cls.number_map[ikey] = entry
+                    new_entries.append(entry)
+            else:
+                key = PatientMappingKey(entry.patient_ide, entry.patient_ide_source, entry.project_id)
+                if key in cls.number_map:
+                    renumber_map[entry.patient_num] = cls.number_map[key]
+                else:
+                    patient_num = cls._existing_entry(tables, key) if key not in cls.new_keys else None
+                    if patient_num is None:
+                        patient_num = cls.number_generator.new_number(tables)
+                    renumber_map[entry.patient_num] = patient_num
+                    entry.patient_num = patient_num
+                    cls.number_map[key] = patient_num
+                    new_entries.append(entry)
+        return renumber_map, new_entries
+
     def __init__(self, tables: Optional[I2B2Tables], patient_id: str, patient_ide_source: str) -> None:
         """ Create a new patient mapping entry in the FHIR context
 
@@ -117,7 +145,7 @@ class FHIRPatientMapping:
 
         # Look it up in the tables
         else:
-            self.patient_num = self._existing_entry(tables, key)
+            self.patient_num = self._existing_entry(tables, key) if key not in self.new_keys else None
             if self.patient_num is None:
                 self.patient_num = self.number_generator.new_number(tables)
             pm = PatientMapping(self.patient_num,
@@ -146,8 +174,8 @@ class FHIRPatientMapping:
             return None                                 # Generating tsv files, nothihc exists
         pdtabc = tables.patient_mapping.c
         s = select([pdtabc.patient_num])\
-            .where(pdtabc.patient_ide == key.patient_id and
-                   pdtabc.patient_ide_source == key.patient_ide_src
-                   and pdtabc.project_id == key.project_id)
+            .where(and_(pdtabc.patient_ide == key.patient_id,
+                        pdtabc.patient_ide_source == key.patient_ide_src,
+                        pdtabc.project_id == key.project_id))
         qr = list(tables.crc_connection.execute(s))
         return qr[0][0] if qr else None
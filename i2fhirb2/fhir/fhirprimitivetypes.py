@@ -1,3 +1,4 @@
+import re
 from datetime import datetime
 from typing import Optional, Dict, Callable
 
@@ -7,8 +8,15 @@ from i2b2model.data.i2b2observationfact import ValueTypeCd, valuetype_text, valu
     valuetype_number
 
 
+# Extended xsd:date / xsd:dateTime lexical forms whose first 16 characters ("YYYY-MM-DD hh:mm") are the i2b2
+# date text.  Anything else (basic format, gYear, years before 1000, ...) takes the general path.
+_date_lexical_re = re.compile(r'[1-9]\d{3}-\d\d-\d\d(?:$|T\d\d:\d\d)', re.ASCII)
+
+
 class I2B2Value:
     """ Representation of th Value portion of an I2B2 Observation Fact"""
+    __slots__ = ('tval_char', 'valtype', 'nval_num', 'observation_blob')
+
     def __init__(self, tval_char: str, valtype: ValueTypeCd= valuetype_text, nval_num: Optional[float]=None,
                  observation_blob: Optional[str]=None) -> None:
         self.tval_char = tval_char
@@ -27,7 +35,7 @@ class I2B2Value:
 
 
 def filter_literal(val: Literal) -> str:
-    return format(str(val).replace('\n', '\\n').replace(r'\t', '\\t'))
+    return str(val).replace('\n', '\\n')
 
 
 def blob_val(val: Literal) -> I2B2Value:
@@ -42,6 +50,11 @@ def date_val(val: Literal) -> I2B2Value:
     dt = val.value
     nval_num = (dt.year * 10000) + (dt.month * 100) + dt.day + \
                (((dt.hour / 100.0) + (dt.minute / 10000.0)) if isinstance(dt, datetime) else 0)
+    # rdflib has already validated and parsed the lexical form, so the text can be sliced out of it rather than
+    # being regenerated with strftime
+    if _date_lexical_re.match(val) and (len(val) > 10) == isinstance(dt, datetime):
+        tval_char = val[:10] + ' ' + val[11:16] if len(val) > 10 else val[:10] + ' 00:00'
+        return I2B2Value(tval_char, valuetype_date, nval_num)
     return I2B2Value(dt.strftime('%Y-%m-%d %H:%M'), valuetype_date, nval_num)
 
 
@@ -74,5 +87,4 @@ literal_conversions: Dict[URIRef, Callable[[Literal], I2B2Value]] = {
 
 
 def i2b2_primitive(val: Literal) -> I2B2Value:
-    return literal_conversions[val.datatype](val) if val.datatype and val.datatype in literal_conversions \
-        else text_val(val)
+    return literal_conversions.get(val.datatype, text_val)(val)
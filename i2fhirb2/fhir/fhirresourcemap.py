@@ -73,7 +73,7 @@ FHIR_RESOURCE_MAP = {           # type: Dict[URIRef, Optional[FHIR_Resource_type
     FHIR.Basic: None,
     FHIR.Binary: None,
     FHIR.BodyStructure: None,
-    FHIR.Bundle: FHIR_Bundle_type,
+    FHIR.Bundle: FHIR_Bundle_type(),
     FHIR.CapabilityStatement: None,
     FHIR.CarePlan: FHIR_Observation_Fact_type(FHIR.CarePlan.subject, FHIR.CarePlan.context, None),
     FHIR.CareTeam: None,
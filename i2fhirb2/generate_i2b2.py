@@ -3,23 +3,27 @@ import sys
 from argparse import Namespace
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Callable
 from urllib import request
 from urllib.error import HTTPError
 
-from fhirtordf.fhir.fhirmetavoc import FHIRMetaVoc
 from i2b2model.shared.i2b2core import I2B2Core
 
 from i2fhirb2.common_cli_parameters import add_common_parameters
+from i2fhirb2.sharedtables import add_pool_args, shared_tables
 from i2b2model.metadata.commondimension import CommonDimension
 from rdflib import Graph
 from sqlalchemy import delete, Table, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.elements import ClauseElement
 from dynprops import heading, as_dict
 
 from i2fhirb2.fhir.fhirconceptdimension import FHIRConceptDimension
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc, fmv_type_graph
 from i2fhirb2.fhir.fhirmodifierdimension import FHIRModifierDimension
 from i2fhirb2.fhir.fhirontologytable import FHIROntologyTable
 from i2fhirb2.fhir.fhirspecific import FHIR, DEFAULT_BASE
+from i2fhirb2.loaders.i2b2deltaloader import update_table_delta
 from i2b2model.metadata.i2b2ontology import OntologyEntry
 from i2b2model.metadata.i2b2tableaccess import TableAccess
 from i2b2model.shared.tablenames import i2b2tablenames
@@ -66,13 +70,45 @@ def generate_i2b2_files(g: Graph, opts: Namespace) -> bool:
                                         i2b2tablenames.ontology_table):
         resource = FHIR[opts.resource] if opts.resource else None
         initialize_table_defaults(g, opts)
-        dimset = FHIROntologyTable(g, name_base=opts.base).dimension_list(resource)
+        type_graph = fmv_type_graph(opts.metadatavoc, g, opts.rebuild_cache)
+        dimset = FHIROntologyTable(g, name_base=opts.base, type_graph=type_graph).dimension_list(resource,
+                                                                                                 opts.workers)
 
-        return \
-            output_table_access(opts) and \
-            output_concept_dimension(opts, dimset.concept_dimension) and \
-            output_modifier_dimension(opts, dimset.modifier_dimension) and \
-            output_ontology(opts, dimset.ontology_dimension)
+        def output_tables() -> bool:
+            return \
+                output_table_access(opts) and \
+                output_concept_dimension(opts, dimset.concept_dimension) and \
+                output_modifier_dimension(opts, dimset.modifier_dimension) and \
+                output_ontology(opts, dimset.ontology_dimension)
+
+        return load_in_transaction(opts, output_tables) if opts.diff and not opts.outdir else output_tables()
+
+
+def load_in_transaction(opts: Namespace, load: Callable[[], bool]) -> bool:
+    """
+    Run load inside one transaction on each of the crc and ontology connections.  The transactions are committed if
+    load succeeds and rolled back if it fails or raises an exception, so a --diff load changes either every table or
+    none of them.
+    :param opts: input options
+    :param load: function that updates the tables
+    :return: success indicator
+    """
+    connections = [opts.tables.crc_connection]
+    if opts.tables.ont_connection is not opts.tables.crc_connection:
+        connections.append(opts.tables.ont_connection)
+    transactions = [conn.begin() for conn in connections]
+    try:
+        success = load()
+    except BaseException:
+        for transaction in transactions:
+            transaction.rollback()
+        raise
+    for transaction in transactions:
+        if success:
+            transaction.commit()
+        else:
+            transaction.rollback()
+    return success
 
 
 def output_table_access(opts: Namespace) -> bool:
@@ -92,6 +128,9 @@ def output_table_access(opts: Namespace) -> bool:
 
 
 def update_table_access_table(opts: Namespace, table: Table, records: List[Dict[str, Any]]) -> bool:
+    if opts.diff:
+        return update_table_delta_report(opts.tables.ont_connection, table, table.c.c_table_cd == DEFAULT_BASE,
+                                         ['c_table_cd'], records)
     ndel = opts.tables.ont_connection.execute(delete(table).where(table.c.c_table_cd == DEFAULT_BASE)).rowcount
     if ndel > 0:
         print("{} {} {} deleted".format(ndel, table, pluralize(ndel, "record")))
@@ -110,11 +149,13 @@ def output_concept_dimension(opts: Namespace, output: List[FHIRConceptDimension]
     table_name = i2b2tablenames.concept_dimension
     if not opts.table or opts.table == table_name:
         if opts.outdir:
-            return write_tsv(opts.outdir, table_name, heading(FHIRConceptDimension), output)
+            return write_tsv(opts.outdir, table_name, heading(FHIRConceptDimension), output, sort=True)
         else:
             table = opts.tables.concept_dimension
-            change_column_length(table, table.c.concept_cd, 200, opts.tables.crc_engine)
-            return update_dimension_table(output, opts, table)
+            # The column change is made on the connection rather than a (pooled) engine connection, so that it is
+            # part of the transaction that a --diff load runs in
+            change_column_length(table, table.c.concept_cd, 200, opts.tables.crc_connection)
+            return update_dimension_table(output, opts, table, ['concept_path'])
     else:
         return True
 
@@ -129,11 +170,11 @@ def output_modifier_dimension(opts: Namespace, output: List[FHIRModifierDimensio
     table_name = i2b2tablenames.modifier_dimension
     if not opts.table or opts.table == table_name:
         if opts.outdir:
-            return write_tsv(opts.outdir, table_name, heading(FHIRModifierDimension), output)
+            return write_tsv(opts.outdir, table_name, heading(FHIRModifierDimension), output, sort=True)
         else:
             table = opts.tables.modifier_dimension
-            change_column_length(table, table.c.modifier_cd, 200, opts.tables.crc_engine)
-            return update_dimension_table(output, opts, table)
+            change_column_length(table, table.c.modifier_cd, 200, opts.tables.crc_connection)
+            return update_dimension_table(output, opts, table, ['modifier_path'])
     else:
         return True
 
@@ -148,27 +189,33 @@ def output_ontology(opts: Namespace, output: List[OntologyEntry]) -> bool:
     table_name = i2b2tablenames.ontology_table
     if not opts.table or opts.table == table_name:
         if opts.outdir:
-            return write_tsv(opts.outdir, table_name, heading(OntologyEntry), output)
+            return write_tsv(opts.outdir, table_name, heading(OntologyEntry), output, sort=True)
         else:
             table = opts.tables.ontology_table
-            change_column_length(table, table.c.c_basecode, 200, opts.tables.ont_engine)
+            change_column_length(table, table.c.c_basecode, 200, opts.tables.ont_connection)
             # MedicationStatement is 1547 long
-            change_column_length(table, table.c.c_tooltip, 1600, opts.tables.ont_engine)
-            return update_dimension_table(output, opts, table)
+            change_column_length(table, table.c.c_tooltip, 1600, opts.tables.ont_connection)
+            return update_dimension_table(output, opts, table, ['c_fullname', 'm_applied_path'])
     else:
         return True
 
 
-def update_dimension_table(output: DIMENSION_LIST, opts: Namespace, table: Table) \
+def update_dimension_table(output: DIMENSION_LIST, opts: Namespace, table: Table, key_fields: List[str]) \
         -> bool:
     """
-    Update the supplied dimension table, removing all existing records
+    Update the supplied dimension table, removing all existing records or, if opts.diff is set, applying only the
+    rows that have changed
 
     :param output: list of dimension entries
     :param opts: input options
     :param table: table to be updated
+    :param key_fields: columns that identify a row (diff mode)
     :return: Success indicator
     """
+    if opts.diff:
+        return update_table_delta_report(opts.tables.crc_connection, table,
+                                         table.c.sourcesystem_cd == opts.sourcesystem, key_fields,
+                                         [as_dict(e) for e in output])
     q = delete(table).where(table.c.sourcesystem_cd == opts.sourcesystem)
     ndel = opts.tables.crc_connection.execute(q).rowcount
     if ndel > 0:
@@ -178,19 +225,33 @@ def update_dimension_table(output: DIMENSION_LIST, opts: Namespace, table: Table
     return True
 
 
+def update_table_delta_report(conn: Connection, table: Table, scope: ClauseElement, key_fields: List[str],
+                              records: List[Dict[str, Any]]) -> bool:
+    """
+    Apply the row level delta between records and the rows of table within scope and report the counts
+    :param conn: connection to the database containing table
+    :param table: table to be updated
+    :param scope: filter selecting the rows being replaced
+    :param key_fields: columns that identify a row
+    :param records: new table contents
+    :return: Success indicator
+    """
+    delta = update_table_delta(conn, table, scope, key_fields, records)
+    for nrecs, action in ((len(delta.inserts), "inserted"), (len(delta.updates), "updated"),
+                          (len(delta.deletes), "deleted"), (delta.unchanged, "unchanged")):
+        print("{} {} {} {}".format(nrecs, table, pluralize(nrecs, "record"), action))
+    return True
+
+
 def load_fhir_ontology(opts: Namespace) -> Graph:
     """
     Load the fhir specification ontology and w5
     :param opts: User options
     :return: Graph containing the ontology
     """
-    print("Loading fhir.ttl")
-    fmv = FHIRMetaVoc(os.path.join(opts.metadatavoc, 'fhir.ttl'))
-    print(" (cached)" if fmv.from_cache else "(from disc)")
-    print("loading w5.ttl")
-    fmv.g.load(os.path.join(opts.metadatavoc, 'w5.ttl'), format="turtle")
+    g = fhir_metavoc(opts.metadatavoc, include_w5=True, rebuild_cache=opts.rebuild_cache)
     print(" done\n")
-    return fmv.g
+    return g
 
 
 def test_configuration(opts: Namespace) -> bool:
@@ -231,7 +292,7 @@ def test_configuration(opts: Namespace) -> bool:
     print("Validating sql connection")
     tables = None
     try:
-        tables = I2B2Tables(opts)
+        tables = shared_tables(opts)
     except Exception as e:
         print(str(e))
 
@@ -289,8 +350,14 @@ def create_parser() -> FileAwareParser:
                         help="Load i2b2 SQL tables", action="store_true")
     parser.add_argument("--list", help="List table names", action="store_true")
     parser.add_argument("--test", help="Test the confguration", action="store_true")
+    parser.add_argument("--rebuild-cache", help="Parse the FHIR metadata vocabulary even if a cached image exists",
+                        action="store_true")
+    parser.add_argument("--workers", metavar="N", help="Number of worker processes used to generate the resource "
+                        "ontologies", type=int, default=1)
+    parser.add_argument("--diff", help="Only apply the rows that differ from the current table contents when loading "
+                        "(-l) rather than replacing the complete set", action="store_true")
     # Add the database connection arguments list
-    add_connection_args(add_common_parameters(parser))
+    add_pool_args(add_connection_args(add_common_parameters(parser)))
 
     return parser
 
@@ -311,6 +378,10 @@ def genargs(argv: List[str]) -> Namespace:
     opts = parser.parse_args(parser.decode_file_args(argv))
     if not (opts.version or opts.list or opts.test or opts.load or opts.outdir):
         parser.print_help()
+    if opts.workers < 1:
+        parser.error("Number of workers must be at least 1")
+    if opts.poolsize < 1:
+        parser.error("Pool size must be at least 1")
     opts.setdefault = lambda *a: setdefault(opts, *a)
     opts.updatedate = datetime.now()
     if not opts.metadatavoc.endswith(os.sep):
@@ -318,8 +389,12 @@ def genargs(argv: List[str]) -> Namespace:
     if opts.outdir and not opts.outdir.endswith(os.sep):
         opts.outdir = os.path.join(opts.outdir, '')
     i2b2tablenames.ontology_table = opts.onttable
-    # Set the defaults for the crc and ontology tables
-    return process_parsed_args(opts, parser.error) if opts.load or opts.list or opts.test else opts
+    # Set the defaults for the crc and ontology tables.  The configuration test (--test) makes its own connection so
+    # that it can report a failure
+    if opts.load or opts.list or opts.test:
+        process_parsed_args(opts, parser.error, connect=False)
+        opts.tables = shared_tables(opts) if not opts.test else None
+    return opts
 
 
 def generate_i2b2(argv: List[str]) -> bool:
@@ -342,7 +417,7 @@ def generate_i2b2(argv: List[str]) -> bool:
         g = None
 
     # list table names
-    opts.tables = I2B2Tables(opts) if (opts.load or opts.list) and not opts.test else None
+    opts.tables = shared_tables(opts) if (opts.load or opts.list) and not opts.test else None
     if opts.list:
         print('\n'.join(["{} : {}".format(tn, tp) for tn, tp in opts.tables._tables()]))
 
@@ -0,0 +1,305 @@
+import logging
+import re
+import urllib.parse
+from typing import Dict, List, Optional, Tuple, Callable, Any, Union
+from uuid import uuid4
+
+from fhirtordf.fhir.fhirmetavoc import FHIRMetaVocEntry
+from fhirtordf.loaders.fhirresourceloader import codesystem_maps
+from fhirtordf.rdfsupport.fhirresourcere import FHIR_RESOURCE_RE, FHIR_RE_BASE, FHIR_RE_RESOURCE
+from fhirtordf.rdfsupport.namespaces import FHIR
+from rdflib import Graph, URIRef, RDF, OWL, XSD, BNode, Literal
+from rdflib.term import Node
+
+# Predicates and types that are used for every resource.  (Attribute access on the FHIR namespace builds a new URIRef
+# each time it is called)
+FHIR_BUNDLE_ENTRY = FHIR.Bundle.entry
+FHIR_BUNDLE_ENTRY_FULLURL = FHIR.Bundle.entry.fullUrl
+FHIR_BUNDLE_ENTRY_RESOURCE = FHIR.Bundle.entry.resource
+FHIR_BUNDLE_ENTRY_COMPONENT = FHIR.BundleEntryComponent
+FHIR_CODING = FHIR.CodeableConcept.coding
+FHIR_ELEMENT = FHIR.Element
+FHIR_EXTENSION = FHIR.Element.extension
+FHIR_INDEX = FHIR.index
+FHIR_LINK = FHIR.link
+FHIR_NODEROLE = FHIR.nodeRole
+FHIR_REFERENCE = FHIR.Reference.reference
+FHIR_RELATED_ARTIFACT = FHIR.RelatedArtifact.resource
+FHIR_RESOURCE = FHIR.Resource
+FHIR_TREEROOT = FHIR.treeRoot
+FHIR_VALUE = FHIR.value
+FHIR_TTL = FHIR['fhir.ttl']
+
+logger = logging.getLogger(__name__)
+
+
+class FHIRJSONMapper:
+    """
+    Convert parsed FHIR JSON resources into the same RDF that ``fhirtordf.loaders.fhirresourceloader.FHIRResource``
+    generates.  The JSON is walked as plain dictionaries and everything that is learned from the FHIR metadata
+    vocabulary (predicates, ranges, atoms, primitive datatypes) is computed once per type rather than once per element.
+    """
+    def __init__(self, vocabulary: Graph) -> None:
+        """
+        Create a mapper
+        :param vocabulary: FHIR Metadata Vocabulary (fhir.ttl) graph
+        """
+        self._vocabulary = vocabulary
+        self._meta = FHIRMetaVocEntry(vocabulary, FHIR_RESOURCE)
+        self._types = {}                # type: Dict[str, URIRef]
+        self._predicates = {}           # type: Dict[URIRef, List[Tuple[str, URIRef]]]
+        self._predicate_types = {}      # type: Dict[URIRef, Optional[URIRef]]
+        self._atoms = {}                # type: Dict[URIRef, bool]
+        self._primitives = {}           # type: Dict[URIRef, bool]
+        self._datatypes = {}            # type: Dict[URIRef, Optional[URIRef]]
+        self._value_types = {}          # type: Dict[str, Optional[URIRef]]
+        self._type_arc_generators = {}  # type: Dict[str, Optional[Callable]]
+        self._indices = []              # type: List[Literal]
+        self._g = None                  # type: Optional[Graph]
+        self._base_uri = None           # type: Optional[str]
+
+    # ---- Memoized metadata ----
+    def fhir_type(self, name: str) -> URIRef:
+        rval = self._types.get(name)
+        if rval is None:
+            rval = self._types[name] = FHIR[name]
+        return rval
+
+    def predicates(self, t: URIRef) -> List[Tuple[str, URIRef]]:
+        """ (JSON key, predicate) for every property of type t, in FHIRMetaVocEntry.predicates order """
+        rval = self._predicates.get(t)
+        if rval is None:
+            rval = self._predicates[t] = list(FHIRMetaVocEntry(self._vocabulary, t).predicates().items())
+        return rval
+
+    def predicate_type(self, pred: URIRef) -> Optional[URIRef]:
+        if pred not in self._predicate_types:
+            self._predicate_types[pred] = self._meta.predicate_type(pred)
+        return self._predicate_types[pred]
+
+    def is_atom(self, pred: URIRef) -> bool:
+        rval = self._atoms.get(pred)
+        if rval is None:
+            rval = self._atoms[pred] = self._meta.is_atom(pred)
+        return rval
+
+    def is_primitive(self, t: URIRef) -> bool:
+        rval = self._primitives.get(t)
+        if rval is None:
+            rval = self._primitives[t] = self._meta.is_primitive(t)
+        return rval
+
+    def primitive_datatype(self, t: URIRef, v: Optional[str] = None) -> Optional[URIRef]:
+        """ Memoized equivalent of FHIRMetaVocEntry.primitive_datatype_nostring """
+        if t not in self._datatypes:
+            self._datatypes[t] = self._meta.primitive_datatype(t)
+        vt = self._datatypes[t]
+        if FHIRMetaVocEntry.fhir_dates and vt == XSD.dateTime and v:
+            return XSD.gYear if len(v) == 4 else XSD.gYearMonth if len(v) == 7 \
+                else XSD.date if (len(v) == 10 or (len(v) > 10 and v[10] in '+-')) else XSD.dateTime
+        if FHIRMetaVocEntry.fhir_oids and vt == XSD.anyURI:
+            vt = None
+        return None if vt == XSD.string else vt
+
+    def value_predicate_to_type(self, value_pred: str) -> Optional[URIRef]:
+        if value_pred not in self._value_types:
+            self._value_types[value_pred] = self._meta.value_predicate_to_type(value_pred)
+        return self._value_types[value_pred]
+
+    def index(self, idx: int) -> Literal:
+        while len(self._indices) <= idx:
+            self._indices.append(Literal(len(self._indices)))
+        return self._indices[idx]
+
+    # ---- Conversion ----
+    def add_resource(self, resource: Dict[str, Any], base_uri: str, target: Graph,
+                     add_ontology_header: bool = False) -> URIRef:
+        """
+        Add the RDF representation of a FHIR resource to target
+        :param resource: parsed JSON resource
+        :param base_uri: base of resource URI -- combined with the resource type and id to form the subject
+        :param target: graph to add the resource to
+        :param add_ontology_header: True means add the OWL ontology header
+        :return: resource subject
+        """
+        if 'resourceType' not in resource:
+            raise ValueError("{} is not a FHIR resource".format(resource))
+        self._g = target
+        self._base_uri = base_uri + ('/' if base_uri[-1] not in '/#' else '')
+        if 'id' not in resource:
+            resource['id'] = str(uuid4())
+        resource_uri = URIRef(self._base_uri + resource['resourceType'] + '/' + resource['id'])
+        if add_ontology_header:
+            self._add_ontology_definition(resource_uri, resource)
+        target.add((resource_uri, FHIR_NODEROLE, FHIR_TREEROOT))
+        self._add_resource(resource_uri, resource)
+        return resource_uri
+
+    def _add_ontology_definition(self, resource_uri: URIRef, resource: Dict[str, Any]) -> None:
+        ont_uri = URIRef(str(resource_uri) + ".ttl")
+        self._g.add((ont_uri, RDF.type, OWL.Ontology))
+        self._g.add((ont_uri, OWL.imports, FHIR_TTL))
+        if 'meta' in resource and 'versionId' in resource['meta']:
+            ont_uri_str = str(ont_uri)
+            if re.search(r'\.\w+$', ont_uri_str):
+                ont_uri_str, suffix = ont_uri_str.rsplit('.', 1)
+                suffix = '.' + suffix
+            else:
+                suffix = ''
+            self._g.add((ont_uri, OWL.versionIRI,
+                         URIRef(ont_uri_str + '/_history/' + resource['meta']['versionId'] + suffix)))
+
+    def _add_resource(self, subj: URIRef, resource: Dict[str, Any]) -> None:
+        resource_type = self.fhir_type(resource['resourceType'])
+        self._g.add((subj, RDF.type, resource_type))
+        for k, p in self.predicates(resource_type):
+            if k in resource:
+                self._add_val(subj, p, resource, k)
+
+    def _add_value_node(self, subj: Node, pred: URIRef, val: Any, valuetype: Optional[URIRef] = None) -> None:
+        pred_type = valuetype if valuetype else self.predicate_type(pred)
+        if pred_type == FHIR_RESOURCE:
+            pred_type = self.fhir_type(val['resourceType'])
+        is_dict = isinstance(val, dict)
+        for k, p in self.predicates(pred_type):
+            if is_dict and k in val:
+                self._add_val(subj, p, val, k)
+                if pred == FHIR_CODING:
+                    self._add_type_arc(subj, val)
+            elif k == "value" and self.predicate_type(p) == FHIR_ELEMENT:
+                for vk in list(val.keys()):
+                    if vk.startswith(k):
+                        self._add_val(subj, self.fhir_type('Extension.' + vk), val, vk,
+                                      self.value_predicate_to_type(vk))
+            else:
+                self._add_extension_val(subj, val, k, p)
+
+    def _add_reference(self, subj: Node, val: str) -> None:
+        match = FHIR_RESOURCE_RE.match(val)
+        ref_uri_str = res_type = None
+        if match:
+            ref_uri_str = val if match.group(FHIR_RE_BASE) else (self._base_uri + urllib.parse.quote(val))
+            res_type = match.group(FHIR_RE_RESOURCE)
+        elif '://' in val:
+            ref_uri_str = val
+            res_type = "Resource"
+        elif self._base_uri and not val.startswith('#') and not val.startswith('/'):
+            ref_uri_str = self._base_uri + urllib.parse.quote(val)
+            res_type = val.split('/', 1)[0] if '/' in val else "Resource"
+        if ref_uri_str:
+            ref_uri = URIRef(ref_uri_str)
+            self._g.add((subj, FHIR_LINK, ref_uri))
+            self._g.add((ref_uri, RDF.type, self.fhir_type(res_type)))
+
+    def _add_type_arc(self, subj: Node, val: Dict[str, Any]) -> None:
+        if "system" in val and "code" in val:
+            system = val['system']
+            if system not in self._type_arc_generators:
+                self._type_arc_generators[system] = None
+                for k, generator in codesystem_maps.items():
+                    if (isinstance(k, str) and k == system) or (not isinstance(k, str) and k.match(system)):
+                        self._type_arc_generators[system] = generator
+                        break
+            generator = self._type_arc_generators[system]
+            if generator:
+                # The namespace map is used to bind prefixes in fhirtordf output -- it doesn't change the triples
+                type_uri = generator(system, urllib.parse.quote(val['code']), {})
+                if type_uri:
+                    self._g.add((subj, RDF.type, type_uri))
+
+    def _add_bundle_entry(self, subj: Node, entry: Dict[str, Any], entry_bnode: BNode, list_idx: int) -> None:
+        entry_subj = URIRef(entry['fullUrl'])
+        self._g.add((entry_bnode, FHIR_INDEX, self.index(list_idx)))
+        self._add_val(entry_bnode, FHIR_BUNDLE_ENTRY_FULLURL, entry, 'fullUrl')
+        self._g.add((entry_bnode, FHIR_BUNDLE_ENTRY_RESOURCE, entry_subj))
+        self._g.add((subj, FHIR_BUNDLE_ENTRY, entry_bnode))
+        for k, p in self.predicates(FHIR_BUNDLE_ENTRY_COMPONENT):
+            if k not in ['resource', 'fullUrl'] and k in entry:
+                self._add_val(subj, p, entry, k)
+        self._add_resource(entry_subj, entry['resource'])
+
+    def _add_val(self, subj: Node, pred: URIRef, json_obj: Dict[str, Any], json_key: str,
+                 valuetype: Optional[URIRef] = None) -> Optional[BNode]:
+        if not isinstance(json_obj, dict) or json_key not in json_obj:
+            logger.warning("%s: no '%s' element -- entry skipped", self._base_uri, json_key)
+            return None
+        g = self._g
+        val = json_obj[json_key]
+        if isinstance(val, list):
+            for list_idx, lv in enumerate(val):
+                entry_bnode = BNode()
+                if pred == FHIR_BUNDLE_ENTRY:
+                    self._add_bundle_entry(subj, lv, entry_bnode, list_idx)
+                    continue
+                g.add((entry_bnode, FHIR_INDEX, self.index(list_idx)))
+                if isinstance(lv, dict):
+                    self._add_value_node(entry_bnode, pred, lv, valuetype)
+                else:
+                    vt = self.predicate_type(pred)
+                    atom_type = self.primitive_datatype(vt) if vt else None
+                    g.add((entry_bnode, FHIR_VALUE, Literal(lv, datatype=atom_type)))
+                    self._add_list_extension_val(entry_bnode, json_obj, json_key, list_idx)
+                g.add((subj, pred, entry_bnode))
+        else:
+            vt = valuetype if valuetype else self.predicate_type(pred)
+            if self.is_atom(pred):
+                g.add((subj, pred, Literal(val)))
+            else:
+                v = BNode()
+                if self.is_primitive(vt):
+                    g.add((v, FHIR_VALUE, Literal(str(val), datatype=self.primitive_datatype(vt, val))))
+                else:
+                    self._add_value_node(v, pred, val, valuetype)
+                g.add((subj, pred, v))
+                if pred == FHIR_REFERENCE:
+                    self._add_reference(subj, val)
+                elif pred == FHIR_RELATED_ARTIFACT:
+                    self._add_reference(v, val)
+                self._add_extension_val(v, json_obj, json_key)
+                return v
+        return None
+
+    def _add_extension_val(self, subj: Node, json_obj: Union[Dict[str, Any], List], key: str,
+                           pred: Optional[URIRef] = None) -> None:
+        """
+        Add the extensions in "_key", if any, to subj.  "_key" is either a single extension object, which extends the
+        value of key, or (if key is absent) a list of extension objects, each of which becomes an indexed pred entry.
+        Null entries in the list are placeholders and are skipped.
+        :param subj: node that carries the value of key
+        :param json_obj: object (potentially) containing "_key"
+        :param key: name of the element that is possibly extended
+        :param pred: predicate for the list entries when key is absent
+        """
+        extendee_name = "_" + key
+        if not isinstance(json_obj, dict) or extendee_name not in json_obj:
+            return
+        extendee = json_obj[extendee_name]
+        if isinstance(extendee, list):
+            if not pred:
+                # A list of extensions for a single value -- the JSON doesn't say which value they extend
+                logger.warning("%s: '%s' is a list but '%s' isn't -- extensions skipped", self._base_uri,
+                               extendee_name, key)
+                return
+            for entry_idx, extension in enumerate(extendee):
+                if extension is not None:
+                    entry = BNode()
+                    self._g.add((entry, FHIR_INDEX, self.index(entry_idx)))
+                    self._add_val(entry, FHIR_EXTENSION, extension, 'extension')
+                    self._g.add((subj, pred, entry))
+        elif isinstance(extendee, dict) and 'extension' in extendee:
+            self._add_val(subj, FHIR_EXTENSION, extendee, 'extension')
+        # Anything else ("fhir_comments", an element id) has no RDF representation
+
+    def _add_list_extension_val(self, subj: BNode, json_obj: Dict[str, Any], key: str, list_idx: int) -> None:
+        """
+        Add the extensions for entry list_idx of the primitive list key -- "_key" is a parallel list with nulls for
+        the entries that aren't extended
+        :param subj: list entry node
+        :param json_obj: object containing key and (potentially) "_key"
+        :param key: name of the list element
+        :param list_idx: position of the entry in the list
+        """
+        extendee = json_obj.get("_" + key)
+        if isinstance(extendee, list) and list_idx < len(extendee) and isinstance(extendee[list_idx], dict) \
+                and 'extension' in extendee[list_idx]:
+            self._add_val(subj, FHIR_EXTENSION, extendee[list_idx], 'extension')
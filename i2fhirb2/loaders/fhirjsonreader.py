@@ -0,0 +1,258 @@
+import io
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, Iterator, Optional, Set, TextIO, Tuple
+
+from i2fhirb2.loaders.urlfetcher import URLFetcher, JSON_ACCEPT, default_fetcher
+
+
+# Reference prefixes that are only meaningful within the Bundle that carries them
+LOCAL_REFERENCE_PREFIXES = ('urn:uuid:', 'urn:oid:')
+
+_whitespace_re = re.compile(r'[ \t\n\r]*')
+
+
+class JSONMemberReader:
+    """
+    Incremental reader for the members of a top level JSON object.  The elements of selected array members (e.g. the
+    Bundle ``entry`` list) are returned one at a time, so only one of them is ever held in memory.
+    """
+    chunk_size = 1 << 16            # Minimum number of characters read at a time
+
+    def __init__(self, stream: TextIO) -> None:
+        """
+        Create a reader
+        :param stream: text stream positioned at the start of a JSON object
+        """
+        self._stream = stream
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> None:
+        """ Read more input, at least doubling what is buffered past the current position """
+        chunk = self._stream.read(max(self.chunk_size, len(self._buf) - self._pos))
+        if chunk:
+            self._buf = self._buf[self._pos:] + chunk
+            self._pos = 0
+        else:
+            self._eof = True
+
+    def _peek(self) -> str:
+        """ Return the next non-whitespace character without consuming it ('' at end of input) """
+        while True:
+            self._pos = _whitespace_re.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or self._eof:
+                return self._buf[self._pos:self._pos + 1]
+            self._fill()
+
+    def _expect(self, c: str) -> None:
+        if self._peek() != c:
+            raise ValueError("Expecting '{}' at: {}".format(c, self._buf[self._pos:self._pos + 40]))
+        self._pos += 1
+
+    def _value(self) -> Any:
+        """ Decode the next JSON value.  A value that runs to the end of the buffer may be incomplete (e.g. a number) so
+        it is only accepted when there is something after it or there is no more input """
+        self._peek()
+        while True:
+            try:
+                val, end = self._decoder.raw_decode(self._buf, self._pos)
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def members(self, element_keys: Set[str]) -> Iterator[Tuple[str, Any, bool]]:
+        """
+        Generate the members of the object
+        :param element_keys: names of the array members whose elements are returned individually
+        :return: (name, value, False) for ordinary members and (name, element, True) for each element of an array
+        named in element_keys
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key in element_keys and self._peek() == '[':
+                self._pos += 1
+                if self._peek() != ']':
+                    while True:
+                        yield key, self._value(), True
+                        if self._peek() != ',':
+                            break
+                        self._pos += 1
+                self._expect(']')
+            else:
+                yield key, self._value(), False
+            if self._peek() != ',':
+                break
+            self._pos += 1
+        self._expect('}')
+
+
+def open_json(source: str, payload: Optional[bytes] = None, fetcher: Optional[URLFetcher] = None) -> TextIO:
+    """
+    Open a JSON file or URL.  URL payloads are read in full, as a Bundle is read twice
+    :param source: file name or URL
+    :param payload: content of source, if it has already been downloaded
+    :param fetcher: fetcher used to download URLs.  Default: default_fetcher
+    :return: text stream
+    """
+    if payload is None and '://' in source:
+        payload = (fetcher or default_fetcher).fetch(source, JSON_ACCEPT)
+    return io.StringIO(payload.decode('utf-8')) if payload is not None else open(source)
+
+
+def is_bundle_entry(resource_type: Optional[str], entry: Any) -> bool:
+    """ Determine whether an ``entry`` element is a Bundle (or collection) entry rather than, say, a List entry """
+    return resource_type in (None, 'Bundle') and isinstance(entry, dict) and 'resource' in entry
+
+
+def set_local_id(entry: Dict[str, Any]) -> None:
+    """
+    Give a Bundle entry resource without an id the id in its local (``urn:uuid:``) fullUrl.  The resource keeps the
+    same identity every time the Bundle is loaded, and references to it can be resolved.
+    :param entry: Bundle entry.  Updated in place
+    """
+    full_url = entry.get('fullUrl')
+    resource = entry['resource']
+    if isinstance(full_url, str) and full_url.startswith(LOCAL_REFERENCE_PREFIXES) and \
+            isinstance(resource, dict) and 'id' not in resource:
+        resource['id'] = full_url.split(':', 2)[2]
+
+
+def resolve_references(node: Any, local_references: Dict[str, str]) -> None:
+    """
+    Replace the Bundle local (``urn:uuid:``) references in node with the ``type/id`` of the resources they refer to
+    :param node: JSON resource or element.  Updated in place
+    :param local_references: map from Bundle entry fullUrl to ``type/id``
+    """
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == 'reference' and isinstance(v, str) and v in local_references:
+                node[k] = local_references[v]
+            elif isinstance(v, (dict, list)):
+                resolve_references(v, local_references)
+    elif isinstance(node, list):
+        for e in node:
+            if isinstance(e, (dict, list)):
+                resolve_references(e, local_references)
+
+
+def bundle_local_references(source: str, payload: Optional[bytes] = None,
+                            fetcher: Optional[URLFetcher] = None) -> Dict[str, str]:
+    """
+    Collect the local fullUrls of the entries in a Bundle
+    :param source: file name or URL of a Bundle or collection
+    :param payload: content of source, if it has already been downloaded
+    :param fetcher: fetcher used to download URLs
+    :return: map from fullUrl to ``type/id`` for every entry whose resource has an id
+    """
+    return scan_bundle(source, payload, fetcher)[0]
+
+
+def scan_bundle(source: str, payload: Optional[bytes] = None,
+                fetcher: Optional[URLFetcher] = None) -> Tuple[Dict[str, str], Optional[str]]:
+    """
+    Collect the local fullUrls of the entries in a Bundle along with its continuation link
+    :param source: file name or URL of a Bundle or collection
+    :param payload: content of source, if it has already been downloaded
+    :param fetcher: fetcher used to download URLs
+    :return: map from fullUrl to ``type/id`` for every entry whose resource has an id, "next" link URL if any
+    """
+    local_references = dict()
+    header = dict()
+    with open_json(source, payload, fetcher) as f:
+        for key, val, is_element in JSONMemberReader(f).members({'entry'}):
+            if not is_element:
+                header[key] = val
+            elif is_bundle_entry(header.get('resourceType'), val):
+                set_local_id(val)
+                full_url = val.get('fullUrl')
+                resource = val['resource']
+                if isinstance(full_url, str) and full_url.startswith(LOCAL_REFERENCE_PREFIXES) and \
+                        isinstance(resource, dict) and 'resourceType' in resource and 'id' in resource:
+                    local_references[full_url] = resource['resourceType'] + '/' + resource['id']
+    return local_references, continuation_link(header)
+
+
+def continuation_link(data: Dict[str, Any]) -> Optional[str]:
+    """
+    Return the URL of the next page of a query or bundle if there is one
+    :param data: JSON image of a query response or bundle
+    :return: "next" link URL, if any
+    """
+    if 'link' in data and isinstance(data['link'], list):
+        for link_e in data['link']:
+            if 'relation' in link_e and link_e['relation'] == 'next':
+                return link_e['url']
+    return None
+
+
+def fhir_json_resources(json_fname: str, payload: Optional[bytes] = None, fetcher: Optional[URLFetcher] = None,
+                        on_page: Optional[Callable[[str], None]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Generate the resources in a FHIR JSON resource, Bundle or collection, following any ``next`` continuation pages.
+    Bundle entries are read and returned one at a time, with their Bundle local (``urn:uuid:``) references replaced
+    by the ``type/id`` of the entry that they refer to.  Entry resources without an id take the id in their local
+    fullUrl.  Bundles are read twice -- once to collect the entry fullUrls and once to return the entries.  The next
+    page is downloaded in the background as soon as its link is known, while the entries of the current page are
+    being returned.
+    :param json_fname: Name or URI of the JSON file
+    :param payload: content of json_fname, if it has already been downloaded
+    :param fetcher: fetcher used to download URLs (including continuation pages)
+    :param on_page: called with the name or URL of each page before its first resource is returned (by which time
+    every resource from the previous pages has been consumed)
+    :return: resource for each entry (or the resource itself)
+    """
+    fetcher = fetcher or default_fetcher
+    page_fname = json_fname
+    with ThreadPoolExecutor(1) as prefetcher:
+        next_page = None                # type: Optional[Tuple[str, Future]]
+
+        def prefetch(url: Optional[str]) -> None:
+            nonlocal next_page
+            if url and next_page is None:
+                next_page = url, prefetcher.submit(fetcher.fetch, url, JSON_ACCEPT)
+
+        while page_fname:
+            if on_page:
+                on_page(page_fname)
+            if payload is None and '://' in page_fname:
+                payload = fetcher.fetch(page_fname, JSON_ACCEPT)
+            local_references = None
+            header = dict()
+            nentries = 0
+            with open_json(page_fname, payload, fetcher) as f:
+                for key, val, is_element in JSONMemberReader(f).members({'entry'}):
+                    if is_element and is_bundle_entry(header.get('resourceType'), val):
+                        if local_references is None:
+                            local_references, next_url = scan_bundle(page_fname, payload, fetcher)
+                            prefetch(next_url)
+                        set_local_id(val)
+                        if local_references:
+                            resolve_references(val['resource'], local_references)
+                        nentries += 1
+                        yield val['resource']
+                    elif is_element:
+                        header.setdefault(key, []).append(val)
+                    else:
+                        header[key] = val
+                        if key == 'link' and header.get('resourceType') == 'Bundle':
+                            prefetch(continuation_link(header))
+            if not nentries:
+                if 'resourceType' in header and header['resourceType'] != 'Bundle':
+                    yield header
+                else:
+                    break
+            page_fname = continuation_link(header)
+            payload = next_page[1].result() if next_page and next_page[0] == page_fname else None
+            next_page = None
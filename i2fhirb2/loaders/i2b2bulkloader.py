@@ -0,0 +1,237 @@
+from datetime import datetime
+from io import StringIO
+from time import perf_counter
+from typing import List, Tuple, Type, Dict, Any, Optional, Callable
+
+from dynprops import as_dict
+from i2b2model.shared.i2b2core import I2B2CoreWithUploadId
+from i2b2model.shared.listchunker import ListChunker
+from sqlalchemy import Table, MetaData, Column, Index, Integer, and_, or_, select, update, exists, func, literal, \
+    literal_column, tuple_
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import ClauseElement, ColumnElement
+
+# Number of rows sent to the server per COPY / executemany call
+BULK_CHUNK_SIZE = 50000
+
+# Maximum number of rows removed by a single DELETE statement
+DELETE_CHUNK_SIZE = 10000
+
+# Minimum number of seconds between DeleteProgress reports
+PROGRESS_INTERVAL = 5.0
+
+# Row identifier that chunked_delete walks tables without a primary key in order of, by dialect
+_ROW_IDS = {'sqlite': 'rowid'}
+
+
+def copy_value(v: Any) -> str:
+    """
+    Format v for the PostgreSQL COPY text format
+    :param v: value to format
+    :return: text representation with tabs, newlines and backslashes escaped
+    """
+    if v is None:
+        return '\\N'
+    if isinstance(v, str):
+        return v.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if isinstance(v, datetime):
+        return v.isoformat(' ')
+    return str(v)
+
+
+def _staging_table(table: Table, columns: List[str]) -> Table:
+    """
+    Return a temporary, unconstrained table with the same columns (and types) as ``table``
+    :param table: target table
+    :param columns: names of the columns to include
+    :return: staging table definition
+    """
+    return Table(table.name + '_staging', MetaData(), *[Column(c, table.c[c].type) for c in columns],
+                 prefixes=['TEMPORARY'])
+
+
+def _load_staging_table(conn: Connection, staging: Table, columns: List[str], rows: List[Dict[str, Any]]) -> None:
+    """
+    Load the rows into the staging table, using COPY FROM STDIN on PostgreSQL and executemany elsewhere
+    :param conn: sql connection
+    :param staging: staging table
+    :param columns: columns to load
+    :param rows: rows to load
+    """
+    if conn.dialect.name == 'postgresql':
+        cursor = conn.connection.cursor()
+        for chunk in ListChunker(rows, BULK_CHUNK_SIZE):
+            buffer = StringIO()
+            for r in chunk:
+                buffer.write('\t'.join(copy_value(r[c]) for c in columns) + '\n')
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {staging.name} ({', '.join(columns)}) FROM STDIN", buffer)
+        cursor.close()
+    else:
+        for chunk in ListChunker(rows, BULK_CHUNK_SIZE):
+            conn.execute(staging.insert(), chunk)
+
+
+def remove_duplicates(rows: List[Dict[str, Any]], key_fields: List[str], report: bool = True) \
+        -> List[Dict[str, Any]]:
+    """
+    Remove the rows whose key duplicates that of a later row, optionally reporting how many were removed and how many
+    of those carried values that differ from the row that was kept
+    :param rows: rows to check
+    :param key_fields: key column names
+    :param report: True means print the number of duplicates
+    :return: last row with each key, in the order that the keys first appear
+    """
+    unique_rows = dict()                # type: Dict[Tuple, Dict[str, Any]]
+    for r in rows:
+        unique_rows[tuple(r[k] for k in key_fields)] = r
+    if report and len(unique_rows) != len(rows):
+        print("{} duplicate records encountered".format(len(rows) - len(unique_rows)))
+        ndiffering = 0
+        for r in rows:
+            last = unique_rows[tuple(r[k] for k in key_fields)]
+            if last is not r and last != r:
+                ndiffering += 1
+        if ndiffering:
+            print("    {} of them have values that differ from the last record with the same key".format(ndiffering))
+    return list(unique_rows.values())
+
+
+def bulk_add_or_update_records(conn: Connection, table: Table, cls: Type[I2B2CoreWithUploadId],
+                               records: List[I2B2CoreWithUploadId]) -> Tuple[int, int]:
+    """
+    Set based equivalent of ``cls.add_or_update_records``.  The records are loaded into a temporary staging table
+    and then merged into ``table`` with a single UPDATE and a single INSERT ... SELECT:
+
+    * Existing rows (matched on ``cls.key_fields``) have their non-key columns replaced by any non-null staged value
+      that differs, along with the update_date.  The ``cls._no_update_fields`` are left alone.
+    * Staged rows that don't match an existing row are inserted (an anti-join against ``table``).
+
+    The staging table is indexed on the key fields (and analyzed on PostgreSQL) before the merge, so both statements
+    are joins rather than a scan of the staging table per target row.
+
+    :param conn: sql connection
+    :param table: target table
+    :param cls: record class -- supplies the key and no-update fields and whether duplicates are reported
+    :param records: records to apply
+    :return: number of records added / modified
+    """
+    if not records:
+        return 0, 0
+    # Staged keys have to be unique -- a repeated key would be inserted twice by the anti-join, and the UPDATE would
+    # take its values from an arbitrary one of the rows
+    rows = remove_duplicates([as_dict(record) for record in records], cls.key_fields, cls._check_dups)
+    columns = list(rows[0].keys())
+    value_columns = [c for c in columns if c not in cls.key_fields and c not in cls._no_update_fields]
+    staging = _staging_table(table, columns)
+
+    with conn.begin():
+        staging.create(conn)
+        _load_staging_table(conn, staging, columns, rows)
+        Index(staging.name + '_key', *[staging.c[k] for k in cls.key_fields]).create(conn)
+        if conn.dialect.name == 'postgresql':
+            conn.execute(f"ANALYZE {staging.name}")
+
+        key_match = and_(*[staging.c[k] == table.c[k] for k in cls.key_fields])
+        value_differs = or_(*[and_(staging.c[c].isnot(None), staging.c[c].is_distinct_from(table.c[c]))
+                              for c in value_columns])
+        if conn.dialect.name == 'postgresql':
+            new_values = {c: func.coalesce(staging.c[c], table.c[c]) for c in value_columns}
+            new_values['update_date'] = staging.c.update_date
+            upd = update(table).where(and_(key_match, value_differs)).values(new_values)
+        else:
+            # No multi-table UPDATE -- use correlated subqueries instead
+            def staged(c: str):
+                return select([staging.c[c]]).where(key_match).limit(1).as_scalar()
+            new_values = {c: func.coalesce(staged(c), table.c[c]) for c in value_columns}
+            new_values['update_date'] = staged('update_date')
+            upd = update(table).where(exists().where(and_(key_match, value_differs))).values(new_values)
+        num_updates = conn.execute(upd).rowcount if value_columns else 0
+
+        ins = table.insert().from_select(columns, select([staging.c[c] for c in columns])
+                                         .where(~exists().where(key_match)))
+        num_inserts = conn.execute(ins).rowcount
+        staging.drop(conn)
+    return num_inserts, num_updates
+
+
+class DeleteProgress:
+    """
+    ``chunked_delete`` progress callback that prints the number of rows deleted so far and the deletion rate, at most
+    once every PROGRESS_INTERVAL seconds
+    """
+    def __init__(self, label: str) -> None:
+        """
+        Create a reporter
+        :param label: what is being deleted (e.g. the table name)
+        """
+        self.label = label
+        self.start = self.last_report = perf_counter()
+
+    def __call__(self, ndeleted: int) -> None:
+        now = perf_counter()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            print("    {}: {} rows deleted ({:.0f} rows/sec)".format(self.label, ndeleted,
+                                                                      ndeleted / (now - self.start)))
+
+
+def _delete_key(conn: Connection, table: Table) -> List[ColumnElement]:
+    """
+    Return the columns that ``chunked_delete`` walks table in order of -- the primary key or, failing that, the
+    dialect's row identifier
+    :param conn: sql connection
+    :param table: table to delete from
+    :return: key columns.  Empty if the table has neither
+    """
+    if len(table.primary_key):
+        return list(table.primary_key.columns)
+    return [literal_column(_ROW_IDS[conn.dialect.name], Integer)] if conn.dialect.name in _ROW_IDS else []
+
+
+def chunked_delete(conn: Connection, table: Table, where: ClauseElement, chunk_size: int = DELETE_CHUNK_SIZE,
+                   commit: bool = False, progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Delete the rows of table that satisfy where, at most chunk_size rows per statement.  The table is walked in
+    primary key order (``rowid`` order for SQLite tables without one) -- each chunk selects the next chunk_size
+    matching keys past the end of the last one and deletes that key range, so the index is scanned once over the
+    whole delete rather than from the start for every chunk.  Tables without a key get a single DELETE.  With commit,
+    each chunk is committed as it is deleted, so an interrupted delete keeps the chunks it has finished and can be
+    completed by running it again.  Otherwise the caller decides the transaction boundary.
+    :param conn: sql connection
+    :param table: table to delete from
+    :param where: selection criteria
+    :param chunk_size: maximum number of rows per DELETE
+    :param commit: commit each chunk in its own transaction (unless conn is already in one)
+    :param progress: called with the number of rows deleted so far after each chunk
+    :return: number of rows deleted
+    """
+    key_cols = _delete_key(conn, table)
+    if not key_cols:
+        return conn.execute(table.delete().where(where)).rowcount
+
+    def key(values: Optional[Tuple] = None) -> ColumnElement:
+        elements = key_cols if values is None else [literal(v, c.type) for c, v in zip(key_cols, values)]
+        return tuple_(*elements) if len(elements) > 1 else elements[0]
+
+    ndeleted = 0
+    last_key = None
+    while True:
+        chunk = select(key_cols).select_from(table).where(where)
+        if last_key is not None:
+            chunk = chunk.where(key() > key(last_key))
+        keys = conn.execute(chunk.order_by(*key_cols).limit(chunk_size)).fetchall()
+        if not keys:
+            return ndeleted
+        last_key = tuple(keys[-1])
+        stmt = table.delete().where(and_(where, key() >= key(tuple(keys[0])), key() <= key(last_key)))
+        if commit:
+            with conn.begin():
+                nrows = conn.execute(stmt).rowcount
+        else:
+            nrows = conn.execute(stmt).rowcount
+        ndeleted += nrows
+        if progress:
+            progress(ndeleted)
+        if len(keys) < chunk_size:
+            return ndeleted
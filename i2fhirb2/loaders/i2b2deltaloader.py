@@ -0,0 +1,88 @@
+import re
+from typing import List, Dict, Any, Tuple, Iterable, Mapping, NamedTuple, Optional
+
+from sqlalchemy import Table, and_, select, bindparam
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.elements import ClauseElement
+
+# Columns that record when a row was written rather than what it says.  They aren't compared, but they are rewritten
+# along with the rest of any row that has changed
+DELTA_IGNORED_COLUMNS = {'update_date', 'download_date', 'import_date', 'c_entry_date', 'c_change_date'}
+
+# The metadata xml embeds its creation (update) date
+_creation_date_re = re.compile(r'<CreationDateTime>.*?</CreationDateTime>', re.DOTALL)
+
+
+class TableDelta(NamedTuple):
+    """ Row level changes needed to bring a table in line with a set of records """
+    inserts: List[Dict[str, Any]]
+    updates: List[Dict[str, Any]]
+    deletes: List[Tuple]
+    unchanged: int
+
+
+def _comparable(v: Any) -> Optional[str]:
+    """
+    Normalize a value for comparison -- database and record values may differ in type and CHAR columns are padded
+    :param v: value to normalize
+    :return: comparable representation
+    """
+    return None if v is None else _creation_date_re.sub('', str(v)).rstrip()
+
+
+def table_delta(existing: Iterable[Mapping[str, Any]], records: List[Dict[str, Any]],
+                key_fields: List[str]) -> TableDelta:
+    """
+    Compute the inserts, updates and deletes needed to turn the existing rows into records
+    :param existing: current table rows
+    :param records: target rows
+    :param key_fields: columns that identify a row
+    :return: table delta.  Deletes are key tuples, as they appear in the table
+    """
+    def comparable_key(row: Mapping[str, Any]) -> Tuple:
+        return tuple(_comparable(row[k]) for k in key_fields)
+
+    current = {comparable_key(row): row for row in existing}
+    inserts = []
+    updates = []
+    unchanged = 0
+    for record in records:
+        row = current.pop(comparable_key(record), None)
+        if row is None:
+            inserts.append(record)
+        elif any(_comparable(v) != _comparable(row[c]) for c, v in record.items()
+                 if c not in DELTA_IGNORED_COLUMNS):
+            updates.append(record)
+        else:
+            unchanged += 1
+    return TableDelta(inserts, updates, [tuple(row[k] for k in key_fields) for row in current.values()], unchanged)
+
+
+def update_table_delta(conn: Connection, table: Table, scope: ClauseElement, key_fields: List[str],
+                       records: List[Dict[str, Any]]) -> TableDelta:
+    """
+    Bring the rows of table that fall within scope in line with records, applying only the rows that differ.  The
+    changes are made in the caller's transaction, if one is open, so that several tables can be updated together.
+    :param conn: sql connection
+    :param table: table to update
+    :param scope: filter that selects the rows that records replaces (e.g. all rows for a sourcesystem_cd)
+    :param key_fields: columns that identify a row
+    :param records: target rows
+    :return: the delta that was applied
+    """
+    def key_match() -> ClauseElement:
+        return and_(*[table.c[k] == bindparam('key_' + k) for k in key_fields])
+
+    def key_params(key: Tuple) -> Dict[str, Any]:
+        return {'key_' + k: v for k, v in zip(key_fields, key)}
+
+    delta = table_delta(conn.execute(select([table]).where(scope)), records, key_fields)
+    if delta.deletes:
+        conn.execute(table.delete().where(and_(scope, key_match())), [key_params(key) for key in delta.deletes])
+    if delta.updates:
+        conn.execute(table.update().where(and_(scope, key_match())),
+                     [dict(record, **key_params(tuple(record[k] for k in key_fields)))
+                      for record in delta.updates])
+    if delta.inserts:
+        conn.execute(table.insert(), delta.inserts)
+    return delta
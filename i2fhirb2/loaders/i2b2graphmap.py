@@ -1,14 +1,16 @@
 from argparse import Namespace
 from datetime import datetime
-from typing import List, Tuple, Optional
+from time import perf_counter
+from typing import List, Tuple, Optional, Dict, Type, Set
 
 from fhirtordf.rdfsupport.fhirgraphutils import value
 from fhirtordf.rdfsupport.uriutils import parse_fhir_resource_uri
 from rdflib import Graph, RDF, URIRef
 
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
 from i2fhirb2.fhir.fhirobservationfact import FHIRObservationFactFactory
 from i2fhirb2.fhir.fhirpatientdimension import FHIRPatientDimension
-from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping, PatientMappingKey
 from i2fhirb2.fhir.fhirresourcemap import FHIR_RESOURCE_MAP, FHIR_Infrastructure_type, FHIR_Observation_Fact_type, \
     FHIR_Visit_Dimension_type, FHIR_Provider_Dimension_type, FHIR_Patient_Dimension_type, FHIR_Bundle_type, \
     FHIR_Resource_type
@@ -19,20 +21,47 @@ from i2b2model.data.i2b2observationfact import ObservationFactKey, ObservationFa
 from i2b2model.data.i2b2patientdimension import PatientDimension
 from i2b2model.data.i2b2patientmapping import PatientMapping
 from i2b2model.data.i2b2visitdimension import VisitDimension
-from i2b2model.shared.i2b2core import I2B2Core
+from i2b2model.shared.i2b2core import I2B2Core, I2B2CoreWithUploadId
 from i2b2model.sqlsupport.dbconnection import I2B2Tables
 from i2b2model.sqlsupport.i2b2tables import change_column_length
-from i2fhirb2.tsv_support.tsvwriter import write_tsv
+from i2fhirb2.loaders.i2b2bulkloader import bulk_add_or_update_records, chunked_delete, DeleteProgress, \
+    DELETE_CHUNK_SIZE
+from i2fhirb2.loaders.i2b2partitions import remove_upload, ensure_upload_partition
+from i2fhirb2.tsv_support.tsvwriter import write_tsv, RecordSpool
 from dynprops import heading
 
 
-# TODO: Handle continuation pages in queries and bundles
+# Handler (I2B2GraphMap method name) for each kind of FHIR_RESOURCE_MAP entry.  Subclasses use their base class handler
+_KIND_HANDLERS = {
+    FHIR_Infrastructure_type: '_map_infrastructure',
+    FHIR_Observation_Fact_type: '_map_observation_facts',
+    FHIR_Visit_Dimension_type: '_map_visit',
+    FHIR_Provider_Dimension_type: '_map_provider',
+    FHIR_Patient_Dimension_type: '_map_patient',
+    FHIR_Bundle_type: '_map_bundle'
+}
+
+
+def _handler_for(mapped_type: Optional[FHIR_Resource_type]) -> str:
+    for cls in type(mapped_type).__mro__:
+        if cls in _KIND_HANDLERS:
+            return _KIND_HANDLERS[cls]
+    return '_map_unmapped'
+
+
+# Resource type to handler dispatch table
+RESOURCE_DISPATCH = {resource_type: _handler_for(mapped_type)
+                     for resource_type, mapped_type in FHIR_RESOURCE_MAP.items()}     # type: Dict[URIRef, str]
+
 
 class I2B2GraphMap:
-    def __init__(self, g: Graph, opts: Namespace) -> None:
+    flush_threshold = 10000             # Pending record count that triggers a flush in streaming mode
+    preload_batch_size = 1000           # Number of queued resources whose mappings are preloaded together
+
+    def __init__(self, g: Optional[Graph], opts: Namespace) -> None:
         """
         Iterate over the resources in the graph mapping them to their i2b2 equivalent
-        :param g: graph
+        :param g: graph.  If None, graphs are supplied one at a time through ``add_graph`` (streaming mode)
         :param opts: input options
         """
         self._opts = opts
@@ -48,45 +77,221 @@ class I2B2GraphMap:
         self.visit_dimensions = []          # type: List[VisitDimension]
         self.encounter_mappings = []        # type: List[EncounterMapping]
         self.tables = opts.tables           # type: I2B2Tables
-        nresources = 0
-        for subj, subj_type in g.subject_objects(RDF.type):
-            if isinstance(subj, URIRef) and subj_type in FHIR_RESOURCE_MAP:
-                action = f"{nresources}: ({str(subj_type).split('/')[-1]}) - {subj}"
-                nresources += 1
-                mapped_type = FHIR_RESOURCE_MAP[subj_type]
-                if isinstance(mapped_type, FHIR_Infrastructure_type):
-                    self.num_infrastructure += 1
-                    rslt = "Skipped"
-                elif isinstance(mapped_type, FHIR_Observation_Fact_type):
-                    pm, vd, start_date = self.process_resource_instance(subj, mapped_type)
-                    if pm is not None:
-                        obsfactory = \
-                            FHIRObservationFactFactory(g, ObservationFactKey(pm.patient_num,
-                                                                             vd.visit_dimension_entry.encounter_num,
-                                                                             opts.providerid, start_date), subj)
-                        # TODO: Decide what do do with the other mappings in the observation factory
-                        self.observation_facts += obsfactory.observation_facts
-                    rslt = f"pnum: {pm.patient_num if pm is not None else 'NONE'} " \
-                           f"enum:{vd.visit_dimension_entry.encounter_num if vd is not None else 'NONE'}"
-                elif isinstance(mapped_type, FHIR_Visit_Dimension_type):
-                    self.num_visit += 1
-                    rslt = "Not Implemented"
-                elif isinstance(mapped_type, FHIR_Provider_Dimension_type):
-                    self.num_provider += 1
-                    rslt = "Not Implemented"
-                elif isinstance(mapped_type, FHIR_Patient_Dimension_type):
-                    pd = FHIRPatientDimension(self._g, self.tables, subj)
-                    self.patient_dimensions.append(pd.patient_dimension_entry)
-                    self.patient_mappings += pd.patient_mappings.patient_mapping_entries
-                    rslt = f"pnum: {pd.patient_dimension_entry.patient_num}"
-                elif isinstance(mapped_type, FHIR_Bundle_type):
-                    self.num_bundle += 1
-                    rslt = "Skipped"
-                else:
-                    self.num_unmapped += 1
-                    rslt = "Unmapped"
-                print(f"{action} ({rslt})")
-        print("---> Graph map phase complete")
+        self._nresources = 0                # Number of resources mapped so far
+        self._tables_prepared = False       # True means the tables have been cleared and resized (load_i2b2_tables)
+        self._replace_transaction = None    # Transaction that replaces the upload (opts.remove), if one is open
+        self._num_flushed = {}              # type: Dict[str, int]
+        self._load_counts = {}              # type: Dict[str, Tuple[int, int]]
+        self._tsv_spools = {}               # type: Dict[str, RecordSpool]
+        self._type_stats = {}               # type: Dict[str, Tuple[int, float]]   # (count, seconds) by type
+        self._queued_graphs = []            # type: List[Tuple[Graph, List[Tuple[URIRef, URIRef]]]]
+        self._num_queued = 0                # Number of resources in _queued_graphs
+        if g is not None:
+            self.add_graph(g)
+            self.map_queued_graphs()
+            print("---> Graph map phase complete")
+
+    def add_graph(self, g: Graph) -> None:
+        """
+        Map the resources in g, adding the results to the existing set of i2b2 records.  When loading tables, graphs
+        are queued until preload_batch_size resources are waiting (or the records are needed), so the existing patient
+        and encounter mappings for the whole batch can be preloaded together.
+        :param g: graph containing one or more FHIR resources
+        """
+        resources = self.graph_resources(g)
+        if self.tables:
+            self._queued_graphs.append((g, resources))
+            self._num_queued += len(resources)
+            if self._num_queued >= self.preload_batch_size:
+                self.map_queued_graphs()
+        else:
+            self._map_resources(g, resources)
+
+    def map_queued_graphs(self) -> None:
+        """ Preload the patient and encounter mappings for the queued graphs and map them """
+        if self._queued_graphs:
+            patient_keys = set()
+            encounter_keys = set()
+            for g, resources in self._queued_graphs:
+                self._mapping_keys(g, resources, patient_keys, encounter_keys)
+            self._preload(patient_keys, encounter_keys)
+            queued_graphs, self._queued_graphs, self._num_queued = self._queued_graphs, [], 0
+            for g, resources in queued_graphs:
+                self._map_resources(g, resources)
+
+    def _map_resources(self, g: Graph, resources: List[Tuple[URIRef, URIRef]]) -> None:
+        """
+        Map resources, adding the results to the existing set of i2b2 records
+        :param g: graph containing the resources
+        :param resources: resources in g that are to be mapped (see ``graph_resources``)
+        """
+        self._g = g
+        for subj, subj_type in resources:
+            type_name = str(subj_type).split('/')[-1]
+            action = f"{self._nresources}: ({type_name}) - {subj}"
+            self._nresources += 1
+            start = perf_counter()
+            rslt = getattr(self, RESOURCE_DISPATCH[subj_type])(g, subj, FHIR_RESOURCE_MAP[subj_type])
+            count, elapsed = self._type_stats.get(type_name, (0, 0.0))
+            self._type_stats[type_name] = (count + 1, elapsed + perf_counter() - start)
+            print(f"{action} ({rslt})")
+
+    @staticmethod
+    def graph_resources(g: Graph) -> List[Tuple[URIRef, URIRef]]:
+        """
+        Return the resources in g that are to be mapped -- the tree roots (``fhir:nodeRole fhir:treeRoot``) and the
+        resources in any Bundle entries.  A referenced resource that is only present as the target of a ``fhir:link``
+        isn't mapped.  Older RDF images don't mark their tree roots, in which case every typed subject is returned.
+        :param g: graph containing one or more FHIR resources
+        :return: (subject, resource type) for every resource whose type is in FHIR_RESOURCE_MAP
+        """
+        roots = list(g.subjects(FHIR.nodeRole, FHIR.treeRoot))
+        if not roots:
+            return [(subj, subj_type) for subj, subj_type in g.subject_objects(RDF.type)
+                    if isinstance(subj, URIRef) and subj_type in RESOURCE_DISPATCH]
+        roots += g.objects(None, FHIR.Bundle.entry.resource)
+        rval = []
+        for subj in dict.fromkeys(roots):
+            if isinstance(subj, URIRef):
+                rval += [(subj, subj_type) for subj_type in g.objects(subj, RDF.type) if subj_type in RESOURCE_DISPATCH]
+        return rval
+
+    # ---- Resource handlers (see RESOURCE_DISPATCH).  Each returns the text that is logged for the resource ----
+    def _map_infrastructure(self, g: Graph, subj: URIRef, mapped_type: FHIR_Resource_type) -> str:
+        self.num_infrastructure += 1
+        return "Skipped"
+
+    def _map_observation_facts(self, g: Graph, subj: URIRef, mapped_type: FHIR_Observation_Fact_type) -> str:
+        pm, vd, start_date = self.process_resource_instance(subj, mapped_type)
+        if pm is not None:
+            obsfactory = \
+                FHIRObservationFactFactory(g, ObservationFactKey(pm.patient_num,
+                                                                 vd.visit_dimension_entry.encounter_num,
+                                                                 self._opts.providerid, start_date), subj)
+            # TODO: Decide what do do with the other mappings in the observation factory
+            self.observation_facts += obsfactory.observation_facts
+        return f"pnum: {pm.patient_num if pm is not None else 'NONE'} " \
+               f"enum:{vd.visit_dimension_entry.encounter_num if vd is not None else 'NONE'}"
+
+    def _map_visit(self, g: Graph, subj: URIRef, mapped_type: FHIR_Visit_Dimension_type) -> str:
+        self.num_visit += 1
+        return "Not Implemented"
+
+    def _map_provider(self, g: Graph, subj: URIRef, mapped_type: FHIR_Provider_Dimension_type) -> str:
+        self.num_provider += 1
+        return "Not Implemented"
+
+    def _map_patient(self, g: Graph, subj: URIRef, mapped_type: FHIR_Patient_Dimension_type) -> str:
+        pd = FHIRPatientDimension(g, self.tables, subj)
+        self.patient_dimensions.append(pd.patient_dimension_entry)
+        self.patient_mappings += pd.patient_mappings.patient_mapping_entries
+        return f"pnum: {pd.patient_dimension_entry.patient_num}"
+
+    def _map_bundle(self, g: Graph, subj: URIRef, mapped_type: FHIR_Bundle_type) -> str:
+        self.num_bundle += 1
+        return "Skipped"
+
+    def _map_unmapped(self, g: Graph, subj: URIRef, mapped_type: Optional[FHIR_Resource_type]) -> str:
+        self.num_unmapped += 1
+        return "Unmapped"
+
+    def _ignore_upload_id(self) -> Optional[int]:
+        """ Return the upload identifier whose records are about to be removed, if any """
+        return self._opts.uploadid if self._opts.remove else None
+
+    def preload_mappings(self, g: Graph, resources: Optional[List[Tuple[URIRef, URIRef]]] = None) -> None:
+        """
+        Resolve the patients and encounters referenced in g against the patient_mapping and encounter_mapping
+        tables in bulk before g is mapped, so patients and encounters from earlier uploads keep their numbers
+        :param g: graph about to be mapped
+        :param resources: resources in g that are to be mapped.  Default: graph_resources(g)
+        """
+        patient_keys = set()
+        encounter_keys = set()
+        self._mapping_keys(g, self.graph_resources(g) if resources is None else resources, patient_keys,
+                           encounter_keys)
+        self._preload(patient_keys, encounter_keys)
+
+    @staticmethod
+    def _mapping_keys(g: Graph, resources: List[Tuple[URIRef, URIRef]], patient_keys: Set[PatientMappingKey],
+                      encounter_keys: Set[Tuple]) -> None:
+        """
+        Add the keys of the patients and encounters referenced by resources to patient_keys and encounter_keys
+        :param g: graph containing the resources
+        :param resources: resources that are to be mapped
+        :param patient_keys: patient mapping keys
+        :param encounter_keys: encounter mapping keys (see ``FHIREncounterMapping.mapping_key``)
+        """
+        for subj, subj_type in resources:
+            mapped_type = FHIR_RESOURCE_MAP[subj_type]
+            if isinstance(mapped_type, FHIR_Observation_Fact_type):
+                patient_id_uri = mapped_type.fact_key_for(g, subj)[0]
+                if patient_id_uri is not None:
+                    parsed_resource = parse_fhir_resource_uri(patient_id_uri)
+                    patient_keys.add(PatientMappingKey(parsed_resource.resource, str(parsed_resource.namespace),
+                                                       FHIRPatientMapping.project_id))
+                    encounter_keys.add(FHIREncounterMapping.mapping_key(subj, parsed_resource.resource,
+                                                                        str(parsed_resource.namespace)))
+            elif isinstance(mapped_type, FHIR_Patient_Dimension_type):
+                parsed_resource = parse_fhir_resource_uri(subj)
+                patient_keys.add(PatientMappingKey(parsed_resource.resource, str(parsed_resource.namespace),
+                                                   FHIRPatientMapping.project_id))
+
+    def _preload(self, patient_keys: Set[PatientMappingKey], encounter_keys: Set[Tuple]) -> None:
+        npatients = FHIRPatientMapping.preload(self.tables, patient_keys, self._ignore_upload_id())
+        nencounters = FHIREncounterMapping.preload(self.tables, encounter_keys, self._ignore_upload_id())
+        if npatients or nencounters:
+            print(f"---> {npatients} existing patient(s) and {nencounters} existing encounter(s) resolved")
+
+    def merge(self, other: "I2B2GraphMap",
+              renumber_maps: Optional[Tuple[Dict[int, int], Dict[int, int]]] = None) -> None:
+        """
+        Add the records from a map that was built with its own patient and encounter numbering (e.g. in a worker
+        process), renumbering them to match the numbers assigned in this process
+        :param other: map to merge
+        :param renumber_maps: (patient, encounter) private to local number maps that are carried from one part of a
+            worker's output to the next.  Required when other is not the first part -- later parts refer to patients
+            and encounters whose mapping entries were in earlier ones.
+        """
+        self.map_queued_graphs()
+        if self.tables:
+            self._preload({PatientMappingKey(e.patient_ide, e.patient_ide_source, e.project_id)
+                           for e in other.patient_mappings
+                           if e.patient_ide_source != FHIRPatientMapping.identity_source_id},
+                          {(e.encounter_ide, e.encounter_ide_source, e.project_id, e.patient_ide, e.patient_ide_source)
+                           for e in other.encounter_mappings
+                           if e.encounter_ide_source != FHIREncounterMapping.identity_source_id})
+        patient_nums, encounter_nums = renumber_maps or ({}, {})
+        _, patient_mappings = FHIRPatientMapping.renumber(self.tables, other.patient_mappings, patient_nums)
+        _, encounter_mappings = FHIREncounterMapping.renumber(other.encounter_mappings, encounter_nums)
+        for pd in other.patient_dimensions:
+            pd.patient_num = patient_nums[pd.patient_num]
+        for vd in other.visit_dimensions:
+            vd.patient_num = patient_nums[vd.patient_num]
+            vd.encounter_num = encounter_nums[vd.encounter_num]
+        for of in other.observation_facts:
+            of.patient_num = patient_nums[of.patient_num]
+            of.encounter_num = encounter_nums[of.encounter_num]
+        self.observation_facts += other.observation_facts
+        self.patient_dimensions += other.patient_dimensions
+        self.patient_mappings += patient_mappings
+        self.visit_dimensions += other.visit_dimensions
+        self.encounter_mappings += encounter_mappings
+        self._nresources += other._nresources
+        for counter in ('num_infrastructure', 'num_visit', 'num_provider', 'num_unmapped', 'num_bundle'):
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+        for type_name, (count, elapsed) in other._type_stats.items():
+            prev_count, prev_elapsed = self._type_stats.get(type_name, (0, 0.0))
+            self._type_stats[type_name] = (prev_count + count, prev_elapsed + elapsed)
+
+    def __getstate__(self) -> Dict:
+        # The source graph is not needed once the resources have been mapped and isn't shipped between processes
+        state = dict(self.__dict__)
+        state['_g'] = None
+        state['_replace_transaction'] = None
+        state['_queued_graphs'] = []
+        state['_num_queued'] = 0
+        return state
 
     def process_resource_instance(self, subj: URIRef,  mapped_type: FHIR_Resource_type) \
             -> Tuple[Optional[FHIRPatientMapping], Optional[FHIRVisitDimension], Optional[datetime]]:
@@ -108,71 +313,165 @@ class I2B2GraphMap:
             return None, None, None
 
     def generate_tsv_files(self) -> None:
-        self._generate_tsv_file("observation_fact.tsv", ObservationFact, self.observation_facts)
-        self._generate_tsv_file("patient_dimension.tsv", PatientDimension, self.patient_dimensions)
-        self._generate_tsv_file("patient_mapping.tsv", PatientMapping, self.patient_mappings)
-        self._generate_tsv_file("visit_dimension.tsv", VisitDimension, self.visit_dimensions)
-        self._generate_tsv_file("encounter_mapping.tsv", EncounterMapping, self.encounter_mappings)
+        self.map_queued_graphs()
+        self._generate_tsv_file("observation_fact", ObservationFact, self.observation_facts)
+        self._generate_tsv_file("patient_dimension", PatientDimension, self.patient_dimensions)
+        self._generate_tsv_file("patient_mapping", PatientMapping, self.patient_mappings)
+        self._generate_tsv_file("visit_dimension", VisitDimension, self.visit_dimensions)
+        self._generate_tsv_file("encounter_mapping", EncounterMapping, self.encounter_mappings)
+
+    def _generate_tsv_file(self, table_name: str, cls, values: List[I2B2Core]) -> None:
+        spool = self._tsv_spools.pop(table_name, None) or RecordSpool()
+        spool.add(values)
+        write_tsv(self._opts.outdir, table_name + ".tsv", heading(cls), spool)
+
+    def flush_tsv_records(self) -> None:
+        """
+        Move the pending records into disk backed (sorted) spools, from which ``generate_tsv_files`` will write them.
+        Used in streaming mode to keep the number of records in memory bounded.
+        """
+        self.map_queued_graphs()
+        for table_name, _, records in self._record_sets():
+            self._tsv_spools.setdefault(table_name, RecordSpool()).add(records)
+            self._num_flushed[table_name] = self._num_records(table_name, records)
+            records.clear()
 
-    def _generate_tsv_file(self, fname: str, cls, values: List[I2B2Core]) -> None:
-        write_tsv(self._opts.outdir, fname, heading(cls), values)
+    # CRC tables, in the order that records are removed from them
+    _clear_order = ("patient_dimension", "patient_mapping", "observation_fact", "visit_dimension", "encounter_mapping")
 
     @staticmethod
-    def clear_i2b2_tables(tables: I2B2Tables, uploadid: int) -> None:
+    def clear_i2b2_tables(tables: I2B2Tables, uploadid: int, chunk_size: int = DELETE_CHUNK_SIZE,
+                          commit: bool = False) -> None:
         """
-        Remove all entries in the i2b2 tables for uploadid.
-        :param tables:
-        :param uploadid:
-        :return:
+        Remove all entries in the i2b2 tables for uploadid, at most chunk_size rows per DELETE.  Tables that are
+        partitioned by upload_id have the uploadid partition dropped instead.
+        :param tables: i2b2 tables
+        :param uploadid: upload identifier to remove
+        :param chunk_size: maximum number of rows per DELETE statement
+        :param commit: commit each chunk as it is deleted.  Otherwise the caller decides the transaction boundary
         """
         # This is a static function to support the removefacts operation
-        print("Deleted {} patient_dimension records"
-              .format(PatientDimension.delete_upload_id(tables, uploadid)))
-        print("Deleted {} patient_mapping records"
-              .format(PatientMapping.delete_upload_id(tables, uploadid)))
-        print("Deleted {} observation_fact records"
-              .format(ObservationFact.delete_upload_id(tables, uploadid)))
-        print("Deleted {} visit_dimension records"
-              .format(VisitDimension.delete_upload_id(tables, uploadid)))
-        print("Deleted {} encounter_mapping records"
-              .format(EncounterMapping.delete_upload_id(tables, uploadid)))
+        for table_name in I2B2GraphMap._clear_order:
+            ndeleted, dropped = remove_upload(tables.crc_connection, tables[table_name], uploadid, chunk_size, commit,
+                                              DeleteProgress(table_name)) if uploadid else (0, False)
+            print("Deleted {} {} records{}".format(ndeleted, table_name, " (partition dropped)" if dropped else ""))
 
     @staticmethod
-    def clear_i2b2_sourcesystems(tables: I2B2Tables, sourcesystemcd: str) -> None:
-        print("Deleted {} patient_dimension records"
-              .format(PatientDimension.delete_sourcesystem_cd(tables, sourcesystemcd)))
-        print("Deleted {} patient_mapping records"
-              .format(PatientMapping.delete_sourcesystem_cd(tables, sourcesystemcd)))
-        print("Deleted {} observation_fact records"
-              .format(ObservationFact.delete_sourcesystem_cd(tables, sourcesystemcd)))
-        print("Deleted {} visit_dimension records"
-              .format(VisitDimension.delete_sourcesystem_cd(tables, sourcesystemcd)))
-        print("Deleted {} encounter_mapping records"
-              .format(EncounterMapping.delete_sourcesystem_cd(tables, sourcesystemcd)))
+    def clear_i2b2_sourcesystems(tables: I2B2Tables, sourcesystemcd: str, chunk_size: int = DELETE_CHUNK_SIZE,
+                                 commit: bool = False) -> None:
+        """
+        Remove all entries in the i2b2 tables for sourcesystemcd, at most chunk_size rows per DELETE
+        :param tables: i2b2 tables
+        :param sourcesystemcd: sourcesystem code to remove
+        :param chunk_size: maximum number of rows per DELETE statement
+        :param commit: commit each chunk as it is deleted.  Otherwise the caller decides the transaction boundary
+        """
+        for table_name in I2B2GraphMap._clear_order:
+            table = tables[table_name]
+            print("Deleted {} {} records".format(
+                chunked_delete(tables.crc_connection, table, table.c.sourcesystem_cd == sourcesystemcd, chunk_size,
+                               commit, DeleteProgress(table_name)), table_name))
 
-    def load_i2b2_tables(self, check_dups=False) -> None:
-        # session = sessionmaker(bind=tables.crc_engine)()
+    def _record_sets(self) -> List[Tuple[str, Type[I2B2CoreWithUploadId], List[I2B2CoreWithUploadId]]]:
+        """
+        Return the i2b2 table name, record class and pending records for each CRC table in load order
+        """
+        return [("patient_dimension", PatientDimension, self.patient_dimensions),
+                ("patient_mapping", PatientMapping, self.patient_mappings),
+                ("visit_dimension", VisitDimension, self.visit_dimensions),
+                ("encounter_mapping", EncounterMapping, self.encounter_mappings),
+                ("observation_fact", ObservationFact, self.observation_facts)]
+
+    def num_pending_records(self) -> int:
+        """
+        Return the number of records that have been generated but not yet loaded.  Each queued resource counts as one
+        record.
+        """
+        return sum(len(records) for _, _, records in self._record_sets()) + self._num_queued
+
+    def _num_records(self, table_name: str, records: List[I2B2CoreWithUploadId]) -> int:
+        return self._num_flushed.get(table_name, 0) + len(records)
+
+    def _prepare_i2b2_tables(self, check_dups: bool) -> None:
+        """
+        Clear the existing upload (if requested) and make sure that the code columns are long enough.  Done once,
+        before the first set of records is loaded
+        :param check_dups: True means check for duplicate records before add
+        """
         I2B2Core._check_dups = check_dups
-        if self._opts.remove:
-            # TODO: This should really be within a transaction boundary
-            self.clear_i2b2_tables(self._opts.tables, self._opts.uploadid)
-        change_column_length(self._opts.tables.observation_fact, self._opts.tables.observation_fact.c.concept_cd,
-                             200, self._opts.tables.crc_connection)
-        change_column_length(self._opts.tables.observation_fact, self._opts.tables.observation_fact.c.modifier_cd,
-                             200, self._opts.tables.crc_connection)
-        print("{} / {} patient_dimension records added / modified"
-              .format(*PatientDimension.add_or_update_records(self._opts.tables, self.patient_dimensions)))
-        print("{} / {} patient_mapping records added / modified"
-              .format(*PatientMapping.add_or_update_records(self._opts.tables, self.patient_mappings)))
-        print("{} / {} visit_dimension records added / modified"
-              .format(*VisitDimension.add_or_update_records(self._opts.tables, self.visit_dimensions)))
-        print("{} / {} encounter_mapping records added / modified"
-              .format(*EncounterMapping.add_or_update_records(self._opts.tables, self.encounter_mappings)))
-        print("{} / {} observation_fact records added / modified"
-              .format(*ObservationFact.add_or_update_records(self._opts.tables, self.observation_facts)))
-        # session.close()
+        if not self._tables_prepared:
+            change_column_length(self._opts.tables.observation_fact,
+                                 self._opts.tables.observation_fact.c.concept_cd,
+                                 200, self._opts.tables.crc_connection)
+            change_column_length(self._opts.tables.observation_fact,
+                                 self._opts.tables.observation_fact.c.modifier_cd,
+                                 200, self._opts.tables.crc_connection)
+            if self._opts.remove:
+                # The existing upload is removed and the new records are added in one transaction, committed by
+                # load_i2b2_tables, so other sessions see either the old upload or the new one
+                self._replace_transaction = self._opts.tables.crc_connection.begin()
+                self.clear_i2b2_tables(self._opts.tables, self._opts.uploadid)
+            for table_name, _, _ in self._record_sets():
+                partition_name = ensure_upload_partition(self._opts.tables.crc_connection,
+                                                         self._opts.tables[table_name], self._opts.uploadid)
+                if partition_name:
+                    print("Created partition {}".format(partition_name))
+            self._tables_prepared = True
+
+    def _load_pending_records(self, check_dups: bool) -> None:
+        """
+        Add or update the pending records in the i2b2 tables, accumulating the added / modified counts.  If the upload
+        is being replaced, the replacement is rolled back if the load fails.
+        :param check_dups: True means check for duplicate records before add
+        """
+        try:
+            self.map_queued_graphs()
+            self._prepare_i2b2_tables(check_dups)
+            for table_name, cls, records in self._record_sets():
+                if self._opts.bulk:
+                    nadded, nmodified = bulk_add_or_update_records(self._opts.tables.crc_connection,
+                                                                   self._opts.tables[table_name], cls, records)
+                else:
+                    nadded, nmodified = cls.add_or_update_records(self._opts.tables, records)
+                prev_added, prev_modified = self._load_counts.get(table_name, (0, 0))
+                self._load_counts[table_name] = (prev_added + nadded, prev_modified + nmodified)
+        except Exception:
+            self.rollback_replacement()
+            raise
+
+    def flush_i2b2_tables(self, check_dups=False) -> None:
+        """
+        Load the pending records into the i2b2 tables and release them.  Used in streaming mode to keep the number of
+        records in memory bounded.
+        :param check_dups: True means check for duplicate records before add
+        """
+        self._load_pending_records(check_dups)
+        for table_name, _, records in self._record_sets():
+            self._num_flushed[table_name] = self._num_records(table_name, records)
+            records.clear()
+
+    def load_i2b2_tables(self, check_dups=False) -> None:
+        """
+        Load the pending records into the i2b2 tables and, if the upload is being replaced, commit the replacement.
+        The replacement is rolled back if the load fails.
+        :param check_dups: True means check for duplicate records before add
+        """
+        self._load_pending_records(check_dups)
+        if self._replace_transaction is not None:
+            self._replace_transaction.commit()
+            self._replace_transaction = None
+            print("Upload {} replaced".format(self._opts.uploadid))
+        for table_name, _, _ in self._record_sets():
+            print("{} / {} {} records added / modified".format(*self._load_counts[table_name], table_name))
+
+    def rollback_replacement(self) -> None:
+        """ Abandon an upload replacement (opts.remove) that is in progress, leaving the existing upload in place """
+        if self._replace_transaction is not None:
+            self._replace_transaction.rollback()
+            self._replace_transaction = None
 
     def summary(self) -> str:
+        self.map_queued_graphs()
         summary_text = """Generated:
     {} Observation facts
     {} Patients
@@ -186,9 +485,17 @@ class I2B2GraphMap:
     {num_unmapped} Unmapped resources
 """
         num_skips = self.num_infrastructure + self.num_visit + self.num_provider + self.num_unmapped + self.num_bundle
-        rval = summary_text.format(len(self.observation_facts),
-                                   len(self.patient_dimensions),
-                                   len(self.patient_mappings))
+        rval = summary_text.format(self._num_records("observation_fact", self.observation_facts),
+                                   self._num_records("patient_dimension", self.patient_dimensions),
+                                   self._num_records("patient_mapping", self.patient_mappings))
         if num_skips:
             rval += skip_text.format(**self.__dict__)
         return rval
+
+    def resource_stats(self) -> str:
+        """ Return the number of resources of each type that were mapped and the time spent mapping them, most
+        expensive first """
+        rval = "=== RESOURCES ===\n"
+        for type_name, (count, elapsed) in sorted(self._type_stats.items(), key=lambda e: (-e[1][1], e[0])):
+            rval += f"    {count} {type_name} ({elapsed:.2f}s, {elapsed * 1000 / count:.2f} ms/resource)\n"
+        return rval
@@ -0,0 +1,121 @@
+from typing import Optional, Tuple, Callable
+
+from sqlalchemy import Table, MetaData, select, func, text
+from sqlalchemy.engine import Connection, Dialect
+
+from i2fhirb2.loaders.i2b2bulkloader import chunked_delete, DELETE_CHUNK_SIZE
+
+
+# Is the (schema qualified) table partitioned by a list of upload_id values?
+_UPLOAD_PARTITIONED_QUERY = text("""
+    SELECT count(*) FROM pg_partitioned_table pt
+        JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = to_regclass(:table_name) AND pt.partstrat = 'l' AND pt.partnatts = 1
+          AND a.attname = 'upload_id'""")
+
+# Is the (schema qualified) partition attached to the (schema qualified) table?
+_PARTITION_ATTACHED_QUERY = text("""
+    SELECT count(*) FROM pg_inherits
+    WHERE inhrelid = to_regclass(:partition_name) AND inhparent = to_regclass(:table_name)""")
+
+
+def upload_partition(table: Table, upload_id: int) -> Table:
+    """
+    Return the partition of table that holds the records for upload_id
+    :param table: partitioned table
+    :param upload_id: upload identifier
+    :return: partition table (in the same schema as table)
+    """
+    return Table('{}_upload_{}'.format(table.name, int(upload_id)), MetaData(), schema=table.schema)
+
+
+def create_partition_ddl(dialect: Dialect, table: Table, upload_id: int) -> str:
+    """ Return the statement that creates the upload_id partition of table """
+    preparer = dialect.identifier_preparer
+    return "CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({})"\
+        .format(preparer.format_table(upload_partition(table, upload_id)), preparer.format_table(table),
+                int(upload_id))
+
+
+def drop_partition_ddl(dialect: Dialect, table: Table, upload_id: int) -> str:
+    """ Return the statement that drops the upload_id partition of table """
+    return "DROP TABLE {}".format(dialect.identifier_preparer.format_table(upload_partition(table, upload_id)))
+
+
+def is_upload_partitioned(conn: Connection, table: Table) -> bool:
+    """
+    Determine whether table is partitioned by upload_id (``PARTITION BY LIST (upload_id)``).  Only PostgreSQL tables
+    are ever partitioned.
+    :param conn: sql connection
+    :param table: table to test
+    :return: True if records can be loaded and removed by upload_id partition
+    """
+    return conn.dialect.name == 'postgresql' and \
+        bool(conn.execute(_UPLOAD_PARTITIONED_QUERY,
+                          table_name=conn.dialect.identifier_preparer.format_table(table)).scalar())
+
+
+def has_upload_partition(conn: Connection, table: Table, upload_id: int) -> bool:
+    """ Determine whether the upload_id partition of table exists and is attached """
+    preparer = conn.dialect.identifier_preparer
+    return bool(conn.execute(_PARTITION_ATTACHED_QUERY,
+                             partition_name=preparer.format_table(upload_partition(table, upload_id)),
+                             table_name=preparer.format_table(table)).scalar())
+
+
+def ensure_upload_partition(conn: Connection, table: Table, upload_id: int) -> Optional[str]:
+    """
+    Create the partition for upload_id if table is partitioned by upload_id and the partition doesn't exist.  If
+    records for upload_id are already in the default partition (they were loaded before the table was partitioned)
+    no partition is created and the new records join them.
+    :param conn: sql connection
+    :param table: target table
+    :param upload_id: upload identifier
+    :return: name of the partition that was created, if any
+    """
+    if not is_upload_partitioned(conn, table) or has_upload_partition(conn, table, upload_id):
+        return None
+    if conn.execute(select([table.c.upload_id]).where(table.c.upload_id == upload_id).limit(1)).first():
+        return None
+    conn.execute(create_partition_ddl(conn.dialect, table, upload_id))
+    return upload_partition(table, upload_id).name
+
+
+def drop_upload_partition(conn: Connection, table: Table, upload_id: int) -> int:
+    """
+    Drop the upload_id partition of table
+    :param conn: sql connection
+    :param table: partitioned table
+    :param upload_id: upload identifier
+    :return: number of records in the partition
+    """
+    nremoved = conn.execute(select([func.count()]).select_from(upload_partition(table, upload_id))).scalar()
+    conn.execute(drop_partition_ddl(conn.dialect, table, upload_id))
+    return nremoved
+
+
+def remove_upload(conn: Connection, table: Table, upload_id: int, chunk_size: int = DELETE_CHUNK_SIZE,
+                  commit: bool = False, progress: Optional[Callable[[int], None]] = None) -> Tuple[int, bool]:
+    """
+    Remove the records for upload_id from table.  If table is partitioned by upload_id, the partition for upload_id
+    is dropped.  Any records that remain (e.g. in the default partition) and the records in unpartitioned tables are
+    deleted chunk_size rows at a time.  The caller decides the transaction boundary unless commit is set.
+    :param conn: sql connection
+    :param table: table to remove the records from
+    :param upload_id: upload identifier
+    :param chunk_size: maximum number of rows per DELETE statement
+    :param commit: commit the partition drop and each chunk in its own transaction (see ``chunked_delete``)
+    :param progress: ``chunked_delete`` progress callback
+    :return: number of records removed, True if a partition was dropped
+    """
+    nremoved = 0
+    dropped = False
+    if is_upload_partitioned(conn, table) and has_upload_partition(conn, table, upload_id):
+        if commit:
+            with conn.begin():
+                nremoved = drop_upload_partition(conn, table, upload_id)
+        else:
+            nremoved = drop_upload_partition(conn, table, upload_id)
+        dropped = True
+    return nremoved + chunked_delete(conn, table, table.c.upload_id == upload_id, chunk_size, commit, progress), \
+        dropped
@@ -0,0 +1,180 @@
+import gzip
+import http.client
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from itertools import islice
+from typing import Dict, List, Iterable, Iterator, Tuple, Union, BinaryIO
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+from urllib.request import Request, urlopen
+
+JSON_ACCEPT = "application/fhir+json, application/json;q=0.9, text/json;q=0.8"
+NDJSON_ACCEPT = "application/fhir+ndjson, application/ndjson;q=0.9"
+TURTLE_ACCEPT = "application/turtle, text/turtle;q=0.9"
+
+# Responses that are worth asking for again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+Connection = Union[http.client.HTTPConnection, http.client.HTTPSConnection]
+
+
+class URLFetcher:
+    """
+    Download URLs over a pool of persistent (keep-alive) HTTP connections, asking for gzip compression and retrying
+    failed requests with exponential backoff.  ``fetch_all`` downloads up to ``max_in_flight`` URLs at once, returning
+    each payload, in order, as soon as it and everything in front of it has arrived.  Schemes other than http and
+    https (e.g. file:) are read with ``urlopen``.
+    """
+    def __init__(self, max_in_flight: int = 4, retries: int = 3, backoff: float = 0.5, timeout: float = 60) -> None:
+        """
+        Create a fetcher
+        :param max_in_flight: maximum number of concurrent requests (and of payloads held by fetch_all)
+        :param retries: number of times a failed request is retried
+        :param backoff: delay, in seconds, before the first retry.  The delay doubles on each subsequent retry
+        :param timeout: socket timeout in seconds
+        """
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._idle = {}                 # type: Dict[Tuple[str, str], List[Connection]]
+        self._lock = threading.Lock()
+        self.num_requests = 0           # Number of HTTP requests issued, including retries and redirects
+        self.num_connections = 0        # Number of HTTP connections opened
+
+    def __enter__(self) -> "URLFetcher":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """ Close all idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _acquire(self, scheme: str, netloc: str, reuse: bool = True) -> Tuple[Connection, bool]:
+        """ Return an idle connection to netloc if there is one (and reuse is True), otherwise a new one
+        :return: connection, True if it is a reused connection """
+        with self._lock:
+            conns = self._idle.get((scheme, netloc))
+            if conns and reuse:
+                return conns.pop(), True
+            self.num_connections += 1
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return conn_class(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme: str, netloc: str, conn: Connection) -> None:
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def _request(self, url: str, accept: str, reuse: bool = True) -> Tuple[int, Message, bytes]:
+        """
+        Issue a single GET on a pooled connection.  A request that fails on a reused connection -- one that the server
+        may have closed while it sat idle -- is repeated once on a new connection
+        :return: status, headers and (still encoded) body
+        """
+        parts = urlsplit(url)
+        conn, reused = self._acquire(parts.scheme, parts.netloc, reuse)
+        try:
+            conn.request('GET', (parts.path or '/') + ('?' + parts.query if parts.query else ''),
+                         headers={'Accept': accept, 'Accept-Encoding': 'gzip'})
+            with self._lock:
+                self.num_requests += 1
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if reused:
+                return self._request(url, accept, reuse=False)
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(parts.scheme, parts.netloc, conn)
+        return response.status, response.msg, body
+
+    def fetch(self, url: str, accept: str) -> bytes:
+        """
+        Download url, following redirects and retrying connection errors and 429 or 5xx responses
+        :param url: URL to download
+        :param accept: Accept header
+        :return: (decompressed) payload
+        """
+        if urlsplit(url).scheme not in ('http', 'https'):
+            with urlopen(Request(url, headers={'Accept': accept}), timeout=self.timeout) as response:
+                return response.read()
+        nredirects = 0
+        attempt = 0
+        while True:
+            try:
+                status, headers, body = self._request(url, accept)
+            except (OSError, http.client.HTTPException):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if status in REDIRECT_STATUSES and 'Location' in headers and nredirects < MAX_REDIRECTS:
+                    url = urljoin(url, headers['Location'])
+                    nredirects += 1
+                    continue
+                if status < 300:
+                    return gzip.decompress(body) if headers.get('Content-Encoding') == 'gzip' else body
+                if status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise HTTPError(url, status, http.client.responses.get(status, ''), headers, None)
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def fetch_all(self, urls: Iterable[str], accept: str) -> Iterator[Tuple[str, bytes]]:
+        """
+        Download urls, max_in_flight at a time
+        :param urls: URLs to download
+        :param accept: Accept header
+        :return: (url, payload) for each URL, in urls order
+        """
+        urls = iter(urls)
+        with ThreadPoolExecutor(self.max_in_flight) as executor:
+            pending = deque((url, executor.submit(self.fetch, url, accept))
+                            for url in islice(urls, self.max_in_flight))
+            while pending:
+                url, future = pending.popleft()
+                payload = future.result()
+                for next_url in islice(urls, 1):
+                    pending.append((next_url, executor.submit(self.fetch, next_url, accept)))
+                yield url, payload
+
+    def open(self, url: str, accept: str) -> BinaryIO:
+        """
+        Open url for streaming.  The connection isn't pooled, as the response is read by the caller, and only the
+        initial request is retried.
+        :param url: URL to open
+        :param accept: Accept header
+        :return: binary stream of the (decompressed) payload
+        """
+        attempt = 0
+        while True:
+            try:
+                response = urlopen(Request(url, headers={'Accept': accept, 'Accept-Encoding': 'gzip'}),
+                                   timeout=self.timeout)
+                break
+            except HTTPError as e:
+                if e.code not in RETRY_STATUSES or attempt >= self.retries:
+                    raise
+            except OSError:
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+        if response.headers.get('Content-Encoding') == 'gzip':
+            return gzip.GzipFile(fileobj=response, mode='rb')
+        return response
+
+
+default_fetcher = URLFetcher()
@@ -1,18 +1,32 @@
+import gzip
+import io
+import json
 import os
+import pickle
+import re
 import sys
 from argparse import Namespace
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
+from io import StringIO
+from itertools import chain, islice
 from random import randint
-from typing import List, Optional
-from urllib.request import Request, urlopen
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from typing import List, Optional, Iterator, Tuple, Dict, TextIO, Callable
+from urllib.parse import urlparse
 from i2fhirb2 import __version__
 
-from fhirtordf.fhir.fhirmetavoc import FHIRMetaVoc
-from fhirtordf.loaders.fhirjsonloader import fhir_json_to_rdf
+from fhirtordf.loaders.fhirresourceloader import FHIRResource
+from jsonasobj import loads
 from rdflib import Graph
 
 from i2fhirb2.common_cli_parameters import add_common_parameters
+from i2fhirb2.sharedtables import add_pool_args, shared_tables
+from i2fhirb2.fhir.fhirconceptcache import cache_counts, add_cache_counts, cache_stats
 from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc
 from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
 from i2b2model.data.i2b2observationfact import ObservationFact
 
@@ -20,14 +34,193 @@ from i2b2model.data.i2b2patientdimension import PatientDimension
 from i2b2model.data.i2b2patientmapping import PatientMapping
 from i2b2model.shared.i2b2core import I2B2Core, I2B2CoreWithUploadId
 
+from i2fhirb2.loaders.fhirjsonmapper import FHIRJSONMapper
+from i2fhirb2.loaders.fhirjsonreader import fhir_json_resources
 from i2fhirb2.loaders.i2b2graphmap import I2B2GraphMap
-from i2b2model.sqlsupport.dbconnection import add_connection_args, process_parsed_args, I2B2Tables
+from i2fhirb2.loaders.urlfetcher import URLFetcher, JSON_ACCEPT, NDJSON_ACCEPT, TURTLE_ACCEPT, default_fetcher
+from i2b2model.sqlsupport.dbconnection import add_connection_args, process_parsed_args
 from i2b2model.sqlsupport.file_aware_parser import FileAwareParser
 
 
 # TODO: Add support for non-turtle RDF files
 # TODO: Add continuation headers for RDF
 
+ndjson_batch_size = 500             # Number of NDJSON resources mapped as a single graph
+
+
+def read_rdf_uri(uri: str, fetcher: Optional[URLFetcher] = None) -> str:
+    """
+    Read the turtle representation of a URI
+    :param uri: URI to read
+    :param fetcher: fetcher to download it with.  Default: default_fetcher
+    :return: turtle image of the resource
+    """
+    return (fetcher or default_fetcher).fetch(uri, TURTLE_ACCEPT).decode()
+
+
+def is_ndjson(fname: str) -> bool:
+    """ Determine whether fname names an NDJSON (FHIR Bulk Data) file """
+    return fname.endswith('.ndjson') or fname.endswith('.ndjson.gz')
+
+
+def open_ndjson(filepath: str, fetcher: Optional[URLFetcher] = None) -> TextIO:
+    """
+    Open an NDJSON file or URL for reading, decompressing it on the fly if its name ends in ``.gz``
+    :param filepath: file name or URL
+    :param fetcher: fetcher to open URLs with.  Default: default_fetcher
+    :return: text stream
+    """
+    if '://' in filepath:
+        stream = (fetcher or default_fetcher).open(filepath, NDJSON_ACCEPT)
+    else:
+        stream = open(filepath, 'rb')
+    if filepath.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    return io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def ndjson_resource_type(filepath: str) -> Optional[str]:
+    """
+    Return the type of the resources in an NDJSON file -- the type of the first resource for local files, the start of
+    the file name for URLs
+    :param filepath: file name or URL
+    :return: resource type if it can be determined
+    """
+    if '://' in filepath:
+        return re.split(r'[^A-Za-z]', os.path.basename(urlparse(filepath).path), 1)[0] or None
+    with open_ndjson(filepath) as f:
+        for line in f:
+            if line.strip():
+                return json.loads(line).get('resourceType')
+    return None
+
+
+def patient_files_first(files: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Move the NDJSON Patient file(s) in front of the other inputs, so patient numbers are assigned in patient file
+    order before the fact bearing resources are mapped
+    :param files: (directory name, file name or URL) for each input
+    :return: reordered files
+    """
+    def is_patient_file(dirname: str, fname: str) -> bool:
+        return is_ndjson(fname) and \
+            ndjson_resource_type(fname if '://' in fname else os.path.join(dirname, fname)) == 'Patient'
+    return sorted(files, key=lambda e: not is_patient_file(*e))
+
+
+def input_files(opts: Namespace) -> Iterator[Tuple[str, str]]:
+    """
+    Enumerate the input file(s) and/or URL(s) specified by opts.  NDJSON Patient files come first
+    :param opts: User supplied options
+    :return: (directory name, file name or URL) for each input
+    """
+    if opts.infile:
+        files = [(opts.indir if opts.indir else "", fn) for fn in opts.infile]
+    else:
+        files = []
+        for dirpath, _, filenames in os.walk(opts.indir):
+            for filename in filenames:
+                if (opts.filetype == 'json' and filename.endswith('.json')) or \
+                        (opts.filetype == 'ndjson' and is_ndjson(filename)) or filename.endswith('.ttl'):
+                    files.append((dirpath, filename))
+    yield from patient_files_first(files)
+
+
+class CrawlCheckpoint:
+    """
+    Record of how far each input has been loaded, kept in a JSON file so that an interrupted load can be resumed.
+    Inputs that have been completely loaded are skipped and a paged (``next`` link) query resumes at the page it was
+    on.  The records mapped so far are flushed before the checkpoint is written, so the file never claims more than
+    has been loaded.
+    """
+    def __init__(self, fname: str, flush: Callable[[], None]) -> None:
+        """
+        Load or create a checkpoint
+        :param fname: checkpoint file name
+        :param flush: function that writes all pending records to their destination
+        """
+        self.fname = fname
+        self._flush = flush
+        self._pages = {}                # type: Dict[str, Optional[str]]
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self._pages = json.load(f)
+
+    def is_done(self, filepath: str) -> bool:
+        """ Determine whether input filepath has been completely loaded """
+        return filepath in self._pages and self._pages[filepath] is None
+
+    def start_page(self, filepath: str) -> str:
+        """ Return the page of input filepath to start loading at """
+        return self._pages.get(filepath) or filepath
+
+    def page_started(self, filepath: str, page: str) -> None:
+        """ Record that everything in front of page has been loaded """
+        self._save(filepath, page)
+
+    def input_done(self, filepath: str) -> None:
+        """ Record that all of filepath has been loaded """
+        self._save(filepath, None)
+
+    def _save(self, filepath: str, page: Optional[str]) -> None:
+        self._flush()
+        self._pages[filepath] = page
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(self._pages, f, indent=1)
+        os.replace(self.fname + '.tmp', self.fname)
+
+
+def is_prefetched(filepath: str, opts: Namespace) -> bool:
+    """ Determine whether filepath is a URL that is downloaded ahead of being read.  NDJSON URLs are streamed """
+    return '://' in filepath and not (is_ndjson(filepath) or opts.filetype == 'ndjson')
+
+
+def input_payloads(opts: Namespace, fetcher: URLFetcher,
+                   checkpoint: Optional[CrawlCheckpoint] = None) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """
+    Enumerate the inputs specified by opts, downloading the URL inputs (see ``is_prefetched``) up to
+    fetcher.max_in_flight at a time, ahead of the caller
+    :param opts: User supplied options
+    :param fetcher: fetcher to download the URLs with
+    :param checkpoint: if present, inputs that have already been loaded are skipped and the payload of a partially
+    loaded input is that of its checkpoint start page
+    :return: (file name or URL, payload) for each input.  Payload is None for files and streamed URLs
+    """
+    filepaths = [fname if '://' in fname else os.path.join(dirname, fname) for dirname, fname in input_files(opts)]
+    if checkpoint:
+        filepaths = [fp for fp in filepaths if not checkpoint.is_done(fp)]
+    payloads = fetcher.fetch_all([checkpoint.start_page(fp) if checkpoint else fp
+                                  for fp in filepaths if is_prefetched(fp, opts)],
+                                 TURTLE_ACCEPT if opts.filetype == 'rdf' else JSON_ACCEPT)
+    for filepath in filepaths:
+        yield filepath, next(payloads)[1] if is_prefetched(filepath, opts) else None
+
+
+def parse_rdf_payload(g: Graph, payload: bytes) -> None:
+    """ Add a downloaded turtle image to g.  An empty download is reported and adds nothing """
+    if not payload:
+        print("   Read Failed")
+        return
+    g.parse(data=payload.decode(), format="turtle")
+
+
+def add_json_resource(resource: Dict, base_uri: str, g: Graph, metavoc: Graph, mapper: Optional[FHIRJSONMapper],
+                      add_ontology_header: bool = False) -> None:
+    """
+    Add the RDF representation of a parsed FHIR JSON resource to g
+    :param resource: JSON resource
+    :param base_uri: Base URI to use for relative references
+    :param g: target graph
+    :param metavoc: FHIR Metadata Vocabulary (fhir.ttl) graph
+    :param mapper: If present, convert the resource with the native JSON mapper rather than fhirtordf
+    :param add_ontology_header: True means add the OWL ontology header
+    """
+    if mapper:
+        mapper.add_resource(resource, base_uri, g, add_ontology_header)
+    else:
+        FHIRResource(metavoc, None, base_uri, data=loads(json.dumps(resource)), target=g,
+                     add_ontology_header=add_ontology_header)
+
 
 def load_rdf_graph(opts: Namespace) -> Optional[Graph]:
     """
@@ -36,41 +229,132 @@ def load_rdf_graph(opts: Namespace) -> Optional[Graph]:
     :return: Loaded graph or None if errors were encountered
     """
     g = Graph()
-    fmv = FHIRMetaVoc(opts.metadatavoc + '/fhir.ttl')
-
-    def read_rdf_uri(uri: str) -> str:
-        req = Request(uri)
-        req.add_header("Accept", "application/turtle, text/turtle;q=0.9")
-        with urlopen(req) as response:
-            return response.read().decode()
-
-    def load_file(dirname: str, fname: str) -> None:
-        filepath = fname if '://' in fname else os.path.join(dirname, fname)
-        print("--> loading {}".format(filepath))
-        if '://' in fname:
-            if opts.filetype == 'rdf':
-                rdf_str = read_rdf_uri(fname)
-                if not rdf_str:
-                    print("   Read Failed")
-                g.parse(data=rdf_str, format="turtle")
-            else:
-                fhir_json_to_rdf(fname, opts.uribase, g, metavoc=fmv)
-        else:
-            if filepath.endswith('.json'):
-                fhir_json_to_rdf(filepath, opts.uribase, g, metavoc=fmv)
+    fmv = fhir_metavoc(opts.metadatavoc, rebuild_cache=opts.rebuild_cache)
+    mapper = FHIRJSONMapper(fmv) if opts.native else None
+
+    with URLFetcher(opts.fetchers) as fetcher:
+        for filepath, payload in input_payloads(opts, fetcher):
+            print("--> loading {}".format(filepath))
+            if '://' in filepath and opts.filetype == 'rdf':
+                parse_rdf_payload(g, payload)
+            elif '://' in filepath or filepath.endswith('.json'):
+                for resource in fhir_json_resources(filepath, payload, fetcher):
+                    add_json_resource(resource, opts.uribase, g, fmv, mapper, add_ontology_header=True)
             else:
                 g.load(filepath, format="turtle")
-
-    if opts.infile:
-        [load_file(opts.indir if opts.indir else "", fn) for fn in opts.infile]
-    else:
-        for dirpath, _, filenames in os.walk(opts.indir):
-            for filename in filenames:
-                if (opts.filetype == 'json' and filename.endswith('.json')) or filename.endswith('.ttl'):
-                    load_file(dirpath, filename)
     return g
 
 
+def json_resource_graphs(json_fname: str, base_uri: str, metavoc: Graph, mapper: Optional[FHIRJSONMapper] = None,
+                         payload: Optional[bytes] = None, fetcher: Optional[URLFetcher] = None,
+                         on_page: Optional[Callable[[str], None]] = None) -> Iterator[Graph]:
+    """
+    Convert a FHIR JSON resource, bundle or collection into a sequence of RDF graphs, one per resource.  Bundle
+    entries are read one at a time (see ``fhir_json_resources``), so neither the bundle nor its graph is ever held
+    in memory as a whole.
+    :param json_fname: Name or URI of the JSON file
+    :param base_uri: Base URI to use for relative references
+    :param metavoc: FHIR Metadata Vocabulary (fhir.ttl) graph
+    :param mapper: If present, convert the resources with the native JSON mapper rather than fhirtordf
+    :param payload: content of json_fname, if it has already been downloaded
+    :param fetcher: fetcher used to download URLs
+    :param on_page: called with the name or URL of each page before it is mapped
+    :return: Graph for each resource
+    """
+    for resource in fhir_json_resources(json_fname, payload, fetcher, on_page):
+        g = Graph()
+        add_json_resource(resource, base_uri, g, metavoc, mapper)
+        yield g
+
+
+def ndjson_resources(filepath: str, fetcher: Optional[URLFetcher] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Read an NDJSON file or URL one line at a time
+    :param filepath: file name or URL
+    :param fetcher: fetcher to open URLs with
+    :return: (line number, line) for every non-blank line
+    """
+    with open_ndjson(filepath, fetcher) as f:
+        for line_num, line in enumerate(f, 1):
+            if line.strip():
+                yield line_num, line
+
+
+def ndjson_resource_graphs(filepath: str, base_uri: str, metavoc: Graph, mapper: Optional[FHIRJSONMapper] = None,
+                           batch_size: Optional[int] = None, fetcher: Optional[URLFetcher] = None) -> Iterator[Graph]:
+    """
+    Convert an NDJSON file (one FHIR resource per line) into a sequence of RDF graphs, each holding at most
+    batch_size resources.  Only one batch is in memory at a time.
+    :param filepath: file name or URL
+    :param base_uri: Base URI to use for relative references
+    :param metavoc: FHIR Metadata Vocabulary (fhir.ttl) graph
+    :param mapper: If present, convert the resources with the native JSON mapper rather than fhirtordf
+    :param batch_size: maximum number of resources per graph.  Default: ndjson_batch_size
+    :param fetcher: fetcher to open URLs with
+    :return: Graph for each batch
+    """
+    batch_size = batch_size or ndjson_batch_size
+    g = Graph()
+    nresources = 0
+    for line_num, line in ndjson_resources(filepath, fetcher):
+        try:
+            resource = json.loads(line)
+        except ValueError as e:
+            raise ValueError("{} line {}: {}".format(filepath, line_num, e))
+        add_json_resource(resource, base_uri, g, metavoc, mapper)
+        nresources += 1
+        if nresources >= batch_size:
+            yield g
+            g = Graph()
+            nresources = 0
+    if nresources:
+        yield g
+
+
+def stream_rdf_graphs(opts: Namespace, metavoc: Optional[Graph] = None, mapper: Optional[FHIRJSONMapper] = None,
+                      checkpoint: Optional[CrawlCheckpoint] = None) -> Iterator[Graph]:
+    """
+    Generate a sequence of small RDF graphs from the file(s) specified by opts -- one graph per Turtle file and one per
+    resource for JSON input.  Used in streaming mode, where each graph is mapped and discarded before the next one
+    is read.  URL inputs are downloaded opts.fetchers at a time while earlier inputs are being mapped.
+    :param opts: User supplied options
+    :param metavoc: FHIR Metadata Vocabulary graph.  If absent, it is loaded from opts.metadatavoc
+    :param mapper: native JSON mapper to use if opts.native is set.  If absent, one is created from metavoc
+    :param checkpoint: if present, resume from and record progress in this checkpoint.  Progress is recorded as each
+    input and each query page is reached, by which time the graphs from everything in front of it have been consumed
+    :return: Graph for each input file or JSON resource
+    """
+    if metavoc is None:
+        metavoc = fhir_metavoc(opts.metadatavoc, rebuild_cache=opts.rebuild_cache)
+    if opts.native and mapper is None:
+        mapper = FHIRJSONMapper(metavoc)
+    mapper = mapper if opts.native else None
+    with URLFetcher(opts.fetchers) as fetcher:
+        for filepath, payload in input_payloads(opts, fetcher, checkpoint):
+            print("--> loading {}".format(filepath))
+            is_url = '://' in filepath
+            if is_ndjson(filepath) or (is_url and opts.filetype == 'ndjson'):
+                yield from ndjson_resource_graphs(filepath, opts.uribase, metavoc, mapper, fetcher=fetcher)
+            elif (is_url and opts.filetype != 'rdf') or (not is_url and filepath.endswith('.json')):
+                if checkpoint:
+                    start_page = checkpoint.start_page(filepath)
+                    if start_page != filepath:
+                        print("    resuming at {}".format(start_page))
+                    yield from json_resource_graphs(start_page, opts.uribase, metavoc, mapper, payload, fetcher,
+                                                    lambda page: checkpoint.page_started(filepath, page))
+                else:
+                    yield from json_resource_graphs(filepath, opts.uribase, metavoc, mapper, payload, fetcher)
+            else:
+                g = Graph()
+                if is_url:
+                    parse_rdf_payload(g, payload)
+                else:
+                    g.load(filepath, format="turtle")
+                yield g
+            if checkpoint:
+                checkpoint.input_done(filepath)
+
+
 def create_parser() -> FileAwareParser:
     """
     Create a command line argument parser
@@ -85,11 +369,27 @@ def create_parser() -> FileAwareParser:
     parser.add_file_argument("-od", "--outdir", metavar="Output directory",
                              help="Output directory to store .tsv files.")
     parser.add_argument("-t", "--filetype",
-                        help="Type of file to ask for / load - only applies for URL's and directories.",
-                        choices=['json', 'rdf'], default='rdf')
+                        help="Type of file to ask for / load - only applies for URL's and directories.  "
+                        "ndjson (FHIR Bulk Data, optionally gzipped) implies --stream",
+                        choices=['json', 'ndjson', 'rdf'], default='rdf')
     parser.add_argument("-rm", "--remove", help="Remove existing entries for the upload identifier and/or"
                         " clear target tsv files", action="store_true")
-    parser.add_argument("--dupcheck", help="Check for duplicate records before add.", action="store_true")
+    parser.add_argument("--dupcheck", help="Check for duplicate records before add.  Implies --bulk",
+                        action="store_true")
+    parser.add_argument("--bulk", help="Load the tables through a staging table (COPY on PostgreSQL) rather than "
+                        "row by row", action="store_true")
+    parser.add_argument("--stream", help="Map input one resource (or Turtle file) at a time instead of loading "
+                        "everything into a single graph first", action="store_true")
+    parser.add_argument("--workers", metavar="N", help="Number of worker processes used to map input files.  "
+                        "Implies --stream", type=int, default=1)
+    parser.add_argument("--fetchers", metavar="N", help="Maximum number of URL inputs downloaded at once",
+                        type=int, default=4)
+    parser.add_argument("--checkpoint", metavar="FILE", help="Record load progress in FILE and resume from it.  "
+                        "Implies --stream and --dupcheck")
+    parser.add_argument("--native", help="Convert JSON input by walking the parsed JSON directly rather than through "
+                        "fhirtordf", action="store_true")
+    parser.add_argument("--rebuild-cache", help="Parse the FHIR metadata vocabulary even if a cached image exists",
+                        action="store_true")
     return add_common_parameters(parser)
 
 
@@ -99,7 +399,7 @@ def genargs(argv: List[str]) -> Optional[Namespace]:
     :param argv: input arguments
     :return: options if success or None of parameters aren't valid
     """
-    parser = add_connection_args(create_parser())
+    parser = add_pool_args(add_connection_args(create_parser()))
     opts = parser.parse_args(parser.decode_file_args(argv))
     if opts.version:
         print("FHIR i2b2 CRC loader -- Version {}".format(__version__))
@@ -107,12 +407,35 @@ def genargs(argv: List[str]) -> Optional[Namespace]:
         parser.error("Either load option (-l) or output directory must be specified")
     if not (opts.infile or opts.indir or opts.version):
         parser.error("Either a list of input files or input directory must be supplied")
+    if opts.workers < 1:
+        parser.error("Number of workers must be at least 1")
+    if opts.fetchers < 1:
+        parser.error("Number of fetchers must be at least 1")
+    if opts.poolsize < 1:
+        parser.error("Pool size must be at least 1")
+    if opts.checkpoint:
+        if not opts.load or opts.outdir:
+            parser.error("Checkpoints are only implemented for the LOAD option without an output directory")
+        if opts.workers > 1:
+            parser.error("Checkpoints can't be used with multiple workers")
+        if opts.remove:
+            # The existing upload is only replaced when the load completes, so there is nothing to resume from
+            parser.error("Checkpoints can't be used with the remove option")
+        # A resumed page is loaded from its start, so records loaded ahead of the interruption are presented again
+        opts.stream = True
+        opts.dupcheck = True
+    if opts.dupcheck:
+        # Duplicates are resolved against the existing tables as a set, through the --bulk staging table
+        opts.bulk = True
     if opts.remove and not opts.load:
         parser.error("Remove existing upload id only implemented for LOAD option")
     if opts.infile:
         for fn in opts.infile:
-            if '://' not in fn and not (fn.endswith('.ttl') or fn.endswith(".json")):
+            if '://' not in fn and not (fn.endswith('.ttl') or fn.endswith(".json") or is_ndjson(fn)):
                 parser.error("Unrecognized file type: {}".format(fn))
+    if opts.filetype == 'ndjson' or (opts.infile and any(is_ndjson(fn) for fn in opts.infile)):
+        # NDJSON files can be arbitrarily large, so they are always read in batches
+        opts.stream = True
     if opts.load or opts.outdir:
         if not opts.uploadid:
             # TODO: find a more rational way to do this
@@ -124,7 +447,8 @@ def genargs(argv: List[str]) -> Optional[Namespace]:
         if opts.outdir and not opts.outdir.endswith(os.sep):
             opts.outdir = os.path.join(opts.outdir, '')
         if opts.load:
-            process_parsed_args(opts, parser.error)
+            process_parsed_args(opts, parser.error, connect=False)
+            opts.tables = shared_tables(opts)
         I2B2Core.sourcesystem_cd = opts.sourcesystem
         I2B2CoreWithUploadId.upload_id = opts.uploadid
         return opts
@@ -149,7 +473,7 @@ def load_graph_map(opts: Namespace) -> Optional[I2B2GraphMap]:
     :param opts: input options
     :return: I2B2GraphMap if success otherwise None
     """
-    opts.tables = I2B2Tables(opts) if opts.load else None
+    opts.tables = shared_tables(opts) if opts.load else None
     print("upload_id: {}".format(opts.uploadid))
     if opts.tables:
         print("  Starting encounter number: {}"
@@ -158,6 +482,10 @@ def load_graph_map(opts: Namespace) -> Optional[I2B2GraphMap]:
         print("  Starting patient number: {}"
               .format(FHIRPatientMapping.refresh_patient_number_generator(opts.tables,
                                                                           opts.uploadid if opts.remove else None)))
+    if opts.workers > 1:
+        return parallel_graph_map(opts)
+    if opts.stream:
+        return stream_graph_map(opts)
     g = load_rdf_graph(opts)
     if g:
         update_dt = datetime.now()
@@ -168,6 +496,174 @@ def load_graph_map(opts: Namespace) -> Optional[I2B2GraphMap]:
     return None
 
 
+def flush_graph_map(opts: Namespace, i2b2_map: I2B2GraphMap, force: bool = False) -> None:
+    """
+    Flush the records accumulated in i2b2_map once it passes its flush threshold -- into the database if we are
+    loading tables or into the tsv spools if we are generating files.  (Records are retained if we are doing both.)
+    :param opts: input options
+    :param i2b2_map: map being built
+    :param force: flush regardless of the threshold
+    """
+    if i2b2_map.num_pending_records() >= (1 if force else i2b2_map.flush_threshold):
+        if opts.load and not opts.outdir:
+            i2b2_map.flush_i2b2_tables(opts.dupcheck)
+        elif opts.outdir and not opts.load:
+            i2b2_map.flush_tsv_records()
+
+
+def stream_graph_map(opts: Namespace) -> I2B2GraphMap:
+    """
+    Map the input URI(s) and/or file(s) one graph at a time.  The accumulated records are flushed whenever the map
+    passes its flush threshold (see ``flush_graph_map``), so memory use is bounded by the threshold rather than by
+    the size of the input.
+    :param opts: input options
+    :return: I2B2GraphMap carrying the records that have not yet been flushed
+    """
+    update_dt = datetime.now()
+    I2B2Core.update_date = datetime(update_dt.year, update_dt.month, update_dt.day, update_dt.hour, update_dt.minute)
+    i2b2_map = I2B2GraphMap(None, opts)
+    checkpoint = CrawlCheckpoint(opts.checkpoint, lambda: flush_graph_map(opts, i2b2_map, force=True)) \
+        if opts.checkpoint else None
+    num_triples = 0
+    try:
+        for g in stream_rdf_graphs(opts, checkpoint=checkpoint):
+            num_triples += len(g)
+            i2b2_map.add_graph(g)
+            flush_graph_map(opts, i2b2_map)
+        i2b2_map.map_queued_graphs()
+    except BaseException:
+        # Records flushed while replacing an upload (-rm) must not outlive a failed load
+        i2b2_map.rollback_replacement()
+        raise
+    print("{} triples".format(num_triples))
+    print("---> Graph map phase complete")
+    return i2b2_map
+
+
+# Per process state for parallel_graph_map workers
+_worker_opts = None                 # type: Optional[Namespace]
+_worker_metavoc = None              # type: Optional[Graph]
+_worker_mapper = None               # type: Optional[FHIRJSONMapper]
+_worker_spool_dir = None            # type: Optional[str]
+
+
+def _init_worker(opts: Namespace, update_date: datetime, spool_dir: str, flush_threshold: int) -> None:
+    """
+    Initialize a parallel_graph_map worker process
+    :param opts: input options, less the database connection.  Workers generate records only -- they never touch
+    the database
+    :param update_date: update_date to use in generated records
+    :param spool_dir: directory that the parts of a mapped file are written to
+    :param flush_threshold: number of pending records at which a worker writes out a part
+    """
+    global _worker_opts, _worker_metavoc, _worker_mapper, _worker_spool_dir
+    _worker_opts = opts
+    _worker_metavoc = fhir_metavoc(opts.metadatavoc)
+    _worker_mapper = FHIRJSONMapper(_worker_metavoc) if opts.native else None
+    _worker_spool_dir = spool_dir
+    I2B2GraphMap.flush_threshold = flush_threshold
+    I2B2Core.update_date = update_date
+    I2B2Core.sourcesystem_cd = opts.sourcesystem
+    I2B2CoreWithUploadId.upload_id = opts.uploadid
+
+
+def _spool_graph_map(i2b2_map: I2B2GraphMap) -> str:
+    """ Write a part of a worker's output to the spool directory, returning the name of the file it is in """
+    with NamedTemporaryFile(dir=_worker_spool_dir, suffix='.pickle', delete=False) as f:
+        pickle.dump(i2b2_map, f, pickle.HIGHEST_PROTOCOL)
+    return f.name
+
+
+def _read_spooled_graph_map(fname: str) -> I2B2GraphMap:
+    """ Read (and remove) a part written by ``_spool_graph_map`` """
+    try:
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        os.remove(fname)
+
+
+def map_input_file(filepath: str) -> Tuple[int, List[str], I2B2GraphMap, Dict[str, Tuple[int, int]]]:
+    """
+    Map a single input file in a worker process.  Patient and encounter numbers are private to the file and are
+    replaced when the result is merged (see ``I2B2GraphMap.merge``).  Whenever the map passes its flush threshold,
+    the records are written to the spool directory and a new map is started, so the memory that a worker uses is
+    bounded by the threshold rather than by the size of the file.
+    :param filepath: name or URL of the file to map
+    :return: number of triples, names of the spooled parts in order, map carrying the rest of the records, concept
+    cache hits and misses while mapping the file
+    """
+    start_counts = cache_counts()
+    FHIRPatientMapping._clear()
+    FHIREncounterMapping._clear()
+    file_opts = Namespace(**vars(_worker_opts))
+    file_opts.infile = [filepath]
+    file_opts.indir = None
+    i2b2_map = I2B2GraphMap(None, file_opts)
+    spooled_parts = []
+    num_triples = 0
+    with redirect_stdout(StringIO()):
+        for g in stream_rdf_graphs(file_opts, _worker_metavoc, _worker_mapper):
+            num_triples += len(g)
+            i2b2_map.add_graph(g)
+            if i2b2_map.num_pending_records() >= i2b2_map.flush_threshold:
+                spooled_parts.append(_spool_graph_map(i2b2_map))
+                i2b2_map = I2B2GraphMap(None, file_opts)
+    return num_triples, spooled_parts, i2b2_map, \
+        {name: (hits - start_counts[name][0], misses - start_counts[name][1])
+         for name, (hits, misses) in cache_counts().items()}
+
+
+def parallel_graph_map(opts: Namespace) -> I2B2GraphMap:
+    """
+    Map the input URI(s) and/or file(s) using opts.workers processes.  Each file is mapped independently and the
+    results are merged in input order, so patient and encounter numbers are assigned exactly as they would be by
+    ``stream_graph_map``.  No more than two files per worker are in progress or waiting to be merged at any one time,
+    and each file comes back in parts of at most the flush threshold records.  As with streaming, records are flushed
+    once the flush threshold is passed.
+    :param opts: input options
+    :return: I2B2GraphMap carrying the records that have not yet been flushed
+    """
+    update_dt = datetime.now()
+    I2B2Core.update_date = datetime(update_dt.year, update_dt.month, update_dt.day, update_dt.hour, update_dt.minute)
+    i2b2_map = I2B2GraphMap(None, opts)
+    filepaths = iter([fname if '://' in fname else os.path.join(dirname, fname)
+                      for dirname, fname in input_files(opts)])
+    # Refresh the metavocabulary cache up front so the workers don't all parse (and cache) fhir.ttl at once
+    fhir_metavoc(opts.metadatavoc, rebuild_cache=opts.rebuild_cache)
+    worker_opts = Namespace(**vars(opts))
+    worker_opts.tables = None
+    num_triples = 0
+    try:
+        with TemporaryDirectory() as spool_dir, \
+                ProcessPoolExecutor(opts.workers, initializer=_init_worker,
+                                    initargs=(worker_opts, I2B2Core.update_date, spool_dir,
+                                              I2B2GraphMap.flush_threshold)) as executor:
+            in_progress = deque((filepath, executor.submit(map_input_file, filepath))
+                                for filepath in islice(filepaths, 2 * opts.workers))
+            while in_progress:
+                filepath, future = in_progress.popleft()
+                file_triples, spooled_parts, file_map, file_cache_counts = future.result()
+                next_filepath = next(filepaths, None)
+                if next_filepath is not None:
+                    in_progress.append((next_filepath, executor.submit(map_input_file, next_filepath)))
+                renumber_maps = ({}, {})
+                nresources = 0
+                for part in chain((_read_spooled_graph_map(fname) for fname in spooled_parts), [file_map]):
+                    nresources += part._nresources
+                    i2b2_map.merge(part, renumber_maps)
+                    flush_graph_map(opts, i2b2_map)
+                print("--> loaded {} ({} resources)".format(filepath, nresources))
+                num_triples += file_triples
+                add_cache_counts(file_cache_counts)
+    except BaseException:
+        i2b2_map.rollback_replacement()
+        raise
+    print("{} triples".format(num_triples))
+    print("---> Graph map phase complete")
+    return i2b2_map
+
+
 def load_facts(argv: List[str]) -> bool:
     """
     Convert a set of FHIR resources into their corresponding i2b2 counterparts.
@@ -182,11 +678,19 @@ def load_facts(argv: List[str]) -> bool:
         if not i2b2_map:
             return False
         else:
-            print(i2b2_map.summary())
-            if opts.outdir:
-                i2b2_map.generate_tsv_files()
-            if opts.load:
-                i2b2_map.load_i2b2_tables(opts.dupcheck)
+            try:
+                print(i2b2_map.summary())
+                print(i2b2_map.resource_stats())
+                print(cache_stats())
+                if opts.outdir:
+                    i2b2_map.generate_tsv_files()
+                if opts.load:
+                    i2b2_map.load_i2b2_tables(opts.dupcheck)
+            except BaseException:
+                i2b2_map.rollback_replacement()
+                raise
+            if opts.checkpoint and os.path.exists(opts.checkpoint):
+                os.remove(opts.checkpoint)
             return True
 
 
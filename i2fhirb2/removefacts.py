@@ -2,13 +2,14 @@ import sys
 from argparse import Namespace
 from typing import List, Tuple, Optional
 
-from sqlalchemy import Table, delete
+from sqlalchemy import Table, select
 from sqlalchemy.engine import Connection
-from sqlalchemy.orm import sessionmaker, Session
 
 from i2fhirb2.common_cli_parameters import add_common_parameters
 from i2b2model.sqlsupport.file_aware_parser import FileAwareParser
+from i2fhirb2.loaders.i2b2bulkloader import chunked_delete, DeleteProgress, DELETE_CHUNK_SIZE
 from i2fhirb2.loaders.i2b2graphmap import I2B2GraphMap
+from i2fhirb2.sharedtables import add_pool_args, shared_tables
 from i2b2model.sqlsupport.dbconnection import add_connection_args, process_parsed_args, I2B2Tables
 
 
@@ -19,9 +20,11 @@ def create_parser() -> FileAwareParser:
     """
     parser = FileAwareParser(description="Clear data from FHIR observation fact table", prog="removefacts",
                              use_defaults=False)
-    add_connection_args(add_common_parameters(parser, multi_upload_ids=True), strong_config_file=False)
+    add_pool_args(add_connection_args(add_common_parameters(parser, multi_upload_ids=True), strong_config_file=False))
     parser.add_argument("--testlist", help="List leftover test suite entries", action="store_true")
     parser.add_argument("--removetestlist", help="Remove leftover test suite entries", action="store_true")
+    parser.add_argument("--chunksize", metavar="N", help="Number of rows deleted (and committed) at a time",
+                        type=int, default=DELETE_CHUNK_SIZE)
     return parser
 
 
@@ -32,8 +35,8 @@ def sourcesystem_test_query(c: Connection, t: Table) -> List[Tuple[Table, str]]:
     :param t: Table
     :return: list of elements
     """
-    q = c.query(t.c.sourcesystem_cd).filter(t.c.sourcesystem_cd.startswith('test_i2FHIRb2_')).distinct()
-    return [(t, e[0]) for e in q.all()]
+    q = select([t.c.sourcesystem_cd]).where(t.c.sourcesystem_cd.startswith('test_i2FHIRb2_')).distinct()
+    return [(t, e[0]) for e in c.execute(q)]
 
 
 def list_test_artifacts(opts: Optional[Namespace], tables: Optional[I2B2Tables]=None) -> List[Tuple[Table, str]]:
@@ -44,14 +47,14 @@ def list_test_artifacts(opts: Optional[Namespace], tables: Optional[I2B2Tables]=
     :return: List 
     """
     if tables is None:
-        tables = I2B2Tables(opts)
-    session = sessionmaker(bind=tables.crc_engine)()
-    qr = sourcesystem_test_query(session, tables.patient_dimension)
-    qr += sourcesystem_test_query(session, tables.patient_mapping)
-    qr += sourcesystem_test_query(session, tables.visit_dimension)
-    qr += sourcesystem_test_query(session, tables.encounter_mapping)
-    qr += sourcesystem_test_query(session, tables.provider_dimension)
-    qr += sourcesystem_test_query(session, tables.observation_fact)
+        tables = shared_tables(opts)
+    conn = tables.crc_connection
+    qr = sourcesystem_test_query(conn, tables.patient_dimension)
+    qr += sourcesystem_test_query(conn, tables.patient_mapping)
+    qr += sourcesystem_test_query(conn, tables.visit_dimension)
+    qr += sourcesystem_test_query(conn, tables.encounter_mapping)
+    qr += sourcesystem_test_query(conn, tables.provider_dimension)
+    qr += sourcesystem_test_query(conn, tables.observation_fact)
     if qr:
         print('\n'.join(f"TABLE: {e[1]} \t: {e[0]}" for e in qr))
     return qr
@@ -63,11 +66,11 @@ def remove_test_artifacts(opts: Namespace):
     :param opts: 
     :return: 
     """
-    tables = I2B2Tables(opts)
+    tables = shared_tables(opts)
     artifacts_list = list_test_artifacts(opts, tables)
     for table, ss_cd in artifacts_list:
-        q = delete(table).where(table.c.sourcesystem_cd == ss_cd)
-        ndel = opts.tables.crc_connection.execute(q).rowcount
+        ndel = chunked_delete(tables.crc_connection, table, table.c.sourcesystem_cd == ss_cd,
+                              opts.chunksize, True, DeleteProgress(str(table)))
         print(f"{ndel} rows removed from {table}")
     return True
 
@@ -90,15 +93,20 @@ def remove_facts(argv: List[str]) -> bool:
     opts.uploadid = local_opts.uploadid
     opts.sourcesystem = local_opts.sourcesystem
 
-    process_parsed_args(opts, parser.error)           # Update CRC and Meta table connection information
+    process_parsed_args(opts, parser.error, connect=False)     # Update CRC and Meta table connection information
+    if opts.chunksize < 1:
+        parser.error("Chunk size must be at least 1")
+    if opts.poolsize < 1:
+        parser.error("Pool size must be at least 1")
+    opts.tables = shared_tables(opts)
 
     if opts.uploadid:
         for uploadid in opts.uploadid:
             print("---> Removing entries for id {}".format(uploadid))
-            I2B2GraphMap.clear_i2b2_tables(I2B2Tables(opts), uploadid)
+            I2B2GraphMap.clear_i2b2_tables(opts.tables, uploadid, opts.chunksize, commit=True)
     if opts.sourcesystem:
         print("---> Removing entries for sourcesystem_cd {}".format(opts.sourcesystem))
-        I2B2GraphMap.clear_i2b2_sourcesystems(I2B2Tables(opts), opts.sourcesystem)
+        I2B2GraphMap.clear_i2b2_sourcesystems(opts.tables, opts.sourcesystem, opts.chunksize, commit=True)
     if opts.testlist:
         print("---> Listing orphan test elements in database")
         list_test_artifacts(opts)
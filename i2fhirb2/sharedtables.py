@@ -0,0 +1,120 @@
+from argparse import Namespace
+from typing import Dict, Tuple, Any
+
+from i2b2model.sqlsupport.dbconnection import I2B2Tables
+from i2b2model.sqlsupport.file_aware_parser import FileAwareParser
+from sqlalchemy import MetaData, create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+
+DEFAULT_POOL_SIZE = 5
+
+
+def add_pool_args(parser: FileAwareParser) -> FileAwareParser:
+    """
+    Add the connection pool arguments to the supplied parser
+    :param parser: parser to add arguments to
+    :return: parser
+    """
+    parser.add_argument("--poolsize", metavar="N", help="Database connection pool size", type=int,
+                        default=DEFAULT_POOL_SIZE)
+    parser.add_argument("--nopreping", dest="preping", help="Don't test pooled connections before they are used",
+                        action="store_false")
+    return parser
+
+
+def engine_args(url: str, pool_size: int, pre_ping: bool) -> Dict[str, Any]:
+    """
+    Return the create_engine pool arguments for url.  The pool size only applies to the pools that hold connections
+    (e.g. not the SQLite file database NullPool)
+    :param url: database URL
+    :param pool_size: maximum number of pooled connections
+    :param pre_ping: test connections as they are checked out of the pool
+    :return: create_engine keyword arguments
+    """
+    args = dict(pool_pre_ping=pre_ping)
+    parsed_url = make_url(url)
+    if issubclass(parsed_url.get_dialect().get_pool_class(parsed_url), (QueuePool, SingletonThreadPool)):
+        args['pool_size'] = pool_size
+    return args
+
+
+class PooledI2B2Tables(I2B2Tables):
+    """
+    I2B2Tables with configurable connection pools.  Use ``shared_tables`` rather than constructing one directly, so
+    the engines, connections and reflected tables are shared by every consumer in the process.
+    """
+    def __init__(self, opts: Namespace, pool_size: int = DEFAULT_POOL_SIZE, pre_ping: bool = True) -> None:
+        """
+        Connect to the crc and ontology databases and reflect their tables
+        :param opts: connection options (see ``add_connection_args``)
+        :param pool_size: maximum number of pooled connections per engine
+        :param pre_ping: test connections as they are checked out of the pool
+        """
+        # This follows I2B2Tables.__init__, which has no way to pass arguments to create_engine, except that the
+        # tables are reflected through the connections rather than through additional pooled connections
+        _metadata = MetaData()
+        crc_url, ont_url = self._db_urls(opts)
+
+        self.crc_engine = create_engine(crc_url, **engine_args(crc_url, pool_size, pre_ping))
+        self.crc_connection = self.crc_engine.connect()
+        _metadata.reflect(bind=self.crc_connection, schema=self.i2b2crc)
+        self._crc_tables = _metadata.tables
+        if ont_url != crc_url:
+            self.ont_engine = create_engine(ont_url, **engine_args(ont_url, pool_size, pre_ping))
+            self.ont_connection = self.ont_engine.connect()
+        else:
+            self.ont_engine = self.crc_engine
+            self.ont_connection = self.crc_connection
+
+        _metadata.reflect(bind=self.ont_connection, schema=self.i2b2metadata)
+        self._ont_tables = _metadata.tables
+
+    def discard_transactions(self) -> None:
+        """
+        Replace any connection that has been left in a transaction (e.g. by a load that failed part way through) with
+        a new one.  Closing the abandoned connection rolls its transaction back.
+        """
+        same_connection = self.ont_connection is self.crc_connection
+        if self.crc_connection.in_transaction():
+            self.crc_connection.close()
+            self.crc_connection = self.crc_engine.connect()
+        if same_connection:
+            self.ont_connection = self.crc_connection
+        elif self.ont_connection.in_transaction():
+            self.ont_connection.close()
+            self.ont_connection = self.ont_engine.connect()
+
+    def close(self) -> None:
+        """ Close the connections and release the pooled ones """
+        for conn in {self.crc_connection, self.ont_connection}:
+            conn.close()
+        for engine in {self.crc_engine, self.ont_engine}:
+            engine.dispose()
+
+
+# Process wide tables, by (crc url, ontology url)
+_shared_tables = {}                 # type: Dict[Tuple[str, str], PooledI2B2Tables]
+
+
+def shared_tables(opts: Namespace) -> I2B2Tables:
+    """
+    Return the tables for the databases named in opts, connecting and reflecting the first time they are asked for.
+    The pool settings are taken from the first request.  Work left uncommitted by an earlier consumer is rolled back
+    rather than handed on.
+    :param opts: connection options (see ``add_connection_args`` and ``add_pool_args``)
+    :return: tables shared by every consumer of the same databases
+    """
+    key = I2B2Tables._db_urls(opts)
+    if key not in _shared_tables:
+        _shared_tables[key] = PooledI2B2Tables(opts, getattr(opts, 'poolsize', DEFAULT_POOL_SIZE),
+                                               getattr(opts, 'preping', True))
+    else:
+        _shared_tables[key].discard_transactions()
+    return _shared_tables[key]
+
+
+def close_shared_tables() -> None:
+    """ Close every set of shared tables """
+    while _shared_tables:
+        _shared_tables.popitem()[1].close()
@@ -1,6 +1,18 @@
 import os
-from typing import List
+import pickle
+from heapq import merge
+from itertools import islice
+from tempfile import TemporaryFile
+from typing import List, Iterable, Iterator, IO, Any
+
 from dynprops import row, DynProps
+from i2b2model.data.i2b2observationfact import ObservationFact
+
+SORT_CHUNK_SIZE = 100000        # Number of records sorted in memory before being spilled to disk
+PICKLE_BATCH_SIZE = 1000        # Number of records pickled per dump in a spill file
+WRITE_BUFFER_SIZE = 1 << 20     # Output buffer size
+
+_esc_table = str.maketrans('', '', '\r\n')
 
 
 def esc_output(txt: str) -> str:
@@ -9,16 +21,123 @@ def esc_output(txt: str) -> str:
     :param txt:
     :return:
     """
-    return txt.replace('\r\n', '').replace('\r', '').replace('\n', '')
+    return txt.translate(_esc_table)
+
+
+class _Ordered:
+    """ Sort key for records with their own ordering.  Only ``__lt__`` is delegated to the record. """
+    __slots__ = ['record']
+
+    def __init__(self, record: DynProps) -> None:
+        self.record = record
+
+    def __lt__(self, other: "_Ordered") -> bool:
+        return self.record < other.record
+
+
+def sort_key(record: DynProps) -> Any:
+    """
+    Return a key that orders records the same way as their ``__lt__`` method.  Computing the key once per record is
+    much cheaper than evaluating ``pk`` or ``row()`` on every comparison.
+    :param record: record to generate key for
+    :return: sort key
+    """
+    lt = type(record).__lt__
+    if lt is ObservationFact.__lt__:
+        return record.pk
+    if lt is DynProps.__lt__:
+        return row(record)
+    return _Ordered(record)
+
+
+class RecordSpool:
+    """
+    Disk backed collection of records that can be iterated over in sorted order.  Records are sorted in chunks of
+    ``chunk_size`` which are pickled to temporary files, and are merged when the spool is read, so no more than
+    one chunk is in memory at a time.  The order is the same as that of ``sorted()`` over all of the records.
+    """
+    def __init__(self, chunk_size: int = SORT_CHUNK_SIZE) -> None:
+        self._chunk_size = chunk_size
+        self._spill_files = []          # type: List[IO]
+        self._pending = []              # type: List[DynProps]
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, values: Iterable[DynProps]) -> None:
+        """
+        Add values to the spool, spilling full chunks to disk
+        :param values: records to add
+        """
+        values = iter(values)
+        while True:
+            chunk = list(islice(values, self._chunk_size - len(self._pending)))
+            if not chunk:
+                break
+            self._pending += chunk
+            self._len += len(chunk)
+            if len(self._pending) >= self._chunk_size:
+                self._spill()
+
+    def _spill(self) -> None:
+        self._pending.sort(key=sort_key)
+        spill_file = TemporaryFile()
+        for pos in range(0, len(self._pending), PICKLE_BATCH_SIZE):
+            pickle.dump(self._pending[pos:pos + PICKLE_BATCH_SIZE], spill_file, pickle.HIGHEST_PROTOCOL)
+        self._spill_files.append(spill_file)
+        self._pending = []
+
+    @staticmethod
+    def _read_spill(spill_file: IO) -> Iterator[DynProps]:
+        spill_file.seek(0)
+        try:
+            while True:
+                yield from pickle.load(spill_file)
+        except EOFError:
+            pass
+        finally:
+            spill_file.close()
+
+    def __iter__(self) -> Iterator[DynProps]:
+        """ Return the records in sorted order.  The spool can only be read once. """
+        self._pending.sort(key=sort_key)
+        if not self._spill_files:
+            return iter(self._pending)
+        return merge(*[self._read_spill(f) for f in self._spill_files], self._pending, key=sort_key)
 
 
-def write_tsv(filedir: str, file: str, hdr: str, values: List[DynProps]) -> bool:
+def external_sort(values: Iterable[DynProps], chunk_size: int = SORT_CHUNK_SIZE) -> Iterator[DynProps]:
+    """
+    Sort values without holding more than chunk_size of them in memory
+    :param values: records to sort
+    :param chunk_size: maximum number of records to sort in memory
+    :return: records in sorted order
+    """
+    spool = RecordSpool(chunk_size)
+    spool.add(values)
+    return iter(spool)
+
+
+def write_tsv(filedir: str, file: str, hdr: str, values: Iterable[DynProps], sort: bool = False) -> bool:
+    """
+    Write values to a tsv file.  values can be any iterable, which is consumed as it is written.
+    :param filedir: output directory
+    :param file: output file name.  '.tsv' is added if there is no suffix
+    :param hdr: file header
+    :param values: records to write
+    :param sort: True means write the records in sorted order.  Sorting uses an external merge sort, so memory use
+    is bounded by SORT_CHUNK_SIZE rather than by the number of records
+    :return: success indicator
+    """
     ofn = filedir + file + ('.tsv' if '.' not in file else '')
     os.makedirs(os.path.dirname(ofn), exist_ok=True)
     print("writing {}".format(ofn), end="")
-    with open(ofn, 'w') as outf:
+    nrecords = 0
+    with open(ofn, 'w', buffering=WRITE_BUFFER_SIZE) as outf:
         outf.write(hdr + '\n')
-        for e in sorted(values):
+        for e in (external_sort(values) if sort else values):
             outf.write(esc_output(row(e)) + '\n')
-    print(" ({}) records written".format(len(values)))
+            nrecords += 1
+    print(" ({}) records written".format(nrecords))
     return True
@@ -0,0 +1,341 @@
+import os
+import unittest
+from argparse import Namespace
+from contextlib import redirect_stdout
+from datetime import datetime
+from io import StringIO
+
+from dynprops import heading
+from i2b2model.data.i2b2encountermapping import EncounterMapping
+from i2b2model.data.i2b2observationfact import ObservationFact, ObservationFactKey
+from i2b2model.data.i2b2patientdimension import PatientDimension
+from i2b2model.data.i2b2patientmapping import PatientMapping, PatientIDEStatus
+from i2b2model.data.i2b2visitdimension import VisitDimension
+from i2b2model.shared.i2b2core import I2B2Core, I2B2CoreWithUploadId
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer, DateTime, Float, select, func, event
+from sqlalchemy.exc import StatementError
+
+from i2fhirb2.loaders import i2b2bulkloader
+from i2fhirb2.loaders.i2b2bulkloader import bulk_add_or_update_records, copy_value, chunked_delete, DeleteProgress
+from i2fhirb2.loaders.i2b2graphmap import I2B2GraphMap
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+from i2fhirb2.loadfacts import genargs, stream_graph_map
+from tests.utils.fhir_graph import test_data_directory
+
+column_types = {'patient_num': Integer, 'encounter_num': Integer, 'instance_num': Integer, 'upload_id': Integer,
+                'nval_num': Float, 'quantity_num': Float, 'confidence_num': Float,
+                'start_date': DateTime, 'end_date': DateTime, 'update_date': DateTime, 'download_date': DateTime,
+                'import_date': DateTime}
+
+
+def sqlite_table(metadata: MetaData, name: str, cls) -> Table:
+    """ Create a (SQLite) table with the columns of the supplied i2b2 class """
+    return Table(name, metadata, *[Column(c, column_types.get(c, String)) for c in heading(cls).split('\t')])
+
+
+class BulkLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        self.patient_mapping = sqlite_table(metadata, 'patient_mapping', PatientMapping)
+        self.observation_fact = sqlite_table(metadata, 'observation_fact', ObservationFact)
+        metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        I2B2Core.update_date = datetime(2017, 5, 25)
+        I2B2Core.sourcesystem_cd = "BULK_TEST"
+        I2B2CoreWithUploadId.upload_id = 117
+
+    def tearDown(self):
+        self.conn.close()
+        I2B2Core._check_dups = False
+
+    def test_copy_value(self):
+        self.assertEqual('\\N', copy_value(None))
+        self.assertEqual('a\\tb\\nc\\\\d\\r', copy_value('a\tb\nc\\d\r'))
+        self.assertEqual('2017-05-25 12:01:00', copy_value(datetime(2017, 5, 25, 12, 1)))
+        self.assertEqual('17.5', copy_value(17.5))
+
+    def test_add_and_update(self):
+        records = [PatientMapping(1, f"p{i}", PatientIDEStatus.active, "http://hl7.org/fhir", "fhir")
+                   for i in range(5)]
+        self.assertEqual((5, 0), bulk_add_or_update_records(self.conn, self.patient_mapping, PatientMapping, records))
+        self.assertEqual((0, 0), bulk_add_or_update_records(self.conn, self.patient_mapping, PatientMapping, records))
+
+        I2B2Core.update_date = datetime(2017, 6, 1)
+        I2B2Core.sourcesystem_cd = "OTHER"
+        changed = [PatientMapping(2, "p1", PatientIDEStatus.inactive, "http://hl7.org/fhir", "fhir"),
+                   PatientMapping(1, "p2", None, "http://hl7.org/fhir", "fhir"),
+                   PatientMapping(3, "p9", PatientIDEStatus.active, "http://hl7.org/fhir", "fhir")]
+        self.assertEqual((1, 1), bulk_add_or_update_records(self.conn, self.patient_mapping, PatientMapping, changed))
+
+        rows = {r.patient_ide: r for r in self.conn.execute(select([self.patient_mapping]))}
+        self.assertEqual(6, len(rows))
+        # Changed values are updated along with the update date, but the sourcesystem_cd is left alone
+        self.assertEqual((2, 'I', datetime(2017, 6, 1), 'BULK_TEST'),
+                         (rows['p1'].patient_num, rows['p1'].patient_ide_status, rows['p1'].update_date,
+                          rows['p1'].sourcesystem_cd))
+        # Null values don't overwrite existing ones
+        self.assertEqual(('A', datetime(2017, 5, 25)), (rows['p2'].patient_ide_status, rows['p2'].update_date))
+        self.assertEqual(('OTHER', datetime(2017, 6, 1)), (rows['p9'].sourcesystem_cd, rows['p9'].update_date))
+
+    def test_check_dups(self):
+        ofk = ObservationFactKey(1, 2, 'provider', datetime(2017, 5, 25, 11, 17))
+        facts = [ObservationFact(ofk, 'FHIR:Observation.status'), ObservationFact(ofk, 'FHIR:Observation.status'),
+                 ObservationFact(ofk, 'FHIR:Observation.code')]
+        facts[1].tval_char = 'final'
+        I2B2Core._check_dups = True
+        self.assertEqual((2, 0), bulk_add_or_update_records(self.conn, self.observation_fact, ObservationFact, facts))
+        self.assertEqual('final', self.conn.execute(
+            select([self.observation_fact.c.tval_char])
+            .where(self.observation_fact.c.concept_cd == 'FHIR:Observation.status')).scalar())
+
+    def test_dups_without_check(self):
+        """ Repeated keys are staged once, keeping the last record, whether or not they are being checked for """
+        ofk = ObservationFactKey(1, 2, 'provider', datetime(2017, 5, 25, 11, 17))
+        facts = [ObservationFact(ofk, 'FHIR:Observation.status') for _ in range(3)]
+        for fact, status in zip(facts, ('preliminary', 'final', 'amended')):
+            fact.tval_char = status
+        output = StringIO()
+        with redirect_stdout(output):
+            self.assertEqual((1, 0), bulk_add_or_update_records(self.conn, self.observation_fact, ObservationFact,
+                                                                facts[:2]))
+            self.assertEqual((0, 1), bulk_add_or_update_records(self.conn, self.observation_fact, ObservationFact,
+                                                                facts[1:] + facts[:1]))
+        self.assertEqual("", output.getvalue())
+        self.assertEqual([('preliminary', )], self.conn.execute(select([self.observation_fact.c.tval_char])).fetchall())
+
+    def test_dups_against_table(self):
+        """ A reload with duplicate checking resolves the batch against the table as a set """
+        facts = []
+        for patient_num in range(1, 51):
+            ofk = ObservationFactKey(patient_num, 2, 'provider', datetime(2017, 5, 25, 11, 17))
+            facts += [ObservationFact(ofk, 'FHIR:Observation.status'), ObservationFact(ofk, 'FHIR:Observation.code')]
+        I2B2Core._check_dups = True
+        self.assertEqual((100, 0), bulk_add_or_update_records(self.conn, self.observation_fact, ObservationFact, facts))
+
+        # Identical records are dropped silently, records with differing values are reported.  The last of each is
+        # the one that is kept
+        reload = facts[:10] + facts[:4]
+        changed = ObservationFact(ObservationFactKey(1, 2, 'provider', datetime(2017, 5, 25, 11, 17)),
+                                  'FHIR:Observation.status')
+        changed.tval_char = 'amended'
+        reload.append(changed)
+        output = StringIO()
+        with redirect_stdout(output):
+            self.assertEqual((0, 1), bulk_add_or_update_records(self.conn, self.observation_fact, ObservationFact,
+                                                                reload))
+        self.assertEqual("5 duplicate records encountered\n"
+                         "    2 of them have values that differ from the last record with the same key\n",
+                         output.getvalue())
+        self.assertEqual(100, self.conn.execute(select([func.count()]).select_from(self.observation_fact)).scalar())
+        self.assertEqual('amended', self.conn.execute(
+            select([self.observation_fact.c.tval_char]).where(self.observation_fact.c.patient_num == 1)
+            .where(self.observation_fact.c.concept_cd == 'FHIR:Observation.status')).scalar())
+
+    def test_chunked_delete_primary_key(self):
+        """ Tables with a primary key are deleted in key order.  Rows that fall in a chunk's key range but don't match
+        the selection criteria are left alone. """
+        metadata = MetaData()
+        of = Table('observation_fact_pk', metadata,
+                   *[Column(c, column_types.get(c, String), primary_key=c in ObservationFact.key_fields)
+                     for c in heading(ObservationFact).split('\t')])
+        metadata.create_all(self.engine)
+        facts = []
+        for patient_num in range(1, 16):
+            for minute in (17, 18):
+                ofk = ObservationFactKey(patient_num, 2, 'provider', datetime(2017, 5, 25, 11, minute))
+                facts += [ObservationFact(ofk, 'FHIR:Observation.status'),
+                          ObservationFact(ofk, 'FHIR:Observation.code')]
+        bulk_add_or_update_records(self.conn, of, ObservationFact, facts)
+        self.conn.execute(of.update().where(of.c.patient_num == 2).where(of.c.concept_cd == 'FHIR:Observation.code'),
+                          upload_id=118)
+        ndeleted = []
+        self.assertEqual(58, chunked_delete(self.conn, of, of.c.upload_id == 117, chunk_size=8,
+                                            progress=ndeleted.append))
+        self.assertEqual([8, 16, 24, 32, 40, 48, 56, 58], ndeleted)
+        self.assertEqual([(2, 'FHIR:Observation.code')] * 2,
+                         self.conn.execute(select([of.c.patient_num, of.c.concept_cd])).fetchall())
+
+    def test_dupcheck_implies_bulk(self):
+        self.assertTrue(genargs(['-i', 'x.json', '-od', 'out', '--dupcheck']).bulk)
+        self.assertFalse(genargs(['-i', 'x.json', '-od', 'out']).bulk)
+
+
+class CRCTables(dict):
+    """ Minimal stand-in for I2B2Tables -- tables by name or attribute, plus the connection """
+    def __getattr__(self, item):
+        return self[item]
+
+
+class ReplaceUploadTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_replaceupload'))
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+        self.engine = create_engine("sqlite:///" + os.path.join(self.output_dir, 'crc.db'))
+        metadata = MetaData()
+        self.tables = CRCTables({name: sqlite_table(metadata, name, cls) for name, cls in
+                                 [('patient_dimension', PatientDimension), ('patient_mapping', PatientMapping),
+                                  ('visit_dimension', VisitDimension), ('encounter_mapping', EncounterMapping),
+                                  ('observation_fact', ObservationFact)]})
+        for column in (self.tables.observation_fact.c.concept_cd, self.tables.observation_fact.c.modifier_cd):
+            column.type.length = 200
+        metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self.tables['crc_connection'] = self.conn
+        # A second session, reading the tables while the upload is being replaced
+        self.reader = self.engine.connect()
+        I2B2Core.update_date = datetime(2017, 5, 25)
+        I2B2Core.sourcesystem_cd = "BULK_TEST"
+        I2B2CoreWithUploadId.upload_id = 117
+        bulk_add_or_update_records(self.conn, self.tables.observation_fact, ObservationFact,
+                                   self.facts(25, 'FHIR:Observation.status'))
+        I2B2CoreWithUploadId.upload_id = 118
+        bulk_add_or_update_records(self.conn, self.tables.observation_fact, ObservationFact,
+                                   self.facts(5, 'FHIR:Observation.subject'))
+        I2B2CoreWithUploadId.upload_id = 117
+
+    def tearDown(self):
+        self.reader.close()
+        self.conn.close()
+        self.engine.dispose()
+        make_and_clear_directory(self.output_dir)
+
+    @staticmethod
+    def facts(n: int, concept_cd: str):
+        return [ObservationFact(ObservationFactKey(patient_num, 2, 'provider', datetime(2017, 5, 25, 11, 17)),
+                                concept_cd) for patient_num in range(1, n + 1)]
+
+    @staticmethod
+    def bad_fact() -> ObservationFact:
+        """ A fact that the database won't accept -- its start_date isn't a date """
+        return ObservationFact(ObservationFactKey(1, 2, 'provider', 'not a date'), 'FHIR:Observation.code')
+
+    def upload_concepts(self, upload_id: int):
+        of = self.tables.observation_fact
+        return self.reader.execute(select([of.c.concept_cd, func.count()]).where(of.c.upload_id == upload_id)
+                                   .group_by(of.c.concept_cd)).fetchall()
+
+    def replacement_map(self) -> I2B2GraphMap:
+        i2b2_map = I2B2GraphMap(None, Namespace(tables=self.tables, remove=True, uploadid=117, bulk=True,
+                                                outdir=None, providerid='provider'))
+        i2b2_map.observation_facts = self.facts(3, 'FHIR:Observation.code')
+        return i2b2_map
+
+    def test_chunked_delete(self):
+        of = self.tables.observation_fact
+        statements = []
+
+        def record_statement(_conn, _cursor, statement, *_):
+            statements.append(statement)
+        event.listen(self.engine, "before_cursor_execute", record_statement)
+        self.assertEqual(25, chunked_delete(self.conn, of, of.c.upload_id == 117, chunk_size=10))
+        # A SELECT of the next ten keys and a DELETE of their range per chunk.  Each chunk starts past the last one.
+        self.assertEqual(6, len(statements))
+        self.assertTrue(all('LIMIT' in statement for statement in statements[::2]))
+        self.assertEqual([False, True, True], ['rowid >' in statement for statement in statements[::2]])
+        self.assertTrue(all(statement.startswith('DELETE') for statement in statements[1::2]))
+        self.assertEqual(0, chunked_delete(self.conn, of, of.c.upload_id == 117, chunk_size=10))
+        self.assertEqual([('FHIR:Observation.subject', 5)], self.upload_concepts(118))
+
+    def test_replace_upload(self):
+        """ Other sessions see the old upload until the replacement is committed """
+        i2b2_map = self.replacement_map()
+        output = StringIO()
+        with redirect_stdout(output):
+            i2b2_map.flush_i2b2_tables()
+            self.assertEqual([('FHIR:Observation.status', 25)], self.upload_concepts(117))
+            i2b2_map.observation_facts = self.facts(4, 'FHIR:Observation.code')[3:]
+            i2b2_map.load_i2b2_tables()
+        self.assertIn("Deleted 25 observation_fact records", output.getvalue())
+        self.assertIn("Upload 117 replaced", output.getvalue())
+        self.assertEqual([('FHIR:Observation.code', 4)], self.upload_concepts(117))
+        self.assertEqual([('FHIR:Observation.subject', 5)], self.upload_concepts(118))
+
+    def test_failed_replacement(self):
+        """ A load that fails leaves the old upload in place """
+        i2b2_map = self.replacement_map()
+        i2b2_map.observation_facts.append(self.bad_fact())
+        with redirect_stdout(StringIO()):
+            with self.assertRaises(StatementError):
+                i2b2_map.load_i2b2_tables()
+        self.assertEqual([('FHIR:Observation.status', 25)], self.upload_concepts(117))
+        self.assertEqual(25, self.conn.execute(select([func.count()]).select_from(self.tables.observation_fact)
+                                               .where(self.tables.observation_fact.c.upload_id == 117)).scalar())
+
+    def test_failed_flush(self):
+        """ A streaming flush that fails rolls back the records flushed before it along with the removal """
+        i2b2_map = self.replacement_map()
+        with redirect_stdout(StringIO()):
+            i2b2_map.flush_i2b2_tables()
+            i2b2_map.observation_facts = self.facts(4, 'FHIR:Observation.code')[3:] + [self.bad_fact()]
+            with self.assertRaises(StatementError):
+                i2b2_map.flush_i2b2_tables()
+        self.assertFalse(self.conn.in_transaction())
+        self.assertEqual([('FHIR:Observation.status', 25)], self.upload_concepts(117))
+
+    def test_failed_stream(self):
+        """ Input that fails to map after records have been flushed leaves the old upload in place """
+        bad_input = os.path.join(self.output_dir, 'bad.json')
+        with open(bad_input, 'w') as f:
+            f.write('{"resourceType": "Bundle", "entry": [')
+        opts = genargs(['-mv', os.path.join(test_data_directory, 'fhir_metadata_vocabulary'), '-od', self.output_dir,
+                        '-u', '117', '-t', 'json', '--stream', '--native', '--bulk', '-i',
+                        os.path.join(test_data_directory, 'synthea_data', 'fhir', 'Adams301_Keyshawn30_74.json'),
+                        bad_input])
+        opts.load, opts.outdir, opts.remove, opts.tables = True, None, True, self.tables
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+        saved_threshold, I2B2GraphMap.flush_threshold = I2B2GraphMap.flush_threshold, 1
+        try:
+            output = StringIO()
+            with redirect_stdout(output):
+                with self.assertRaises(ValueError):
+                    stream_graph_map(opts)
+        finally:
+            I2B2GraphMap.flush_threshold = saved_threshold
+            FHIRPatientMapping._clear()
+            FHIREncounterMapping._clear()
+        self.assertIn("Deleted 25 observation_fact records", output.getvalue())
+        self.assertFalse(self.conn.in_transaction())
+        self.assertEqual([('FHIR:Observation.status', 25)], self.upload_concepts(117))
+
+    def test_interrupted_delete(self):
+        """ Committed chunks stay deleted when a delete is interrupted, and running it again finishes the job """
+        of = self.tables.observation_fact
+
+        def interrupt(ndeleted: int) -> None:
+            if ndeleted >= 20:
+                raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            chunked_delete(self.conn, of, of.c.upload_id == 117, chunk_size=10, commit=True, progress=interrupt)
+        self.assertEqual([('FHIR:Observation.status', 5)], self.upload_concepts(117))
+        self.assertEqual(5, chunked_delete(self.conn, of, of.c.upload_id == 117, chunk_size=10, commit=True))
+        self.assertEqual([], self.upload_concepts(117))
+
+    def test_clear_sourcesystem(self):
+        output = StringIO()
+        with redirect_stdout(output):
+            I2B2GraphMap.clear_i2b2_sourcesystems(self.tables, "BULK_TEST", chunk_size=7, commit=True)
+        self.assertIn("Deleted 30 observation_fact records", output.getvalue())
+        self.assertEqual([], self.upload_concepts(118))
+
+    def test_delete_progress(self):
+        saved_interval, i2b2bulkloader.PROGRESS_INTERVAL = i2b2bulkloader.PROGRESS_INTERVAL, 0
+        try:
+            output = StringIO()
+            with redirect_stdout(output):
+                of = self.tables.observation_fact
+                chunked_delete(self.conn, of, of.c.upload_id == 117, chunk_size=10, progress=DeleteProgress('facts'))
+        finally:
+            i2b2bulkloader.PROGRESS_INTERVAL = saved_interval
+        self.assertEqual(['facts: 10 rows deleted', 'facts: 20 rows deleted', 'facts: 25 rows deleted'],
+                         [line.strip().split(' (')[0] for line in output.getvalue().splitlines()])
+        self.assertTrue(output.getvalue().strip().endswith('rows/sec)'))
+
+
+if __name__ == '__main__':
+    unittest.main()
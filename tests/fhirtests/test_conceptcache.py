@@ -0,0 +1,66 @@
+import os
+import unittest
+
+from fhirtordf.rdfsupport.namespaces import FHIR, LOINC
+from rdflib import Graph, BNode, RDF
+
+from i2fhirb2.fhir.fhircodemapping import coding_concept, concept_uri_for, coding_cache
+from i2fhirb2.fhir import fhirconceptcache
+from i2fhirb2.fhir.fhirconceptcache import LRUCache, cache_counts, add_cache_counts, cache_stats
+from i2fhirb2.fhir.fhirobservationfact import FHIRObservationFact
+
+
+class ConceptCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache("test_lru", 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))         # 'b' is now the least recently used
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+        self.assertEqual((3, 1, 2), (cache.hits, cache.misses, len(cache)))
+        self.assertEqual("test_lru: 3 hits / 1 misses (75.0% hit rate, max 2 entries)", cache.stats())
+
+        add_cache_counts({"test_lru": (7, 9), "unknown": (1, 1)})
+        self.assertEqual((10, 10), cache_counts()["test_lru"])
+        self.assertIn("    test_lru: 10 hits / 10 misses (50.0% hit rate, max 2 entries)\n", cache_stats())
+        cache.clear()
+        self.assertEqual((0, 0, 0), (cache.hits, cache.misses, len(cache)))
+        del fhirconceptcache._caches["test_lru"]
+
+    def test_coding_concept(self):
+        """ Cached codings have to resolve to what concept_uri_for and ns_name_for give """
+        g = Graph()
+        g.load(os.path.join(os.path.split(os.path.abspath(__file__))[0], "data",
+                            "diagnosticreport-example-f202-bloodculture.ttl"), format="turtle")
+        FHIRObservationFact._clear()
+        codings = list(g.objects(None, FHIR.CodeableConcept.coding))
+        self.assertTrue(codings)
+        expected = []
+        for coding in codings:
+            concept_uri = concept_uri_for(g, coding)
+            expected.append((concept_uri, FHIRObservationFact.ns_name_for(concept_uri) if concept_uri else None))
+        self.assertEqual(expected, [coding_concept(g, coding) for coding in codings])
+        # Every known coding is found in the cache the second time around
+        hits = coding_cache.hits
+        self.assertEqual(expected, [coding_concept(g, coding) for coding in codings])
+        self.assertEqual(len([e for e in expected if e[1]]), coding_cache.hits - hits)
+        FHIRObservationFact._clear()
+        self.assertEqual(0, len(coding_cache))
+
+    def test_clear(self):
+        """ Clearing the NS:code cache clears the Coding cache that is built on it """
+        g = Graph()
+        coding = BNode()
+        g.add((coding, RDF.type, LOINC['1234-5']))
+        FHIRObservationFact._clear()
+        self.assertEqual((LOINC['1234-5'], 'LOINC:1234-5'), coding_concept(g, coding))
+        self.assertEqual((1, 1), (len(coding_cache), len(FHIRObservationFact._ns_names)))
+        FHIRObservationFact._clear()
+        self.assertEqual((0, 0), (len(coding_cache), len(FHIRObservationFact._ns_names)))
+        self.assertEqual((0, 0), (coding_cache.hits, coding_cache.misses))
+
+
+if __name__ == '__main__':
+    unittest.main()
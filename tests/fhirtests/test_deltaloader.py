@@ -0,0 +1,110 @@
+import unittest
+from argparse import Namespace
+from datetime import datetime
+from typing import Optional
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, MetaData, Table, Column, String, DateTime, CHAR, select
+
+from i2fhirb2.generate_i2b2 import load_in_transaction, output_concept_dimension
+from i2fhirb2.loaders.i2b2deltaloader import update_table_delta, table_delta
+
+
+def concept(path: str, name: str, sourcesystem_cd: str = 'FHIR', update_date: datetime = datetime(2017, 5, 25)) \
+        -> dict:
+    return dict(concept_path=path, concept_cd=path.replace('\\', ':'), name_char=name, update_date=update_date,
+                sourcesystem_cd=sourcesystem_cd)
+
+
+class DeltaLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        self.concept_dimension = Table('concept_dimension', metadata,
+                                       Column('concept_path', String), Column('concept_cd', String),
+                                       Column('name_char', CHAR(20)), Column('update_date', DateTime),
+                                       Column('sourcesystem_cd', String))
+        metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self.scope = self.concept_dimension.c.sourcesystem_cd == 'FHIR'
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_table_delta(self):
+        existing = [concept('\\A\\', 'a   '), concept('\\B\\', 'b'), concept('\\C\\', 'c')]
+        delta = table_delta(existing, [concept('\\A\\', 'a', update_date=datetime(2018, 1, 1)),
+                                       concept('\\B\\', 'bee'), concept('\\D\\', 'd')], ['concept_path'])
+        # Padding and update dates don't count as changes
+        self.assertEqual((['\\D\\'], ['\\B\\'], [('\\C\\', )], 1),
+                         ([r['concept_path'] for r in delta.inserts], [r['concept_path'] for r in delta.updates],
+                          delta.deletes, delta.unchanged))
+
+    def test_padded_keys(self):
+        """ Keys from CHAR columns are padded -- they still have to match the records """
+        existing = [concept('\\A\\   ', 'a'), concept('\\B\\  ', 'b')]
+        delta = table_delta(existing, [concept('\\A\\', 'a'), concept('\\C\\', 'c')], ['concept_path'])
+        self.assertEqual((['\\C\\'], [], [('\\B\\  ', )], 1),
+                         ([r['concept_path'] for r in delta.inserts], delta.updates, delta.deletes, delta.unchanged))
+
+    def test_update_table_delta(self):
+        self.conn.execute(self.concept_dimension.insert(),
+                          [concept('\\A\\', 'a'), concept('\\B\\', 'b'), concept('\\C\\', 'c'),
+                           concept('\\C\\', 'c', 'OTHER')])
+        new_date = datetime(2018, 1, 1)
+        delta = update_table_delta(self.conn, self.concept_dimension, self.scope, ['concept_path'],
+                                   [concept('\\A\\', 'a', update_date=new_date),
+                                    concept('\\B\\', 'bee', update_date=new_date),
+                                    concept('\\D\\', 'd', update_date=new_date)])
+        self.assertEqual((1, 1, 1, 1), (len(delta.inserts), len(delta.updates), len(delta.deletes), delta.unchanged))
+
+        rows = {(r.concept_path, r.sourcesystem_cd): r
+                for r in self.conn.execute(select([self.concept_dimension]))}
+        self.assertEqual([('\\A\\', 'FHIR'), ('\\B\\', 'FHIR'), ('\\C\\', 'OTHER'), ('\\D\\', 'FHIR')], sorted(rows))
+        # Unchanged rows keep their original update date
+        self.assertEqual(datetime(2017, 5, 25), rows[('\\A\\', 'FHIR')].update_date)
+        self.assertEqual(('bee', new_date), (rows[('\\B\\', 'FHIR')].name_char, rows[('\\B\\', 'FHIR')].update_date))
+
+        # A second pass has nothing to do
+        delta = update_table_delta(self.conn, self.concept_dimension, self.scope, ['concept_path'],
+                                   [concept('\\A\\', 'a'), concept('\\B\\', 'bee'), concept('\\D\\', 'd')])
+        self.assertEqual((0, 0, 0, 3), (len(delta.inserts), len(delta.updates), len(delta.deletes), delta.unchanged))
+
+    def test_load_in_transaction(self):
+        """ The deltas for every table are applied in one transaction, which is rolled back if any table fails """
+        self.conn.execute(self.concept_dimension.insert(), [concept('\\A\\', 'a')])
+        opts = Namespace(tables=Namespace(crc_connection=self.conn, ont_connection=self.conn))
+
+        def load(success: Optional[bool]) -> bool:
+            update_table_delta(self.conn, self.concept_dimension, self.scope, ['concept_path'],
+                               [concept('\\B\\', 'b')])
+            self.assertTrue(self.conn.in_transaction())
+            if success is None:
+                raise ValueError("Load failed")
+            return success
+
+        def paths() -> list:
+            return [r.concept_path for r in self.conn.execute(select([self.concept_dimension.c.concept_path]))]
+
+        self.assertFalse(load_in_transaction(opts, lambda: load(False)))
+        self.assertEqual(['\\A\\'], paths())
+        with self.assertRaises(ValueError):
+            load_in_transaction(opts, lambda: load(None))
+        self.assertEqual(['\\A\\'], paths())
+        self.assertTrue(load_in_transaction(opts, lambda: load(True)))
+        self.assertFalse(self.conn.in_transaction())
+        self.assertEqual(['\\B\\'], paths())
+
+    def test_column_change_in_transaction(self):
+        """ The concept_cd column is widened on the connection that the --diff transaction is open on """
+        opts = Namespace(table=None, outdir=None, diff=True, sourcesystem='FHIR',
+                         tables=Namespace(crc_connection=self.conn, ont_connection=self.conn,
+                                          concept_dimension=self.concept_dimension))
+        with patch('i2fhirb2.generate_i2b2.change_column_length') as change_column_length:
+            with patch('sys.stdout'):
+                self.assertTrue(load_in_transaction(opts, lambda: output_concept_dimension(opts, [])))
+        self.assertIs(self.conn, change_column_length.call_args[0][3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,25 @@ class FHIREncounterMappingTestCase(CRCTestCase):
             self.assertEqual(2, len(em.encounter_mapping_entries))
             self.assertEqual(500000, em.encounter_num)
 
+    def test_renumber(self):
+        """ Merge the encounter mappings built with a private generator and number map into the current context """
+        from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+
+        FHIREncounterMapping._clear()
+        FHIREncounterMapping.number_generator = EncounterNumberGenerator(1)
+        worker_entries = FHIREncounterMapping(FHIR["Observation/o2"], "p1", "http://hl7.org/fhir")\
+            .encounter_mapping_entries + \
+            FHIREncounterMapping(FHIR["Observation/o1"], "p1", "http://hl7.org/fhir").encounter_mapping_entries
+
+        FHIREncounterMapping._clear()
+        em = FHIREncounterMapping(FHIR["Observation/o1"], "p1", "http://hl7.org/fhir")
+        renumber_map, new_entries = FHIREncounterMapping.renumber(worker_entries)
+        self.assertEqual({1: em.encounter_num + 1, 2: em.encounter_num}, renumber_map)
+        self.assertEqual([('Observation/o2', em.encounter_num + 1), (str(em.encounter_num + 1), em.encounter_num + 1),
+                          (str(em.encounter_num), em.encounter_num)],
+                         [(e.encounter_ide, e.encounter_num) for e in new_entries])
+        FHIREncounterMapping._clear()
+
     def test_encounternum_refresh(self):
         """ Test the EncounterNumberGenerator refresh function.
          Process:
@@ -1,8 +1,12 @@
 
+import pickle
 import unittest
 import os
+from datetime import datetime
 
+from dynprops import row
 from fhirtordf.rdfsupport.namespaces import FHIR
+from i2b2model.shared.i2b2core import I2B2Core
 
 from i2fhirb2.fhir.fhirmetadatavocabulary import FMVGraphNode
 from i2fhirb2.fhir.fhirontologytable import FHIROntologyTable
@@ -53,6 +57,34 @@ class FHIROntologyP2TestCase(unittest.TestCase):
             self.assertEqual(f.read(), str(fmv_rg))
         self.assertFalse(save_output, "Test always fails if save_output is true")
 
+    def test_compiled_type_graph(self):
+        """ A pickled, compiled type graph must generate the same dimensions as one built from the FMV """
+        I2B2Core.update_date = datetime(2017, 5, 25, 13, 0)
+        fhir_ont = FHIROntologyTable(shared_graph)
+        type_graph = pickle.loads(pickle.dumps(fhir_ont.compile_type_graph(), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(fhir_ont.fhir_resource_concepts(), set(type_graph.keys()))
+        with open(os.path.join(self.output_dir, 'fhir_observation_resource_graph.txt')) as f:
+            self.assertEqual(f.read(), str(type_graph[FHIR.Observation]))
+
+        expected = FHIROntologyTable(shared_graph).dimension_list(FHIR.Observation)
+        actual = FHIROntologyTable(shared_graph, type_graph=type_graph).dimension_list(FHIR.Observation)
+        for expected_entries, actual_entries in zip(expected, actual):
+            self.assertEqual(sorted(row(e) for e in expected_entries), sorted(row(e) for e in actual_entries))
+
+    def test_parallel_dimension_list(self):
+        """ Expanding the resources in a process pool must generate the same entries, in the same order """
+        I2B2Core.update_date = datetime(2017, 5, 25, 13, 0)
+        fhir_ont = FHIROntologyTable(shared_graph)
+        type_graph = fhir_ont.compile_type_graph()
+        serial = FHIROntologyTable(shared_graph, type_graph=type_graph).dimension_list()
+        parallel = FHIROntologyTable(shared_graph, type_graph=type_graph).dimension_list(workers=2)
+        self.assertEqual([(e.c_fullname, e.m_applied_path, e.c_basecode) for e in serial.ontology_dimension],
+                         [(e.c_fullname, e.m_applied_path, e.c_basecode) for e in parallel.ontology_dimension])
+        self.assertEqual([(e.concept_path, e.concept_cd) for e in serial.concept_dimension],
+                         [(e.concept_path, e.concept_cd) for e in parallel.concept_dimension])
+        self.assertEqual([(e.modifier_path, e.modifier_cd) for e in serial.modifier_dimension],
+                         [(e.modifier_path, e.modifier_cd) for e in parallel.modifier_dimension])
+
 
 if __name__ == '__main__':
     unittest.main()
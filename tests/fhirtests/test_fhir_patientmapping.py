@@ -54,6 +54,24 @@ class FHIRPatientMappingTestCase(CRCTestCase):
             self.assertEqual(2, len(pm.patient_mapping_entries))
             self.assertEqual(pm2.patient_num, pm.patient_num)
 
+    def test_renumber(self):
+        """ Merge the patient mappings built with a private generator and number map into the current context """
+        from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+
+        FHIRPatientMapping._clear()
+        FHIRPatientMapping.number_generator = PatientNumberGenerator(1)
+        worker_entries = FHIRPatientMapping(None, "p2", "http://hl7.org/fhir").patient_mapping_entries + \
+            FHIRPatientMapping(None, "p1", "http://hl7.org/fhir").patient_mapping_entries
+
+        FHIRPatientMapping._clear()
+        pm = FHIRPatientMapping(None, "p1", "http://hl7.org/fhir")
+        renumber_map, new_entries = FHIRPatientMapping.renumber(None, worker_entries)
+        self.assertEqual({1: 100000002, 2: pm.patient_num}, renumber_map)
+        self.assertEqual([('p2', 'http://hl7.org/fhir', 100000002), ('100000002', 'HIVE', 100000002)],
+                         [(e.patient_ide, e.patient_ide_source, e.patient_num) for e in new_entries])
+        self.assertEqual(100000002, FHIRPatientMapping(None, "p2", "http://hl7.org/fhir").patient_num)
+        FHIRPatientMapping._clear()
+
     def test_patientnum_refresh(self):
         # Not a lot we can do to test this without knowing what is in the database.   We COULD add something to the
         # tables and demonstrate that we don't see it if we pass a number in...
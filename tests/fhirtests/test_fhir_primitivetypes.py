@@ -1,13 +1,16 @@
 
 import os
 import unittest
-from typing import Dict
+from datetime import datetime
+from itertools import islice, cycle
+from timeit import default_timer
+from typing import Dict, List
 
 from fhirtordf.rdfsupport.namespaces import FHIR
-from rdflib import Graph, RDFS
+from rdflib import Graph, RDFS, Literal, XSD
 
 from i2fhirb2.fhir.fhirprimitivetypes import i2b2_primitive, I2B2Value
-from i2b2model.data.i2b2observationfact import ValueTypeCd
+from i2b2model.data.i2b2observationfact import ValueTypeCd, valuetype_date, valuetype_number, valuetype_text
 
 expected: Dict[str, I2B2Value] = {
      'base64': I2B2Value("", ValueTypeCd("B"), None, '"/9j/4AAQS...SgJX2f//Z"'),
@@ -28,6 +31,50 @@ expected: Dict[str, I2B2Value] = {
      'time': I2B2Value("16:30:00", ValueTypeCd("D"), 0.163, None)}
 
 
+def reference_date_val(val: Literal) -> I2B2Value:
+    dt = val.value
+    nval_num = (dt.year * 10000) + (dt.month * 100) + dt.day + \
+               (((dt.hour / 100.0) + (dt.minute / 10000.0)) if isinstance(dt, datetime) else 0)
+    return I2B2Value(dt.strftime('%Y-%m-%d %H:%M'), valuetype_date, nval_num)
+
+
+def reference_decimal_val(val: Literal) -> I2B2Value:
+    return I2B2Value("E", valuetype_number, float(val.value))
+
+
+def reference_text_val(val: Literal) -> I2B2Value:
+    return I2B2Value(format(str(val).replace('\n', '\\n').replace(r'\t', '\\t')), valuetype_text)
+
+
+reference_conversions = {XSD.date: reference_date_val, XSD.dateTime: reference_date_val,
+                         XSD.decimal: reference_decimal_val, XSD.integer: reference_decimal_val}
+
+
+def reference_primitive(val: Literal) -> I2B2Value:
+    """ The original conversion of the types that i2b2_primitive has a fast path for """
+    return reference_conversions[val.datatype](val) if val.datatype and val.datatype in reference_conversions \
+        else reference_text_val(val)
+
+
+def mixed_literals(nliterals: int) -> List[Literal]:
+    """ Return nliterals distinct date, dateTime, decimal, integer and string literals """
+    rval = []
+    for i in range(nliterals):
+        kind = i % 5
+        if kind == 0:
+            rval.append(Literal(f"20{i % 18:02d}-{i % 12 + 1:02d}-{i % 28 + 1:02d}", datatype=XSD.date))
+        elif kind == 1:
+            rval.append(Literal(f"2017-{i % 12 + 1:02d}-{i % 28 + 1:02d}T{i % 24:02d}:{i % 60:02d}:00.{i:03d}-05:00",
+                                datatype=XSD.dateTime))
+        elif kind == 2:
+            rval.append(Literal(f"{i / 7:.3f}", datatype=XSD.decimal))
+        elif kind == 3:
+            rval.append(Literal(str(i - 500), datatype=XSD.integer))
+        else:
+            rval.append(Literal(f"Line {i}\nline {i + 1}"))
+    return rval
+
+
 class FHIRPrimitiveTypesTestCase(unittest.TestCase):
     test_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
 
@@ -40,7 +87,34 @@ class FHIRPrimitiveTypesTestCase(unittest.TestCase):
             fhir_value = g.value(o, FHIR.value)
             rslts[entry_label] = i2b2_primitive(fhir_value)
         self.assertEqual(expected, rslts)
-        
+
+    def test_fast_path(self):
+        """ The lexical form fast paths have to give exactly what the original conversions did """
+        literals = mixed_literals(1000) + [
+            Literal("2015-08-06T10:11", datatype=XSD.dateTime),
+            Literal("2015-08-06T10:11:12Z", datatype=XSD.dateTime),
+            Literal("20150806T101112", datatype=XSD.dateTime),
+            Literal("0999-01-01T10:11:00", datatype=XSD.dateTime),
+            Literal("0999-01-01", datatype=XSD.date),
+            Literal(datetime(2017, 5, 25, 13, 1)),
+            Literal("tab\there\r\n")]
+        for literal in literals:
+            self.assertEqual(repr(reference_primitive(literal)), repr(i2b2_primitive(literal)), literal)
+
+    @unittest.skipUnless(os.environ.get('I2FHIRB2_BENCHMARK'), "Set I2FHIRB2_BENCHMARK to run the benchmarks")
+    def test_benchmark(self):
+        """ Convert a million mixed literals with the original and the fast path conversions and report the times """
+        literals = mixed_literals(1000)
+
+        def convert(f) -> float:
+            start = default_timer()
+            for literal in islice(cycle(literals), 1000000):
+                f(literal)
+            return default_timer() - start
+        reference_time = convert(reference_primitive)
+        fast_time = convert(i2b2_primitive)
+        print(f"1M literals: reference: {reference_time:.2f}s i2b2_primitive: {fast_time:.2f}s")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,58 @@
+import os
+import unittest
+
+from fhirtordf.rdfsupport.namespaces import FHIR
+from rdflib import Graph, URIRef, Literal
+
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc
+from i2fhirb2.loaders.fhirjsonmapper import FHIRJSONMapper
+from tests.utils.fhir_graph import test_data_directory
+
+
+def extension(value: str) -> dict:
+    return {"extension": [{"url": "http://example.org/ext", "valueString": value}]}
+
+
+class FHIRJSONMapperTestCase(unittest.TestCase):
+    mapper = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mapper = FHIRJSONMapper(fhir_metavoc(os.path.join(test_data_directory, 'fhir_metadata_vocabulary')))
+
+    def patient_graph(self, **elements) -> Graph:
+        g = Graph()
+        self.mapper.add_resource(dict(resourceType="Patient", id="p1", **elements), "http://hl7.org/fhir/", g)
+        return g
+
+    @staticmethod
+    def extension_values(g: Graph) -> list:
+        return sorted(str(v) for v in g.objects(None, FHIR.Extension.valueString / FHIR.value))
+
+    def test_extensions(self):
+        """ Single and list element extensions are attached to the values they extend """
+        g = self.patient_graph(birthDate="1970-01-01", _birthDate=extension("bd"),
+                               name=[{"given": ["A", "B", "C"], "_given": [None, extension("b"), extension("c")]}])
+        self.assertEqual(['b', 'bd', 'c'], self.extension_values(g))
+        for given, ext in (("B", "b"), ("C", "c")):
+            entry = g.value(None, FHIR.value, Literal(given))
+            self.assertEqual(Literal(ext), g.value(entry, FHIR.Element.extension / FHIR.Extension.valueString /
+                                                   FHIR.value))
+
+        # Extensions without a value, with null placeholders
+        g = self.patient_graph(name=[{"_given": [extension("x"), None]}])
+        self.assertEqual(['x'], self.extension_values(g))
+
+    def test_unmapped_extensions(self):
+        """ Comments, element ids and mismatched lists are skipped rather than raising an exception """
+        with self.assertLogs('i2fhirb2.loaders.fhirjsonmapper', 'WARNING') as logs:
+            g = self.patient_graph(gender="male", _gender={"fhir_comments": ["comment"]}, birthDate="1970-01-01",
+                                   _birthDate={"id": "bd1"}, active=True, _active=[extension("a")])
+        self.assertEqual(1, len(logs.output))
+        self.assertIn("'_active' is a list", logs.output[0])
+        self.assertEqual([], self.extension_values(g))
+        self.assertIn(URIRef("http://hl7.org/fhir/Patient/p1"), set(g.subjects()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import io
+import json
+import os
+import unittest
+
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.loaders.fhirjsonreader import JSONMemberReader, fhir_json_resources, bundle_local_references
+from tests.utils.fhir_graph import test_data_directory
+
+
+class FHIRJSONReaderTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_fhirjsonreader'))
+    bundle = os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir', 'Adams301_Keyshawn30_74.json'))
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def test_members(self):
+        doc = {"resourceType": "Bundle", "total": 123456789, "entry": [{"a": [1, 2.5, None]}, {"b": "x,]}"}, {}],
+               "link": [{"relation": "next", "url": "http://example.org/page2"}], "empty": [], "last": 1.25e3}
+        text = json.dumps(doc, indent=2)
+        # A tiny chunk size splits numbers, strings and keywords across reads
+        for chunk_size in (1, 3, 7, len(text)):
+            reader = JSONMemberReader(io.StringIO(text))
+            reader.chunk_size = chunk_size
+            members = list(reader.members({'entry', 'empty'}))
+            self.assertEqual([('resourceType', 'Bundle', False), ('total', 123456789, False),
+                              ('entry', {"a": [1, 2.5, None]}, True), ('entry', {"b": "x,]}"}, True),
+                              ('entry', {}, True), ('link', doc['link'], False), ('last', 1250.0, False)], members)
+        self.assertEqual([], list(JSONMemberReader(io.StringIO(' { } ')).members({'entry'})))
+        with self.assertRaises(ValueError):
+            list(JSONMemberReader(io.StringIO('{"a": 1 "b": 2}')).members(set()))
+
+    def test_bundle(self):
+        with open(self.bundle) as f:
+            entries = json.load(f)['entry']
+        local_references = bundle_local_references(self.bundle)
+        self.assertEqual(len([e for e in entries if 'fullUrl' in e]), len(local_references))
+        self.assertEqual('Patient/526238ef-dec3-401d-a1c1-2974962df23f',
+                         local_references['urn:uuid:526238ef-dec3-401d-a1c1-2974962df23f'])
+
+        resources = list(fhir_json_resources(self.bundle))
+        # Resources without an id take the one in their urn:uuid fullUrl
+        self.assertEqual([e['fullUrl'][9:] if 'fullUrl' in e else e['resource'].get('id') for e in entries],
+                         [r.get('id') for r in resources])
+        resources_text = json.dumps(resources)
+        self.assertNotIn('urn:uuid:', resources_text)
+        condition = next(r for r in resources if r['resourceType'] == 'Condition')
+        self.assertEqual('Patient/526238ef-dec3-401d-a1c1-2974962df23f', condition['subject']['reference'])
+        self.assertTrue(condition['context']['reference'].startswith('Encounter/'))
+
+    def test_continuation(self):
+        page1 = os.path.join(self.output_dir, 'page1.json')
+        page2 = os.path.join(self.output_dir, 'page2.json')
+        patient = {"resourceType": "Patient", "id": "p1"}
+        with open(page1, 'w') as f:
+            json.dump({"resourceType": "Bundle", "type": "searchset",
+                       "entry": [{"fullUrl": "urn:uuid:1", "resource": patient}],
+                       "link": [{"relation": "next", "url": "file://" + page2}]}, f)
+        with open(page2, 'w') as f:
+            json.dump({"resourceType": "Bundle",
+                       "entry": [{"resource": {"resourceType": "Observation", "id": "o1",
+                                               "subject": {"reference": "urn:uuid:1"}}}]}, f)
+        self.assertEqual(['Patient', 'Observation'], [r['resourceType'] for r in fhir_json_resources(page1)])
+        # Local references don't span pages
+        self.assertEqual('urn:uuid:1', list(fhir_json_resources(page2))[0]['subject']['reference'])
+        # A resource that isn't a Bundle is returned as is, "entry" and all
+        single = os.path.join(self.output_dir, 'list.json')
+        with open(single, 'w') as f:
+            json.dump({"resourceType": "List", "id": "l1", "entry": [{"item": {"reference": "Patient/p1"}}]}, f)
+        self.assertEqual([{"resourceType": "List", "id": "l1", "entry": [{"item": {"reference": "Patient/p1"}}]}],
+                         list(fhir_json_resources(single)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Tuple
+
+from fhirtordf.fhir.picklejar import picklejarfactory
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc, content_signature
+
+fhir_ttl = """@prefix fhir: <http://hl7.org/fhir/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+fhir:Observation.status rdfs:domain fhir:Observation .
+"""
+
+w5_ttl = """@prefix w5: <http://hl7.org/fhir/w5#> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+w5:clinical rdfs:subClassOf w5:Resource .
+"""
+
+
+class FHIRMetaVocCacheTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_fhirmetavoccache'))
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+        self.save_cache_directory = picklejarfactory.cache_directory
+        picklejarfactory.cache_directory = os.path.join(self.output_dir, 'cache')
+        self.write_ttl('fhir.ttl', fhir_ttl)
+        self.write_ttl('w5.ttl', w5_ttl)
+
+    def tearDown(self):
+        picklejarfactory.cache_directory = self.save_cache_directory
+        make_and_clear_directory(self.output_dir)
+
+    def write_ttl(self, name: str, text: str) -> None:
+        with open(os.path.join(self.output_dir, name), 'w') as f:
+            f.write(text)
+
+    def load(self, **kwargs) -> Tuple[int, str]:
+        output = StringIO()
+        with redirect_stdout(output):
+            g = fhir_metavoc(self.output_dir, **kwargs)
+        return len(g), output.getvalue()
+
+    def test_content_signature(self):
+        fname = os.path.join(self.output_dir, 'fhir.ttl')
+        sig = content_signature(fname)
+        os.utime(fname, (0, 0))
+        self.assertEqual(sig, content_signature(fname))
+        self.write_ttl('fhir.ttl', fhir_ttl.replace('status', 'statuz'))
+        self.assertNotEqual(sig, content_signature(fname))
+        self.assertIsNone(content_signature(os.path.join(self.output_dir, 'missing.ttl')))
+
+    def test_cache(self):
+        self.assertEqual((1, "Loading fhir.ttl (from disc)\n"), self.load())
+        self.assertEqual((1, "Loading fhir.ttl (cached)\n"), self.load())
+        self.assertEqual((2, "Loading fhir.ttl (from disc)\nLoading w5.ttl (from disc)\n"), self.load(include_w5=True))
+        self.assertEqual((2, "Loading fhir.ttl, w5.ttl (cached)\n"), self.load(include_w5=True))
+        self.assertEqual((1, "Loading fhir.ttl (from disc)\n"), self.load(rebuild_cache=True))
+
+        # A change in the content of either file invalidates the cached image
+        self.write_ttl('w5.ttl', w5_ttl + "w5:administrative rdfs:subClassOf w5:Resource .\n")
+        self.assertEqual((1, "Loading fhir.ttl (cached)\n"), self.load())
+        self.assertEqual((3, "Loading fhir.ttl (from disc)\nLoading w5.ttl (from disc)\n"), self.load(include_w5=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
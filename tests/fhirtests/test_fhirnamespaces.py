@@ -0,0 +1,43 @@
+import unittest
+
+from fhirtordf.rdfsupport.namespaces import namespace_for, FHIR, LOINC
+
+from i2fhirb2.fhir.fhirnamespaces import fhir_namespace_for, namespaces, SNOMED, HGNC
+from i2fhirb2.fhir.fhirobservationfact import FHIRObservationFact
+
+
+class FHIRNamespacesTestCase(unittest.TestCase):
+    def test_fhir_namespace_for(self):
+        self.assertEqual('fhir', fhir_namespace_for(FHIR))
+        self.assertEqual('loinc', fhir_namespace_for(LOINC))
+        self.assertEqual('hgnc', fhir_namespace_for(HGNC))
+        self.assertEqual('hgnc', fhir_namespace_for(str(HGNC)[:-1]))
+        self.assertEqual('sct', fhir_namespace_for(SNOMED))
+        self.assertIsNone(fhir_namespace_for("http://example.org/unknown/"))
+
+    def test_fhir_subnamespace(self):
+        """ FHIR sub-namespaces are registered the first time they are encountered """
+        uri = str(FHIR) + "test-subnamespace/"
+        self.assertNotIn(uri, namespaces.values())
+        self.assertEqual('test-subnamespace', fhir_namespace_for(uri))
+        self.assertEqual(uri, namespaces['test-subnamespace'])
+        self.assertEqual('test-subnamespace', fhir_namespace_for(uri))
+
+    def test_external_registration(self):
+        """ Namespaces added to the underlying fhirtordf table must be picked up by the reverse index """
+        uri = "http://example.org/anonymous/"
+        self.assertIsNone(fhir_namespace_for(uri))
+        prefix = namespace_for(uri)
+        self.assertEqual(prefix, fhir_namespace_for(uri))
+
+    def test_ns_name_for(self):
+        FHIRObservationFact._clear()
+        self.assertEqual('LOINC:1234-5', FHIRObservationFact.ns_name_for(LOINC['1234-5']))
+        self.assertEqual('LOINC:1234-5', FHIRObservationFact.ns_name_for(LOINC['1234-5']))
+        self.assertEqual('FHIR:Observation.status', FHIRObservationFact.ns_name_for(FHIR.Observation.status))
+        self.assertIsNone(FHIRObservationFact.ns_name_for("http://example.org/unknown2/code"))
+        FHIRObservationFact._clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
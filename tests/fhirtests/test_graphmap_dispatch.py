@@ -0,0 +1,69 @@
+import os
+import unittest
+from argparse import Namespace
+from contextlib import redirect_stdout
+from io import StringIO
+
+from fhirtordf.loaders.fhirresourceloader import FHIRResource
+from fhirtordf.rdfsupport.namespaces import FHIR
+from jsonasobj import load
+from rdflib import Graph, RDF
+
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+from i2fhirb2.fhir.fhirresourcemap import FHIR_RESOURCE_MAP
+from i2fhirb2.loaders.i2b2graphmap import I2B2GraphMap, RESOURCE_DISPATCH
+from tests.utils.fhir_graph import test_data_directory
+
+
+class GraphMapDispatchTestCase(unittest.TestCase):
+    mv = os.path.abspath(os.path.join(test_data_directory, 'fhir_metadata_vocabulary'))
+
+    def test_dispatch_table(self):
+        self.assertEqual(set(FHIR_RESOURCE_MAP), set(RESOURCE_DISPATCH))
+        self.assertEqual('_map_observation_facts', RESOURCE_DISPATCH[FHIR.Observation])
+        self.assertEqual('_map_patient', RESOURCE_DISPATCH[FHIR.Patient])
+        self.assertEqual('_map_bundle', RESOURCE_DISPATCH[FHIR.Bundle])
+        self.assertEqual('_map_unmapped', RESOURCE_DISPATCH[FHIR.Appointment])
+        for handler in set(RESOURCE_DISPATCH.values()):
+            self.assertTrue(callable(getattr(I2B2GraphMap, handler)), handler)
+
+    def test_graph_resources(self):
+        """ Tree roots and Bundle entry resources are mapped.  Reference targets aren't """
+        g = Graph()
+        with open(os.path.join(test_data_directory, 'patient-bundle.json')) as f:
+            with redirect_stdout(StringIO()):
+                FHIRResource(fhir_metavoc(self.mv), None, 'http://hl7.org/fhir/', data=load(f), target=g)
+        resources = I2B2GraphMap.graph_resources(g)
+        self.assertEqual(50, len([r for r in resources if r[1] == FHIR.Patient]))
+        self.assertEqual(1, len([r for r in resources if r[1] == FHIR.Bundle]))
+        self.assertIn(FHIR.Organization, set(g.objects(None, RDF.type)))
+        self.assertEqual(51, len(resources))
+
+        # Without tree roots, every typed resource -- reference targets included -- is mapped
+        g = Graph()
+        g.load(os.path.join(test_data_directory, 'medicationdispense0308.ttl'), format="turtle")
+        roots = I2B2GraphMap.graph_resources(g)
+        self.assertEqual([FHIR.MedicationDispense], [t for _, t in roots])
+        g.remove((None, FHIR.nodeRole, FHIR.treeRoot))
+        resources = I2B2GraphMap.graph_resources(g)
+        self.assertEqual(5, len(resources))
+        self.assertLess(set(roots), set(resources))
+
+    def test_resource_stats(self):
+        g = Graph()
+        g.load(os.path.join(test_data_directory, 'synthea_data', 'ttl', 'Collins889_Amy73_12.ttl'), format="turtle")
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+        with redirect_stdout(StringIO()):
+            graph_map = I2B2GraphMap(g, Namespace(tables=None, providerid='FHIR:DefaultProvider', uploadid=1,
+                                                  remove=False))
+        stats = graph_map.resource_stats().split('\n')
+        self.assertEqual('=== RESOURCES ===', stats[0])
+        self.assertIn('    1 Patient (', graph_map.resource_stats())
+        self.assertEqual(graph_map._nresources, sum(int(l.split()[0]) for l in stats[1:] if l))
+
+
+if __name__ == '__main__':
+    unittest.main()
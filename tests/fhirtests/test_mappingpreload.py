@@ -0,0 +1,148 @@
+import os
+import unittest
+from argparse import Namespace
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from rdflib import Graph
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, event
+
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping, PatientMappingKey
+from i2fhirb2.loaders.i2b2graphmap import I2B2GraphMap
+
+FHIR_NS = 'http://hl7.org/fhir/'
+
+
+class MappingPreloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        patient_mapping = Table('patient_mapping', metadata,
+                                Column('patient_ide', String), Column('patient_ide_source', String),
+                                Column('patient_num', Integer), Column('project_id', String),
+                                Column('upload_id', Integer))
+        encounter_mapping = Table('encounter_mapping', metadata,
+                                  Column('encounter_ide', String), Column('encounter_ide_source', String),
+                                  Column('project_id', String), Column('encounter_num', Integer),
+                                  Column('patient_ide', String), Column('patient_ide_source', String),
+                                  Column('upload_id', Integer))
+        patient_dimension = Table('patient_dimension', metadata,
+                                  Column('patient_num', Integer), Column('upload_id', Integer))
+        metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self.tables = SimpleNamespace(crc_connection=self.conn, patient_mapping=patient_mapping,
+                                      encounter_mapping=encounter_mapping, patient_dimension=patient_dimension)
+        self.conn.execute(patient_mapping.insert(), [
+            dict(patient_ide='p1', patient_ide_source=FHIR_NS, patient_num=17, project_id='fhir', upload_id=1),
+            dict(patient_ide='17', patient_ide_source='HIVE', patient_num=17, project_id='fhir', upload_id=1),
+            dict(patient_ide='p2', patient_ide_source=FHIR_NS, patient_num=18, project_id='fhir', upload_id=1),
+            dict(patient_ide='p3', patient_ide_source=FHIR_NS, patient_num=19, project_id='fhir', upload_id=2),
+            dict(patient_ide='p4', patient_ide_source='other', patient_num=20, project_id='fhir', upload_id=1),
+            dict(patient_ide='f201', patient_ide_source=FHIR_NS, patient_num=21, project_id='fhir', upload_id=1)])
+        self.conn.execute(encounter_mapping.insert(), [
+            dict(encounter_ide='DiagnosticReport/f202', encounter_ide_source=FHIR_NS, project_id='fhir',
+                 encounter_num=500017, patient_ide='f201', patient_ide_source=FHIR_NS, upload_id=1)])
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+
+        self.nqueries = 0
+
+        def count_query(*_):
+            self.nqueries += 1
+        event.listen(self.engine, "before_cursor_execute", count_query)
+
+    def tearDown(self):
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+        self.conn.close()
+
+    def test_preload_patients(self):
+        saved_chunk_size, FHIRPatientMapping.preload_chunk_size = FHIRPatientMapping.preload_chunk_size, 2
+        try:
+            keys = [PatientMappingKey(p, FHIR_NS, 'fhir') for p in ('p1', 'p2', 'p3', 'p4', 'p9')]
+            self.assertEqual(3, FHIRPatientMapping.preload(self.tables, keys, ignore_upload_id=None))
+        finally:
+            FHIRPatientMapping.preload_chunk_size = saved_chunk_size
+        # Five identifiers, two per IN clause
+        self.assertEqual(3, self.nqueries)
+        self.assertEqual(17, FHIRPatientMapping.number_map[PatientMappingKey('p1', FHIR_NS, 'fhir')])
+        self.assertEqual(19, FHIRPatientMapping.number_map[PatientMappingKey('p3', FHIR_NS, 'fhir')])
+        self.assertNotIn(PatientMappingKey('p4', FHIR_NS, 'fhir'), FHIRPatientMapping.number_map)
+
+        # Preloaded patients keep their number without a query and without generating new mapping entries
+        pm = FHIRPatientMapping(self.tables, 'p1', FHIR_NS)
+        self.assertEqual((17, []), (pm.patient_num, pm.patient_mapping_entries))
+        self.assertEqual(3, self.nqueries)
+
+        # Resolved keys aren't asked for again
+        self.assertEqual(0, FHIRPatientMapping.preload(self.tables, keys[:3]))
+        self.assertEqual(3, self.nqueries)
+
+    def test_preload_ignore_upload_id(self):
+        keys = [PatientMappingKey(p, FHIR_NS, 'fhir') for p in ('p1', 'p2', 'p3')]
+        self.assertEqual(1, FHIRPatientMapping.preload(self.tables, keys, ignore_upload_id=1))
+        self.assertEqual({PatientMappingKey('p3', FHIR_NS, 'fhir'), PatientMappingKey('19', 'HIVE', 'fhir')},
+                         set(FHIRPatientMapping.number_map))
+
+    def test_existing_entry(self):
+        # The single patient lookup has to match the source and project as well as the identifier
+        self.assertEqual(20, FHIRPatientMapping._existing_entry(self.tables, PatientMappingKey('p4', 'other', 'fhir')))
+        self.assertIsNone(FHIRPatientMapping._existing_entry(self.tables, PatientMappingKey('p4', FHIR_NS, 'fhir')))
+
+    def test_graph_map_preload(self):
+        g = Graph()
+        g.load(os.path.join(os.path.split(os.path.abspath(__file__))[0], "data",
+                            "diagnosticreport-example-f202-bloodculture.ttl"), format="turtle")
+        graph_map = I2B2GraphMap(None, Namespace(tables=self.tables, uploadid=1, remove=False))
+        graph_map.preload_mappings(g)
+        self.assertEqual(2, self.nqueries)
+        self.assertEqual(21, FHIRPatientMapping.number_map[PatientMappingKey('f201', FHIR_NS, 'fhir')])
+        self.assertEqual(500017, FHIREncounterMapping.number_map[('DiagnosticReport/f202', FHIR_NS, 'fhir', 'f201',
+                                                                  FHIR_NS)])
+        self.assertEqual(500017, FHIREncounterMapping.number_map[('500017', 'HIVE', 'fhir')])
+
+    def test_new_keys(self):
+        """ Keys that aren't in patient_mapping are remembered, so new patients don't cost a query each """
+        keys = [PatientMappingKey(p, FHIR_NS, 'fhir') for p in ('p1', 'p9')]
+        self.assertEqual(1, FHIRPatientMapping.preload(self.tables, keys))
+        self.assertEqual(1, self.nqueries)
+        self.assertEqual({PatientMappingKey('p9', FHIR_NS, 'fhir')}, FHIRPatientMapping.new_keys)
+        self.assertEqual(0, FHIRPatientMapping.preload(self.tables, keys))
+        self.assertEqual(1, self.nqueries)
+
+        # The new patient is numbered without looking it up
+        with patch.object(FHIRPatientMapping.number_generator, 'new_number', return_value=1000):
+            pm = FHIRPatientMapping(self.tables, 'p9', FHIR_NS)
+        self.assertEqual(1000, pm.patient_num)
+        self.assertEqual(1, self.nqueries)
+
+    def test_batched_preload(self):
+        """ Graphs are queued and the mappings for each batch are preloaded with one set of queries """
+        fname = os.path.join(os.path.split(os.path.abspath(__file__))[0], "data",
+                             "diagnosticreport-example-f202-bloodculture.ttl")
+        graphs = [Graph() for _ in range(4)]
+        for g in graphs:
+            g.load(fname, format="turtle")
+        graph_map = I2B2GraphMap(None, Namespace(tables=self.tables, uploadid=1, remove=False))
+        mapped = []
+        saved_batch_size, I2B2GraphMap.preload_batch_size = I2B2GraphMap.preload_batch_size, 3
+        try:
+            with patch.object(graph_map, '_map_resources', lambda g, resources: mapped.append(g)):
+                graph_map.add_graph(graphs[0])
+                graph_map.add_graph(graphs[1])
+                self.assertEqual((0, [], 2), (self.nqueries, mapped, graph_map.num_pending_records()))
+                graph_map.add_graph(graphs[2])
+                self.assertEqual((2, graphs[:3]), (self.nqueries, mapped))
+                graph_map.add_graph(graphs[3])
+                graph_map.map_queued_graphs()
+                self.assertEqual(graphs, mapped)
+        finally:
+            I2B2GraphMap.preload_batch_size = saved_batch_size
+        # The keys resolved by the first batch aren't asked for again
+        self.assertEqual(2, self.nqueries)
+        self.assertEqual(21, FHIRPatientMapping.number_map[PatientMappingKey('f201', FHIR_NS, 'fhir')])
+
+
+if __name__ == '__main__':
+    unittest.main()
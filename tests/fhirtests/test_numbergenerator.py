@@ -0,0 +1,68 @@
+import unittest
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, event
+
+from i2fhirb2.fhir.fhirencountermapping import EncounterNumberGenerator
+from i2fhirb2.fhir.fhirnumbergenerator import NumberGenerator
+from i2fhirb2.fhir.fhirpatientmapping import PatientNumberGenerator
+
+
+class NumberGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        patient_dimension = Table('patient_dimension', metadata,
+                                  Column('patient_num', Integer), Column('upload_id', Integer))
+        visit_dimension = Table('visit_dimension', metadata,
+                                Column('encounter_num', Integer), Column('upload_id', Integer))
+        metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self.tables = SimpleNamespace(crc_connection=self.conn, patient_dimension=patient_dimension,
+                                      visit_dimension=visit_dimension)
+        self.conn.execute(patient_dimension.insert(), [dict(patient_num=n, upload_id=1) for n in (10, 11, 13, 25)])
+        self.conn.execute(visit_dimension.insert(), [dict(encounter_num=n, upload_id=2) for n in (100, 101)])
+
+        self.nqueries = 0
+
+        def count_query(*_):
+            self.nqueries += 1
+        event.listen(self.engine, "before_cursor_execute", count_query)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_collision_check(self):
+        png = PatientNumberGenerator(10)
+        png.block_size = 5
+        self.assertEqual([12, 14, 15, 16, 17, 18, 19, 20], [png.new_number(self.tables) for _ in range(8)])
+        # One range query per block -- 10-14, 15-19 and 20-24
+        self.assertEqual(3, self.nqueries)
+        # No check means no queries
+        self.assertEqual([21, 22, 23, 24, 25], [png.new_number(self.tables, check_db=False) for _ in range(5)])
+        self.assertEqual(3, self.nqueries)
+
+    def test_full_block(self):
+        png = PatientNumberGenerator(10)
+        png.block_size = 2
+        self.assertEqual(12, png.new_number(self.tables))
+
+    def test_refresh(self):
+        png = PatientNumberGenerator(1)
+        png.new_number()
+        self.assertEqual(26, png.refresh(self.tables, None))
+        self.assertEqual(26, png.new_number(self.tables))
+        self.assertEqual(1, png.refresh(self.tables, 1))
+
+        eng = EncounterNumberGenerator(500000)
+        self.assertEqual(500000, eng.new_number())
+        self.assertEqual(102, eng.refresh(self.tables, None))
+        self.assertEqual(102, eng.new_number())
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            NumberGenerator(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
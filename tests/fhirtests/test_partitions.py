@@ -0,0 +1,41 @@
+import unittest
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, select, func
+from sqlalchemy.dialects import postgresql
+
+from i2fhirb2.loaders.i2b2partitions import create_partition_ddl, drop_partition_ddl, is_upload_partitioned, \
+    ensure_upload_partition, remove_upload
+
+
+class PartitionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.observation_fact = Table('observation_fact', MetaData(), Column('concept_cd', String),
+                                      Column('upload_id', Integer))
+        self.observation_fact.metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self.conn.execute(self.observation_fact.insert(),
+                          [dict(concept_cd='c{}'.format(i), upload_id=117 + i % 2) for i in range(30)])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_ddl(self):
+        crc_fact = Table('observation_fact', MetaData(), schema='i2b2demodata')
+        self.assertEqual('CREATE TABLE i2b2demodata.observation_fact_upload_117 PARTITION OF '
+                         'i2b2demodata.observation_fact FOR VALUES IN (117)',
+                         create_partition_ddl(postgresql.dialect(), crc_fact, 117))
+        self.assertEqual('DROP TABLE i2b2demodata.observation_fact_upload_117',
+                         drop_partition_ddl(postgresql.dialect(), crc_fact, 117))
+
+    def test_sqlite_fallback(self):
+        """ SQLite tables are never partitioned -- uploads are removed with (chunked) DELETEs """
+        self.assertFalse(is_upload_partitioned(self.conn, self.observation_fact))
+        self.assertIsNone(ensure_upload_partition(self.conn, self.observation_fact, 119))
+        self.assertEqual((15, False), remove_upload(self.conn, self.observation_fact, 117, chunk_size=4))
+        self.assertEqual((0, False), remove_upload(self.conn, self.observation_fact, 117))
+        self.assertEqual(15, self.conn.execute(select([func.count()]).select_from(self.observation_fact)).scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
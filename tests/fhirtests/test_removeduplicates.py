@@ -0,0 +1,38 @@
+import unittest
+from types import SimpleNamespace
+from typing import List
+
+from i2fhirb2.fhir.fhirobservationfact import FHIRObservationFactFactory
+
+
+def synthetic_facts(nfacts: int) -> List[SimpleNamespace]:
+    """ Generate nfacts stand-ins for FHIRObservationFact, every fourth one of which duplicates an earlier entry """
+    return [SimpleNamespace(instance_num=(i - i % 4 if i % 4 == 3 else i) // 10,
+                            concept_cd=f"FHIR:Observation.component{(i - i % 4 if i % 4 == 3 else i) % 10}",
+                            modifier_cd="FHIR:CodeableConcept.coding") for i in range(nfacts)]
+
+
+class RemoveDuplicatesTestCase(unittest.TestCase):
+    def test_order_preserved(self):
+        facts = synthetic_facts(1000)
+        rval = FHIRObservationFactFactory.removeduplicates(facts)
+        self.assertEqual(750, len(rval))
+        self.assertEqual([f for i, f in enumerate(facts) if i % 4 != 3], rval)
+
+    def test_linear_scaling(self):
+        """ Each fact's key is read once.  A scan of the facts already kept reads them again for every new fact """
+        class CountingFact(SimpleNamespace):
+            nreads = 0
+
+            def __getattribute__(self, item):
+                if item == 'instance_num':
+                    CountingFact.nreads += 1
+                return super().__getattribute__(item)
+
+        for nfacts in (2500, 10000):
+            CountingFact.nreads = 0
+            FHIRObservationFactFactory.removeduplicates([CountingFact(**vars(f)) for f in synthetic_facts(nfacts)])
+            self.assertEqual(nfacts, CountingFact.nreads)
+
+if __name__ == '__main__':
+    unittest.main()
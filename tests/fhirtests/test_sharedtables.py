@@ -0,0 +1,61 @@
+import unittest
+from argparse import Namespace
+
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+from i2fhirb2.sharedtables import shared_tables, close_shared_tables, engine_args
+
+
+class SharedTablesTestCase(unittest.TestCase):
+    opts = Namespace(crcdb='sqlite://', crcuser='', crcpassword='', ontodb='sqlite://', ontouser='', ontopassword='',
+                     poolsize=3, preping=True)
+
+    def setUp(self):
+        self.nconnects = 0
+        event.listen(Pool, 'connect', self.attach_schemas)
+
+    def tearDown(self):
+        event.remove(Pool, 'connect', self.attach_schemas)
+        close_shared_tables()
+
+    def attach_schemas(self, dbapi_connection, _):
+        """ Give each (in memory SQLite) connection the i2b2 crc and metadata schemas """
+        self.nconnects += 1
+        cursor = dbapi_connection.cursor()
+        cursor.execute("ATTACH DATABASE ':memory:' AS i2b2demodata")
+        cursor.execute("ATTACH DATABASE ':memory:' AS i2b2metadata")
+        cursor.close()
+
+    def test_engine_args(self):
+        self.assertEqual(dict(pool_pre_ping=True, pool_size=7),
+                         engine_args('postgresql+psycopg2://u:p@localhost:5432/i2b2', 7, True))
+        # SQLite file databases aren't pooled
+        self.assertEqual(dict(pool_pre_ping=False), engine_args('sqlite:///crc.db', 7, False))
+
+    def test_shared(self):
+        tables = shared_tables(self.opts)
+        self.assertIs(tables, shared_tables(Namespace(**vars(self.opts))))
+        self.assertEqual(1, self.nconnects)
+        self.assertIs(tables.crc_connection, tables.ont_connection)
+        self.assertTrue(tables.crc_engine.pool._pre_ping)
+        self.assertEqual(3, tables.crc_engine.pool.size)
+
+        close_shared_tables()
+        self.assertIsNot(tables, shared_tables(self.opts))
+        self.assertEqual(2, self.nconnects)
+
+    def test_abandoned_transaction(self):
+        """ A transaction left open by an earlier consumer is rolled back before the tables are handed out again """
+        tables = shared_tables(self.opts)
+        tables.crc_connection.execute("CREATE TABLE i2b2demodata.t (v INTEGER)")
+        tables.crc_connection.begin()
+        tables.crc_connection.execute("INSERT INTO i2b2demodata.t VALUES (1)")
+        self.assertIs(tables, shared_tables(self.opts))
+        self.assertFalse(tables.crc_connection.in_transaction())
+        self.assertIs(tables.crc_connection, tables.ont_connection)
+        self.assertEqual(0, tables.crc_connection.execute("SELECT count(*) FROM i2b2demodata.t").scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import random
+import unittest
+from datetime import datetime
+
+from dynprops import heading, row
+from i2b2model.data.i2b2observationfact import ObservationFact, ObservationFactKey
+from i2b2model.data.i2b2patientmapping import PatientMapping, PatientIDEStatus
+from i2b2model.shared.i2b2core import I2B2Core
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.tsv_support.tsvwriter import esc_output, external_sort, RecordSpool, write_tsv
+
+
+def random_facts(nfacts: int):
+    rng = random.Random(42)
+    return [ObservationFact(ObservationFactKey(rng.randint(1, 20), rng.randint(1, 50), 'provider',
+                                               datetime(2017, 5, 25)), f"FHIR:Observation.c{rng.randint(1, 5)}")
+            for _ in range(nfacts)]
+
+
+class TSVWriterTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_tsvwriter'))
+
+    def setUp(self):
+        I2B2Core.update_date = datetime(2017, 5, 25)
+        make_and_clear_directory(self.output_dir)
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def test_esc_output(self):
+        self.assertEqual('abc\tdef', esc_output('a\r\nb\rc\t\nd\ne\r\n\rf'))
+
+    def test_external_sort(self):
+        """ External sort, with or without spills, must match sorted() -- including the order of equal records """
+        facts = random_facts(500)
+        expected = sorted(facts)
+        self.assertEqual([id(e) for e in expected], [id(e) for e in external_sort(facts, 1000)])
+        self.assertEqual([e.pk for e in expected], [e.pk for e in external_sort(facts, 64)])
+
+        mappings = [PatientMapping(i % 7, f"p{i % 13}", PatientIDEStatus.active, "http://hl7.org/fhir", "fhir")
+                    for i in range(100)]
+        self.assertEqual([row(e) for e in sorted(mappings)], [row(e) for e in external_sort(mappings, 16)])
+
+    def test_spool(self):
+        facts = random_facts(300)
+        spool = RecordSpool(100)
+        spool.add(facts[:150])
+        spool.add(iter(facts[150:]))
+        self.assertEqual(300, len(spool))
+        self.assertEqual([row(e) for e in sorted(facts)], [row(e) for e in spool])
+
+    def test_write_tsv(self):
+        facts = random_facts(50)
+        write_tsv(self.output_dir + os.sep, 'unsorted', heading(ObservationFact), iter(facts))
+        write_tsv(self.output_dir + os.sep, 'sorted', heading(ObservationFact), facts, sort=True)
+        with open(os.path.join(self.output_dir, 'unsorted.tsv')) as f:
+            self.assertEqual([heading(ObservationFact)] + [row(e) for e in facts], f.read().splitlines())
+        with open(os.path.join(self.output_dir, 'sorted.tsv')) as f:
+            self.assertEqual([heading(ObservationFact)] + [row(e) for e in sorted(facts)], f.read().splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import gzip
+import os
+import unittest
+from urllib.error import HTTPError
+
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.loaders.urlfetcher import URLFetcher, JSON_ACCEPT, NDJSON_ACCEPT
+from tests.utils.fhir_graph import test_data_directory
+from tests.utils.fhir_server import FHIRTestServer
+
+
+class URLFetcherTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_urlfetcher'))
+    synthea_dir = os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir'))
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def test_fetch_all(self):
+        fnames = sorted(os.listdir(self.synthea_dir))[:8]
+        with FHIRTestServer(self.synthea_dir, fail_once={fnames[2]}, delay=0.2) as server:
+            with URLFetcher(max_in_flight=3, backoff=0.01) as fetcher:
+                payloads = list(fetcher.fetch_all([server.url + fn for fn in fnames], JSON_ACCEPT))
+        # Payloads come back in order, decompressed
+        self.assertEqual([server.url + fn for fn in fnames], [url for url, _ in payloads])
+        for fn, (_, payload) in zip(fnames, payloads):
+            with open(os.path.join(self.synthea_dir, fn), 'rb') as f:
+                self.assertEqual(f.read(), payload)
+        self.assertEqual(8, server.gzipped)
+        # The 503 is retried
+        self.assertEqual(2, server.requests.count(fnames[2]))
+        self.assertEqual(9, fetcher.num_requests)
+        # Requests are concurrent, but never more than max_in_flight at a time, and connections are reused
+        self.assertLessEqual(server.max_in_flight, 3)
+        self.assertGreater(server.max_in_flight, 1)
+        self.assertLessEqual(server.num_connections, 3)
+        self.assertEqual(server.num_connections, fetcher.num_connections)
+
+    def test_errors(self):
+        with FHIRTestServer(self.synthea_dir, fail_once={'Patient.json'}) as server:
+            with URLFetcher(retries=0) as fetcher:
+                with self.assertRaises(HTTPError) as e:
+                    fetcher.fetch(server.url + 'Patient.json', JSON_ACCEPT)
+                self.assertEqual(503, e.exception.code)
+            with URLFetcher(backoff=0.01) as fetcher:
+                with self.assertRaises(HTTPError) as e:
+                    fetcher.fetch(server.url + 'missing.json', JSON_ACCEPT)
+                self.assertEqual(404, e.exception.code)
+        # A 404 isn't retried
+        self.assertEqual(['Patient.json', 'missing.json'], server.requests)
+
+    def test_open(self):
+        """ Streamed (NDJSON) content is decompressed both when the server gzips it and when the file is gzipped """
+        lines = b'{"resourceType": "Patient", "id": "p1"}\n' * 1000
+        with open(os.path.join(self.output_dir, 'Patient.ndjson'), 'wb') as f:
+            f.write(lines)
+        with FHIRTestServer(self.output_dir) as server:
+            with URLFetcher().open(server.url + 'Patient.ndjson', NDJSON_ACCEPT) as f:
+                self.assertEqual(lines, f.read())
+        self.assertEqual(1, server.gzipped)
+        with gzip.open(os.path.join(self.output_dir, 'Patient.ndjson.gz'), 'wb') as f:
+            f.write(lines)
+        with FHIRTestServer(self.output_dir) as server:
+            response = URLFetcher().open(server.url + 'Patient.ndjson.gz', NDJSON_ACCEPT)
+            with gzip.GzipFile(fileobj=response, mode='rb') as f:
+                self.assertEqual(lines, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
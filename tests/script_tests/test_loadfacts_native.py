@@ -0,0 +1,83 @@
+import itertools
+import os
+import unittest
+import uuid
+from collections import Counter
+from typing import Dict, Any
+from unittest.mock import patch
+
+import fhirtordf.loaders.fhirresourceloader as fhirresourceloader
+from rdflib import Graph, BNode
+from rdflib.compare import to_isomorphic
+
+import i2fhirb2.loaders.fhirjsonmapper as fhirjsonmapper
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc
+from i2fhirb2.loaders.fhirjsonmapper import FHIRJSONMapper
+from i2fhirb2.loaders.fhirjsonreader import fhir_json_resources
+from i2fhirb2.loadfacts import add_json_resource
+from tests.utils.fhir_graph import test_data_directory
+
+
+def graph_signature(g: Graph) -> Counter:
+    """
+    Return a signature that two graphs share exactly when they are isomorphic.  ``rdflib.compare.isomorphic`` takes
+    time in proportion to the square of the number of BNodes (around 30 seconds for a single synthea bundle), so each
+    set of BNodes that are connected to each other is canonicalized on its own and the ground triples are compared
+    as they are.
+    :param g: graph
+    :return: ground triples and canonical digests of the BNode components
+    """
+    parent = {}         # type: Dict[BNode, BNode]
+
+    def component(n: BNode) -> BNode:
+        while parent.setdefault(n, n) != n:
+            n = parent[n]
+        return n
+
+    for s, _, o in g:
+        if isinstance(s, BNode) and isinstance(o, BNode):
+            parent[component(s)] = component(o)
+    ground = Counter()
+    components = {}     # type: Dict[BNode, Graph]
+    for t in g:
+        s, _, o = t
+        bnode = s if isinstance(s, BNode) else o if isinstance(o, BNode) else None
+        if bnode is None:
+            ground[t] += 1
+        else:
+            components.setdefault(component(bnode), Graph()).add(t)
+    return ground + Counter(to_isomorphic(c).graph_digest() for c in components.values())
+
+
+class LoadFactsNativeTestCase(unittest.TestCase):
+    """ Differential test -- the native JSON mapper has to generate the same RDF as fhirtordf """
+    synthea_dir = os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir'))
+    mv = os.path.abspath(os.path.join(test_data_directory, 'fhir_metadata_vocabulary'))
+
+    def resource_graph(self, resource: Dict[str, Any], metavoc: Graph, mapper: FHIRJSONMapper = None) -> Graph:
+        """ Convert resource, giving it the same generated id as the other conversion if it doesn't have one """
+        resource_ids = itertools.count()
+
+        def new_uuid():
+            return uuid.UUID(int=next(resource_ids))
+        g = Graph()
+        with patch.object(fhirresourceloader, 'uuid4', new_uuid), patch.object(fhirjsonmapper, 'uuid4', new_uuid):
+            add_json_resource(dict(resource), "http://hl7.org/fhir/", g, metavoc, mapper)
+        return g
+
+    def test_native_matches_fhirtordf(self):
+        metavoc = fhir_metavoc(self.mv)
+        mapper = FHIRJSONMapper(metavoc)
+        input_files = sorted(fn for fn in os.listdir(self.synthea_dir) if fn.endswith('.json'))
+        self.assertTrue(input_files)
+        for fn in input_files:
+            for resource in fhir_json_resources(os.path.join(self.synthea_dir, fn)):
+                fhirtordf_graph = self.resource_graph(resource, metavoc)
+                native_graph = self.resource_graph(resource, metavoc, mapper)
+                self.assertEqual(len(fhirtordf_graph), len(native_graph))
+                self.assertEqual(graph_signature(fhirtordf_graph), graph_signature(native_graph),
+                                 "{} {}/{}".format(fn, resource['resourceType'], resource.get('id')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import gzip
+import json
+import os
+import unittest
+from argparse import Namespace
+
+from fhirtordf.rdfsupport.namespaces import FHIR
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirmetavoccache import fhir_metavoc
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+from i2fhirb2.loaders.fhirjsonmapper import FHIRJSONMapper
+from i2fhirb2.loaders.fhirjsonreader import resolve_references, bundle_local_references
+from i2fhirb2.loadfacts import load_facts, input_files, ndjson_resource_graphs
+from tests.utils.fhir_graph import test_data_directory
+
+
+class LoadFactsNDJSONTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_loadfacts_ndjson'))
+    input_dir = os.path.join(output_dir, 'ndjson')
+    mv = os.path.abspath(os.path.join(test_data_directory, 'fhir_metadata_vocabulary'))
+    bundle = os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir', 'Adams301_Keyshawn30_74.json'))
+    tables = ['observation_fact', 'patient_dimension', 'patient_mapping', 'visit_dimension', 'encounter_mapping']
+
+    def setUp(self):
+        """ Split the bundle into a Bulk Data style export -- one (possibly gzipped) file per resource type, with
+        the bundle's urn:uuid references replaced by type/id references """
+        make_and_clear_directory(self.output_dir)
+        os.makedirs(self.input_dir)
+        with open(self.bundle) as f:
+            resources = [entry['resource'] for entry in json.load(f)['entry']]
+        resolve_references(resources, bundle_local_references(self.bundle))
+        for resource_type in {r['resourceType'] for r in resources}:
+            lines = ''.join(json.dumps(r) + '\n\n' for r in resources if r['resourceType'] == resource_type)
+            if resource_type == 'Condition':
+                with gzip.open(os.path.join(self.input_dir, resource_type + '.ndjson.gz'), 'wt') as f:
+                    f.write(lines)
+            else:
+                with open(os.path.join(self.input_dir, resource_type + '.ndjson'), 'w') as f:
+                    f.write(lines)
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def create_test_output(self, outdir: str, *args: str) -> None:
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+        load_facts(f"-mv {self.mv} -u 1234 -od {outdir}".split() + list(args))
+
+    def line_count(self, outdir: str, table: str) -> int:
+        with open(os.path.join(outdir, table + '.tsv')) as f:
+            return sum(1 for _ in f)
+
+    def test_patient_first(self):
+        files = [fn for _, fn in input_files(Namespace(infile=None, indir=self.input_dir, filetype='ndjson'))]
+        self.assertEqual('Patient.ndjson', files[0])
+        self.assertEqual(8, len(files))
+        self.assertIn('Condition.ndjson.gz', files)
+
+    def test_batches(self):
+        mapper = FHIRJSONMapper(fhir_metavoc(self.mv))
+        graphs = list(ndjson_resource_graphs(os.path.join(self.input_dir, 'MedicationRequest.ndjson'),
+                                             'http://hl7.org/fhir/', None, mapper, batch_size=5))
+        self.assertEqual([5, 5, 3], [len(list(g.subjects(FHIR.nodeRole, FHIR.treeRoot))) for g in graphs])
+
+    def test_ndjson_matches_json(self):
+        """ The Bulk Data export must generate the same records as the bundle it came from """
+        json_dir = os.path.join(self.output_dir, 'json')
+        ndjson_dir = os.path.join(self.output_dir, 'out')
+        self.create_test_output(json_dir, '-t', 'json', '--stream', '-i', self.bundle)
+        self.create_test_output(ndjson_dir, '-t', 'ndjson', '--native', '-id', self.input_dir)
+        for table in self.tables:
+            self.assertEqual(self.line_count(json_dir, table), self.line_count(ndjson_dir, table), table)
+        with open(os.path.join(json_dir, 'patient_mapping.tsv')) as json_f, \
+                open(os.path.join(ndjson_dir, 'patient_mapping.tsv')) as ndjson_f:
+            self.assertEqual([l.split('\t')[:4] for l in json_f], [l.split('\t')[:4] for l in ndjson_f])
+
+
+if __name__ == '__main__':
+    unittest.main()
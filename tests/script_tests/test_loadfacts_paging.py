@@ -0,0 +1,95 @@
+import json
+import os
+import time
+import unittest
+from argparse import Namespace
+
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.loaders.fhirjsonreader import fhir_json_resources
+from i2fhirb2.loaders.urlfetcher import URLFetcher
+from i2fhirb2.loadfacts import CrawlCheckpoint, stream_rdf_graphs
+from tests.utils.fhir_graph import test_data_directory
+from tests.utils.fhir_server import FHIRTestServer
+
+
+class LoadFactsPagingTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_loadfacts_paging'))
+    pages_dir = os.path.join(output_dir, 'pages')
+    mv = os.path.abspath(os.path.join(test_data_directory, 'fhir_metadata_vocabulary'))
+    bundle = os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir', 'Adams301_Keyshawn30_74.json'))
+    page_size = 10
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+        os.makedirs(self.pages_dir)
+        with open(self.bundle) as f:
+            self.entries = json.load(f)['entry']
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def write_pages(self, server_url: str) -> str:
+        """ Split the bundle into searchset pages of page_size entries, chained with next links
+        :return: URL of the first page """
+        npages = (len(self.entries) + self.page_size - 1) // self.page_size
+        for page_num in range(npages):
+            page = {"resourceType": "Bundle", "type": "searchset", "total": len(self.entries)}
+            if page_num + 1 < npages:
+                page["link"] = [{"relation": "next", "url": server_url + 'page{}.json'.format(page_num + 1)}]
+            page["entry"] = self.entries[page_num * self.page_size:(page_num + 1) * self.page_size]
+            with open(os.path.join(self.pages_dir, 'page{}.json'.format(page_num)), 'w') as f:
+                json.dump(page, f)
+        return server_url + 'page0.json'
+
+    def test_prefetch(self):
+        """ The next page is requested while the current one is being consumed, and each page is fetched once """
+        with FHIRTestServer(self.pages_dir) as server:
+            first_page = self.write_pages(server.url)
+            pages = []
+            resources = []
+            with URLFetcher() as fetcher:
+                for resource in fhir_json_resources(first_page, fetcher=fetcher, on_page=pages.append):
+                    if not resources:
+                        time.sleep(0.2)
+                        self.assertEqual(['page0.json', 'page1.json'], server.requests)
+                    resources.append(resource)
+        self.assertEqual(len(self.entries), len(resources))
+        self.assertEqual(['page0.json', 'page1.json', 'page2.json'], server.requests)
+        self.assertEqual([server.url + r for r in server.requests], pages)
+
+    def test_checkpoint(self):
+        """ An interrupted crawl resumes at the page it was on """
+        checkpoint_file = os.path.join(self.output_dir, 'checkpoint.json')
+        flushes = []
+        with FHIRTestServer(self.pages_dir) as server:
+            first_page = self.write_pages(server.url)
+            opts = Namespace(infile=[first_page], indir=None, filetype='json', uribase='http://hl7.org/fhir/',
+                             native=True, fetchers=2, metadatavoc=self.mv, rebuild_cache=False)
+
+            # Stop part way through the second page
+            checkpoint = CrawlCheckpoint(checkpoint_file, lambda: flushes.append(len(server.requests)))
+            graphs = stream_rdf_graphs(opts, checkpoint=checkpoint)
+            for _ in range(self.page_size + 3):
+                next(graphs)
+            graphs.close()
+            self.assertEqual(2, len(flushes))
+            with open(checkpoint_file) as f:
+                self.assertEqual({first_page: server.url + 'page1.json'}, json.load(f))
+
+            # Resume -- the second page is mapped again, from its start, and the first page isn't requested
+            del server.requests[:]
+            checkpoint = CrawlCheckpoint(checkpoint_file, lambda: None)
+            self.assertEqual(len(self.entries) - self.page_size,
+                             len(list(stream_rdf_graphs(opts, checkpoint=checkpoint))))
+            self.assertEqual(['page1.json', 'page2.json'], server.requests)
+            self.assertTrue(CrawlCheckpoint(checkpoint_file, lambda: None).is_done(first_page))
+
+            # A completed input isn't loaded again
+            self.assertEqual([], list(stream_rdf_graphs(opts, checkpoint=CrawlCheckpoint(checkpoint_file,
+                                                                                         lambda: None))))
+
+
+if __name__ == '__main__':
+    unittest.main()
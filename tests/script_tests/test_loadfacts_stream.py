@@ -0,0 +1,109 @@
+import unittest
+
+import os
+import uuid
+from datetime import datetime
+from typing import List
+from unittest.mock import patch
+
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+from i2fhirb2.loaders.i2b2graphmap import I2B2GraphMap
+from i2fhirb2.loadfacts import load_facts
+from tests.utils.fhir_graph import test_data_directory
+
+
+class FrozenDateTime(datetime):
+    """ datetime whose now() doesn't change, so that runs at different times generate the same records """
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2018, 3, 30, 12, 0)
+
+
+class LoadFactsStreamTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_loadfacts_stream'))
+    tables = ['observation_fact', 'patient_dimension', 'patient_mapping', 'visit_dimension', 'encounter_mapping']
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def create_test_output(self, outdir: str, *args: str, input_files=('Terry46_Deonte363_76.json', )) -> None:
+        mv = os.path.abspath(os.path.join(test_data_directory, 'fhir_metadata_vocabulary'))
+        input_paths = [os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir', input_file))
+                       for input_file in input_files]
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+        # Dates and the ids of resources that don't have one (CarePlans) are fixed, so runs can be compared
+        with patch('i2fhirb2.loadfacts.datetime', FrozenDateTime), \
+                patch('i2fhirb2.loaders.i2b2graphmap.datetime', FrozenDateTime), \
+                patch('i2fhirb2.fhir.fhirpatientdimension.datetime', FrozenDateTime), \
+                patch('fhirtordf.loaders.fhirresourceloader.uuid4', lambda: uuid.UUID(int=0)):
+            load_facts(f"-mv {mv} -t json -u 1234 -od {outdir} -i".split() + input_paths + list(args))
+
+    @staticmethod
+    def tsv_contents(outdir: str, table: str) -> List[str]:
+        """ Return the sorted records in a tsv file.  The order in which repeated values of an element are numbered
+        depends on the BNode ids that rdflib assigns, which change from one run to the next, so instance_num is left
+        out of the observation facts. """
+        with open(os.path.join(outdir, table + '.tsv')) as f:
+            if table == 'observation_fact':
+                return sorted('\t'.join(r[:6] + r[7:]) for r in (l.split('\t') for l in f))
+            return sorted(f)
+
+    def test_stream_matches_graph(self):
+        """ Streaming one resource at a time must generate the same records as building the complete graph """
+        graph_dir = os.path.join(self.output_dir, 'graph')
+        stream_dir = os.path.join(self.output_dir, 'stream')
+        self.create_test_output(graph_dir)
+        self.create_test_output(stream_dir, '--stream')
+        for table in self.tables:
+            self.assertEqual(self.tsv_contents(graph_dir, table), self.tsv_contents(stream_dir, table), table)
+
+    def test_stream_flush_tsv(self):
+        """ Flushing records to the tsv spools must not change the output """
+        graph_dir = os.path.join(self.output_dir, 'graph')
+        flush_dir = os.path.join(self.output_dir, 'flush')
+        self.create_test_output(graph_dir)
+        flush_threshold = I2B2GraphMap.flush_threshold
+        I2B2GraphMap.flush_threshold = 50
+        try:
+            self.create_test_output(flush_dir, '--stream')
+        finally:
+            I2B2GraphMap.flush_threshold = flush_threshold
+        for table in self.tables:
+            self.assertEqual(self.tsv_contents(graph_dir, table), self.tsv_contents(flush_dir, table), table)
+
+    def test_workers_match_stream(self):
+        """ Mapping with a pool of worker processes must generate the same records as streaming """
+        stream_dir = os.path.join(self.output_dir, 'stream')
+        workers_dir = os.path.join(self.output_dir, 'workers')
+        self.create_test_output(stream_dir, '--stream')
+        self.create_test_output(workers_dir, '--workers', '2')
+        for table in self.tables:
+            self.assertEqual(self.tsv_contents(stream_dir, table), self.tsv_contents(workers_dir, table), table)
+
+    def test_workers_match_stream_files(self):
+        """ Several files, each mapped in several parts, must generate the same records as streaming them """
+        stream_dir = os.path.join(self.output_dir, 'stream')
+        workers_dir = os.path.join(self.output_dir, 'workers')
+        input_files = sorted(fn for fn in os.listdir(os.path.join(test_data_directory, 'synthea_data', 'fhir'))
+                             if fn.endswith('.json'))[:6]
+        flush_threshold = I2B2GraphMap.flush_threshold
+        I2B2GraphMap.flush_threshold = 200
+        try:
+            self.create_test_output(stream_dir, '--stream', input_files=input_files)
+            self.create_test_output(workers_dir, '--workers', '3', input_files=input_files)
+        finally:
+            I2B2GraphMap.flush_threshold = flush_threshold
+        for table in self.tables:
+            self.assertEqual(self.tsv_contents(stream_dir, table), self.tsv_contents(workers_dir, table), table)
+
+
+if __name__ == '__main__':
+    unittest.main()
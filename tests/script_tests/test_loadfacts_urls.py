@@ -0,0 +1,75 @@
+import os
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+from i2b2model.testingutils.base_test_case import make_and_clear_directory
+from rdflib import Graph
+
+from i2fhirb2.fhir.fhirencountermapping import FHIREncounterMapping
+from i2fhirb2.fhir.fhirpatientmapping import FHIRPatientMapping
+from i2fhirb2.loadfacts import load_facts, parse_rdf_payload
+from tests.utils.fhir_graph import test_data_directory
+from tests.utils.fhir_server import FHIRTestServer
+
+
+class LoadFactsURLTestCase(unittest.TestCase):
+    dirname, _ = os.path.split(os.path.abspath(__file__))
+    output_dir = os.path.abspath(os.path.join(dirname, 'data_out', 'test_loadfacts_urls'))
+    mv = os.path.abspath(os.path.join(test_data_directory, 'fhir_metadata_vocabulary'))
+    synthea_dir = os.path.abspath(os.path.join(test_data_directory, 'synthea_data', 'fhir'))
+    fnames = sorted(os.listdir(synthea_dir))[:6]
+    tables = ['observation_fact', 'patient_dimension', 'patient_mapping', 'visit_dimension', 'encounter_mapping']
+
+    def setUp(self):
+        make_and_clear_directory(self.output_dir)
+
+    def tearDown(self):
+        make_and_clear_directory(self.output_dir)
+
+    def create_test_output(self, outdir: str, *args: str) -> None:
+        FHIRPatientMapping._clear()
+        FHIREncounterMapping._clear()
+        load_facts(f"-mv {self.mv} -u 1234 -t json --native -od {outdir}".split() + list(args))
+
+    def mapping_keys(self, outdir: str):
+        with open(os.path.join(outdir, 'patient_mapping.tsv')) as f:
+            return [l.split('\t')[:4] for l in f]
+
+    def line_count(self, outdir: str, table: str) -> int:
+        with open(os.path.join(outdir, table + '.tsv')) as f:
+            return sum(1 for _ in f)
+
+    def test_urls_match_files(self):
+        """ Downloading the input (concurrently, with a retry) must generate the same records as reading the files """
+        for mode in ('--stream', '--load-graph'):
+            args = [mode] if mode == '--stream' else []
+            file_dir = os.path.join(self.output_dir, 'files' + mode)
+            url_dir = os.path.join(self.output_dir, 'urls' + mode)
+            self.create_test_output(file_dir, *args, '-i', *[os.path.join(self.synthea_dir, fn) for fn in self.fnames])
+            with FHIRTestServer(self.synthea_dir, fail_once={self.fnames[1]}, delay=0.05) as server:
+                self.create_test_output(url_dir, *args, '--fetchers', '3', '-i',
+                                        *[server.url + fn for fn in self.fnames])
+            self.assertEqual(len(self.fnames) + 1, len(server.requests))
+            self.assertGreater(server.max_in_flight, 1)
+            for table in self.tables:
+                self.assertEqual(self.line_count(file_dir, table), self.line_count(url_dir, table), table)
+            if mode == '--stream':
+                self.assertEqual(self.mapping_keys(file_dir), self.mapping_keys(url_dir))
+            else:
+                # Patient numbers are assigned in graph order when the input is loaded as a single graph
+                self.assertEqual(sorted(k[:2] for k in self.mapping_keys(file_dir)),
+                                 sorted(k[:2] for k in self.mapping_keys(url_dir)))
+
+    def test_empty_rdf_payload(self):
+        """ An empty turtle download is reported and skipped """
+        g = Graph()
+        output = StringIO()
+        with redirect_stdout(output):
+            parse_rdf_payload(g, b'')
+        self.assertEqual("   Read Failed\n", output.getvalue())
+        self.assertEqual(0, len(g))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import gzip
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Set, List
+
+
+class FHIRTestServer:
+    """
+    Local HTTP stand-in for a FHIR server.  Serves the files in a directory over keep-alive (HTTP/1.1) connections,
+    gzipping the response when the client accepts it, and records what it was asked for.
+
+        with FHIRTestServer(directory) as server:
+            urlopen(server.url + 'Patient.json')
+    """
+    def __init__(self, directory: str, fail_once: Set[str] = frozenset(), delay: float = 0) -> None:
+        """
+        Create a server
+        :param directory: directory of files to serve
+        :param fail_once: names of the files whose first request is answered with a 503
+        :param delay: seconds to wait before answering each request
+        """
+        self.directory = directory
+        self.fail_once = set(fail_once)
+        self.delay = delay
+        self.requests = []              # type: List[str]
+        self.num_connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.gzipped = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/'.format(self._server.server_port)
+
+    def __enter__(self) -> "FHIRTestServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.num_connections += 1
+
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                name = self.path.lstrip('/').split('?')[0]
+                with server._lock:
+                    server.requests.append(name)
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                    fail = name in server.fail_once
+                    server.fail_once.discard(name)
+                # Requests are only counted as in flight while they are delayed, so the count is never off because
+                # a client has already sent its next request on another connection
+                time.sleep(server.delay)
+                with server._lock:
+                    server.in_flight -= 1
+                path = os.path.join(server.directory, name)
+                if fail or not os.path.isfile(path):
+                    self.send_response(503 if fail else 404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                with open(path, 'rb') as f:
+                    body = f.read()
+                self.send_response(200)
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                    with server._lock:
+                        server.gzipped += 1
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        return Handler